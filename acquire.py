@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent acquisition of missing AIA data.
+
+All the channels missing for one or more observation times are fetched at
+once by a bounded pool of threads, with retries, and the outcome for every
+channel is collected in a report rather than stopping at the first failure.
+Where the files come from is decided by a fetcher object with a single
+method,
+
+    fetch(wlen, start, end, dest_dir) -> list of file names
+
+so the VSO can be replaced by a local directory (LocalFetcher) in tests and
+offline runs. The fetcher used by default is a VSOFetcher, or a LocalFetcher
+for $CORONATEMPS_FETCH_DIR if that is set; set_fetcher overrides both.
+"""
+
+import os
+import time
+import shutil
+import Queue
+import threading
+import datetime as dt
+from os import path
+from archive import archive_index
+
+wlens = ['094', '131', '171', '193', '211', '335']
+
+_fetcher = []
+
+
+class VSOFetcher(object):
+    """
+    Fetch AIA level 1 files from the VSO.
+
+    Parameters
+    ----------
+    provider, site : str
+        Data provider to query and mirror to download from.
+    methods : list, optional
+        Transfer methods to ask for, e.g. ['URL_FILE_Rice'].
+    """
+    def __init__(self, provider='JSOC', site='NSO', methods=None):
+        self.provider = provider
+        self.site = site
+        self.methods = methods
+
+    def fetch(self, wlen, start, end, dest_dir):
+        from sunpy.net import vso
+        from astropy import units as u
+        # A client per call, as they are not safe to share between threads
+        client = vso.VSOClient()
+        # Wavelength value for query needs to be an astropy Quantity
+        wquant = u.Quantity(value=int(wlen), unit='Angstrom')
+        qr = client.query(vso.attrs.Time(start, end),
+                          vso.attrs.Wave(wquant, wquant),
+                          vso.attrs.Instrument('aia'),
+                          vso.attrs.Provider(self.provider))
+        if len(qr) == 0:
+            raise IOError('VSO has no {} data from {} to {}'.format(
+                wlen, start, end))
+        kwargs = {'path': path.join(dest_dir, '{file}'), 'site': self.site}
+        if self.methods:
+            kwargs['methods'] = self.methods
+        files = [f for f in client.get(qr, **kwargs).wait() if f]
+        if not files:
+            raise IOError('Download of {} data from {} to {} failed'.format(
+                wlen, start, end))
+        return files
+
+
+class LocalFetcher(object):
+    """
+    Stand-in for VSOFetcher that copies files from a local directory, found
+    through its archive index.
+
+    Parameters
+    ----------
+    source_dir : str
+        Directory holding the files to hand out.
+    link : bool
+        Symlink the files rather than copying them.
+    """
+    def __init__(self, source_dir, link=False):
+        self.source_dir = source_dir
+        self.link = link
+
+    def fetch(self, wlen, start, end, dest_dir):
+        index = archive_index(self.source_dir)
+        sources = index.between(wlen, start, end)
+        if not sources:
+            index.scan()
+            sources = index.between(wlen, start, end)
+        if not sources:
+            raise IOError('No {} data from {} to {} in {}'.format(
+                wlen, start, end, self.source_dir))
+        files = []
+        for source in sources:
+            fname = path.join(dest_dir, path.basename(source))
+            if path.exists(fname):
+                pass
+            elif self.link:
+                os.symlink(path.abspath(source), fname)
+            else:
+                shutil.copy2(source, fname)
+            files.append(fname)
+        return files
+
+
+def set_fetcher(fetcher):
+    """Use fetcher by default from now on; None restores the default."""
+    del _fetcher[:]
+    if fetcher is not None:
+        _fetcher.append(fetcher)
+
+
+def get_fetcher():
+    """Return the fetcher used when none is given."""
+    if _fetcher:
+        return _fetcher[0]
+    if os.environ.get('CORONATEMPS_FETCH_DIR'):
+        return LocalFetcher(os.environ['CORONATEMPS_FETCH_DIR'])
+    return VSOFetcher()
+
+
+class AcquisitionReport(object):
+    """
+    Outcome of an acquisition. found holds the channels that were already
+    in the archive, fetched the files downloaded for each job and failed the
+    last error for each job that could not be completed. Jobs are
+    (wlen, start, end, dest_dir) tuples.
+    """
+    def __init__(self):
+        self.found = []
+        self.fetched = {}
+        self.failed = {}
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def __str__(self):
+        lines = ['{} channels found, {} fetched, {} failed'.format(
+            len(self.found), len(self.fetched), len(self.failed))]
+        for job, err in sorted(self.failed.items()):
+            lines.append('  {} from {}: {}'.format(job[0], job[1], err))
+        return '\n'.join(lines)
+
+
+def acquire(jobs, fetcher=None, max_workers=6, retries=3, retry_wait=5.0,
+            report=None, verbose=False):
+    """
+    Carry out a list of fetches concurrently.
+
+    Parameters
+    ----------
+    jobs : list
+        (wlen, start, end, dest_dir) for each fetch.
+    fetcher : object, optional
+        Fetcher to use; see get_fetcher.
+    max_workers : int
+        Largest number of fetches in progress at once.
+    retries : int
+        Number of further attempts at a failed fetch. The wait before each
+        doubles, starting from retry_wait seconds.
+    report : AcquisitionReport, optional
+        Report to add the results to.
+
+    Returns
+    -------
+    report : AcquisitionReport
+    """
+    if fetcher is None:
+        fetcher = get_fetcher()
+    if report is None:
+        report = AcquisitionReport()
+    todo = Queue.Queue()
+    for job in jobs:
+        todo.put(job)
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                job = todo.get_nowait()
+            except Queue.Empty:
+                return
+            wlen, start, end, dest_dir = job
+            for attempt in range(retries + 1):
+                try:
+                    if not path.isdir(dest_dir):
+                        try:
+                            os.makedirs(dest_dir)
+                        except OSError:
+                            if not path.isdir(dest_dir):
+                                raise
+                    files = fetcher.fetch(wlen, start, end, dest_dir)
+                except Exception as err:
+                    error = err
+                    if verbose:
+                        print 'Fetching {} for {} failed (attempt {}): ' \
+                            '{}'.format(wlen, start, attempt + 1, err)
+                    if attempt < retries:
+                        time.sleep(retry_wait * 2 ** attempt)
+                else:
+                    with lock:
+                        report.fetched[job] = files
+                    if verbose: print 'Fetched {} for {}'.format(wlen, start)
+                    break
+            else:
+                with lock:
+                    report.failed[job] = error
+
+    workers = [threading.Thread(target=work)
+               for i in range(max(min(max_workers, len(jobs)), 1))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return report
+
+
+def download_dir(data_dir, date, wlen):
+    """Directory of the archive that downloads for a channel are saved in."""
+    return path.join(data_dir, '{:%Y/%m/%d}'.format(date), wlen)
+
+
+def fetch_missing(dates, data_dir, channels=None, fetcher=None,
+                  max_workers=6, retries=3, tolerance=12, verbose=False):
+    """
+    Make sure the archive has data for every channel at each of a list of
+    observation times, fetching whatever is missing concurrently.
+
+    Channels already in the archive index within tolerance seconds are left
+    alone, measured from the span of time each file name covers (a file
+    named only to the minute holds the whole minute; see
+    archive.parse_filename). Fetched files are saved under data_dir as laid
+    out by download_dir and added to the index. Other arguments are as for
+    acquire.
+
+    Returns
+    -------
+    report : AcquisitionReport
+        Check report.ok, or report.failed for the channels that could not be
+        fetched.
+    """
+    if channels is None:
+        channels = wlens
+    archive = archive_index(data_dir)
+    report = AcquisitionReport()
+    wanted = [(wlen, date) for date in dates for wlen in channels]
+    missing = [(wlen, date) for wlen, date in wanted
+               if archive.nearest(wlen, date, tolerance) is None]
+    if missing:
+        # Pick up anything added to the archive since it was last scanned
+        archive.scan()
+        missing = [(wlen, date) for wlen, date in missing
+                   if archive.nearest(wlen, date, tolerance) is None]
+    report.found = [item for item in wanted if item not in missing]
+    jobs = [(wlen, date - dt.timedelta(seconds=5),
+             date + dt.timedelta(seconds=11),
+             download_dir(data_dir, date, wlen)) for wlen, date in missing]
+    if jobs:
+        if verbose: print 'Fetching {} missing channels'.format(len(jobs))
+        acquire(jobs, fetcher, max_workers, retries, report=report,
+                verbose=verbose)
+        for files in report.fetched.values():
+            archive.add(files)
+    return report
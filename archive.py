@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the AIA files in a data archive.
+
+Files are found by wavelength and observation time, both parsed from their
+names, with a query against a local SQLite database rather than globbing the
+archive. Rescans are incremental: a directory is only listed again if its
+modification time has changed since it was last scanned, so keeping the
+index up to date costs one stat per directory rather than a listing of
+every file.
+
+Run as a script to build or refresh the index of an archive:
+
+    python archive.py <data_dir> [full]
+"""
+
+import os
+import re
+import sqlite3
+import calendar
+import datetime as dt
+from os import path
+from sys import argv
+from cache import default_cache_dir, hash_items
+
+# Names given to level 1 files by the VSO and JSOC, e.g.
+# aia_lev1_171a_2011_02_15t01_50_00_34z_image_lev1.fits and
+# aia.lev1.171A_2011-02-15T01_50_00.34Z.image_lev1.fits
+_lev1_name = re.compile(
+    r'^aia[._]lev1[._](\d+)a[._](\d{4})[._-](\d\d)[._-](\d\d)t'
+    r'(\d\d)[._:-](\d\d)[._:-](\d\d)(?:[._](\d+))?z?.*\.fits$', re.I)
+# Short names used in our archive, e.g. AIA20110215_0150_0171.fits
+_short_name = re.compile(
+    r'^aia(\d{4})(\d\d)(\d\d)_(\d\d)(\d\d)(\d\d)?_(\d+)\.fits$', re.I)
+# Longest time span covered by a file name: a short name without seconds
+# stands for any time in its minute
+_max_span = 60.0
+
+# Index databases already opened by this process, by archive directory
+_indexes = {}
+
+
+def wavelength_name(wlen):
+    """Canonical name of an AIA channel, e.g. '94' for '094' or 94."""
+    try:
+        return str(int(wlen))
+    except ValueError:
+        return str(wlen).lower()
+
+
+def epoch_seconds(time):
+    """Convert a datetime to seconds since 1970-01-01 (UTC)."""
+    return calendar.timegm(time.utctimetuple()) + time.microsecond / 1e6
+
+
+def parse_filename(name):
+    """
+    Get the wavelength and observation time of an AIA file from its name.
+
+    Returns (wavelength, seconds since 1970, span) or None if the name is
+    not recognised. span is the number of seconds after that time the name
+    could stand for: 60 for a short name giving only hours and minutes, 1
+    for one truncated to whole seconds, and 0 for a level 1 name.
+    """
+    match = _lev1_name.match(name)
+    if match:
+        wlen, fields, frac = match.group(1), match.groups()[1:7], \
+            match.group(8)
+        span = 0.0
+    else:
+        match = _short_name.match(name)
+        if not match:
+            return None
+        fields, wlen = list(match.groups()[:6]), match.group(7)
+        span = 1.0 if fields[5] else _max_span
+        fields[5] = fields[5] or '0'
+        frac = None
+    time = epoch_seconds(dt.datetime(*[int(f) for f in fields]))
+    if frac:
+        time += float('0.' + frac)
+    return wavelength_name(wlen), time, span
+
+
+class ArchiveIndex(object):
+    """
+    Index of the files in an AIA data archive.
+
+    Parameters
+    ----------
+    data_dir : str
+        Root of the archive. Files may be anywhere below it.
+    db_file : str, optional
+        Index database. Defaults to a file per archive in an 'archive'
+        directory of cache.default_cache_dir().
+    """
+    def __init__(self, data_dir, db_file=None):
+        self.data_dir = path.abspath(data_dir)
+        if db_file is None:
+            db_dir = path.join(default_cache_dir(), 'archive')
+            if not path.isdir(db_dir):
+                try:
+                    os.makedirs(db_dir)
+                except OSError:
+                    if not path.isdir(db_dir):
+                        raise
+            db_file = path.join(db_dir,
+                                hash_items(self.data_dir) + '.sqlite')
+        self.db_file = db_file
+        with self._connect() as conn:
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(files)')]
+            if columns and 'span' not in columns:
+                # Index from before time spans were recorded: rebuild it
+                conn.execute('DROP TABLE files')
+                conn.execute('DROP TABLE IF EXISTS dirs')
+            conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY '
+                         'KEY, dir TEXT, wlen TEXT, time REAL, span REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS files_wlen_time ON '
+                         'files (wlen, time)')
+            conn.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+            conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY '
+                         'KEY, parent TEXT, mtime REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON '
+                         'dirs (parent)')
+
+    def _connect(self):
+        # A connection per operation, so an index can be used from several
+        # threads and processes at once
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def _forget(self, conn, dirname):
+        """Remove a directory and everything below it from the index."""
+        prefix = dirname.rstrip('/') + '/'
+        conn.execute('DELETE FROM files WHERE dir = ? OR '
+                     'substr(dir, 1, ?) = ?', (dirname, len(prefix), prefix))
+        conn.execute('DELETE FROM dirs WHERE path = ? OR '
+                     'substr(path, 1, ?) = ?', (dirname, len(prefix), prefix))
+
+    def scan(self, top=None, full=False):
+        """
+        Bring the index up to date with the files under top (by default the
+        whole archive). Unless full is True, directories that have not been
+        modified since they were last scanned are not listed again.
+
+        Returns the number of directories listed.
+        """
+        top = path.abspath(top or self.data_dir)
+        n_listed = 0
+        with self._connect() as conn:
+            stack = [top]
+            while stack:
+                dirname = stack.pop()
+                try:
+                    mtime = os.stat(dirname).st_mtime
+                except OSError:
+                    self._forget(conn, dirname)
+                    continue
+                row = conn.execute('SELECT mtime FROM dirs WHERE path = ?',
+                                   (dirname,)).fetchone()
+                known = [d for (d,) in conn.execute(
+                    'SELECT path FROM dirs WHERE parent = ?', (dirname,))]
+                if not full and row is not None and row[0] == mtime:
+                    stack.extend(known)
+                    continue
+
+                files, subdirs = [], []
+                for name in os.listdir(dirname):
+                    fname = path.join(dirname, name)
+                    # Recognised names are taken to be files without a stat
+                    parsed = parse_filename(name)
+                    if parsed is not None:
+                        files.append((fname, dirname) + parsed)
+                    elif path.isdir(fname):
+                        subdirs.append(fname)
+                for old in set(known) - set(subdirs):
+                    self._forget(conn, old)
+                conn.execute('DELETE FROM files WHERE dir = ?', (dirname,))
+                conn.executemany('INSERT OR REPLACE INTO files VALUES '
+                                 '(?, ?, ?, ?, ?)', files)
+                conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                             (dirname, path.dirname(dirname), mtime))
+                stack.extend(subdirs)
+                n_listed += 1
+        return n_listed
+
+    def add(self, filenames):
+        """
+        Add files (e.g. ones just downloaded) to the index without a rescan.
+        """
+        rows = []
+        for fname in filenames:
+            fname = path.abspath(fname)
+            parsed = parse_filename(path.basename(fname))
+            if parsed is not None:
+                rows.append((fname, path.dirname(fname)) + parsed)
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO files VALUES '
+                             '(?, ?, ?, ?, ?)', rows)
+
+    def nearest(self, wlen, time, tolerance=12.0):
+        """
+        Return the indexed file for a wavelength closest in time to the given
+        datetime, or None if there is none within tolerance seconds.
+
+        Times are compared with the span of time each file name stands for
+        (see parse_filename), so a file named only to the minute matches any
+        time within that minute. Of several matches, the one whose span is
+        centred closest to the time is returned.
+        """
+        time = epoch_seconds(time)
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT path FROM files WHERE wlen = ? AND time BETWEEN ? AND '
+                '? AND time + span >= ? ORDER BY ABS(time + span / 2 - ?), '
+                'path LIMIT 1',
+                (wavelength_name(wlen), time - tolerance - _max_span,
+                 time + tolerance, time - tolerance, time)).fetchone()
+        return row[0] if row else None
+
+    def between(self, wlen, start, end):
+        """
+        Return the indexed files for a wavelength observed between two
+        datetimes, in time order.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT path FROM files WHERE wlen = ? AND time BETWEEN ? AND '
+                '? ORDER BY time, path',
+                (wavelength_name(wlen), epoch_seconds(start),
+                 epoch_seconds(end))).fetchall()
+        return [row[0] for row in rows]
+
+    def find(self, wlen, time, tolerance=12.0):
+        """
+        As nearest, but if nothing is found rescan the archive for new files
+        and try again.
+        """
+        fname = self.nearest(wlen, time, tolerance)
+        if fname is None or not path.exists(fname):
+            self.scan()
+            fname = self.nearest(wlen, time, tolerance)
+        return fname
+
+
+def archive_index(data_dir):
+    """Return the (shared) ArchiveIndex for an archive directory."""
+    data_dir = path.abspath(data_dir)
+    if data_dir not in _indexes:
+        _indexes[data_dir] = ArchiveIndex(data_dir)
+    return _indexes[data_dir]
+
+
+if __name__ == '__main__':
+    index = ArchiveIndex(argv[1])
+    n_listed = index.scan(full=len(argv) > 2 and argv[2] == 'full')
+    with index._connect() as conn:
+        n_files = conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+    print 'Listed {} directories; {} files indexed'.format(n_listed, n_files)
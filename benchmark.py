@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the fitting pipeline on synthetic data.
+
+Input cubes are made from random Gaussian model DEMs with the same emission
+machinery as test_vs_model_DEMs.py, so no archive or network access is
+needed. Each case times the stages of a run separately:
+
+    responses   loading the temperature responses
+    model       building the synthetic emission table (in a private cache)
+    distribute  packing the pixels and handing them to the fitting processes
+    fit         the fitting kernel
+    gather      collecting the results and unpacking them into a frame
+    save        writing the map file
+
+over a sweep of image sizes, temperature grid sizes, numbers of parameters,
+backends and worker counts, and writes the results as JSON so that kernels,
+backends and versions can be compared. With the pool backend the fit time
+includes copying the pixels to shared memory and starting the workers.
+
+Usage:
+
+    python benchmark.py <results.json> [<options>]
+    mpiexec -n <n> python benchmark.py <results.json> "{'backends': ['mpi']}"
+    python benchmark.py compare <old.json> <new.json> [<threshold>]
+
+where options is a dict of keyword arguments to sweep. compare lists the
+stages of cases present in both files that got slower by more than
+threshold (default 1.2) times.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import numpy as np
+from sys import argv
+from os import path
+from itertools import product
+from utils import emission_table, load_temp_responses, valid_pixels
+from fitting import build_model_index, fit_images
+from create_tempmap import t0, synthetic_model, unpack_results
+from tmapfile import write_tempmap
+
+stages = ['responses', 'model', 'distribute', 'fit', 'gather', 'save']
+
+
+def benchmark_grid(n_params, n_temps, n_widths=7, n_heights=31):
+    """
+    Parameters of a model grid like that of create_tempmap.parameter_grid,
+    with n_temps temperatures from t0 to 7.0 and, for three parameters,
+    n_widths DEM widths from 0.1 to 0.7 and n_heights heights from 1e20 to
+    1e35.
+    """
+    temp = np.linspace(t0, 7.0, n_temps)
+    if n_params == 1:
+        widths = [0.1]
+        heights = [1.0]
+    else:
+        widths = np.linspace(0.1, 0.7, n_widths)
+        heights = 10.0 ** np.linspace(20, 35, n_heights)
+    return np.array([i for i in product(temp, widths, heights)])
+
+
+def synthetic_images(size, n_params, resp, noise=0.0, seed=0):
+    """
+    Synthetic AIA intensities of shape (6, size, size) for a random Gaussian
+    DEM in every pixel, normalised to the 171 channel for one parameter.
+    Relative Gaussian noise of the given level is added if noise > 0.
+    """
+    rng = np.random.RandomState(seed)
+    n = size * size
+    pars = np.empty((n, 3))
+    pars[:, 0] = rng.uniform(5.7, 6.9, n)
+    if n_params == 1:
+        pars[:, 1] = 0.1
+        pars[:, 2] = 1.0
+    else:
+        pars[:, 1] = rng.uniform(0.1, 0.6, n)
+        pars[:, 2] = 10.0 ** rng.uniform(25, 30, n)
+    images = emission_table(pars, resp).T.reshape((resp.shape[0], size, size))
+    if noise > 0:
+        images *= 1.0 + noise * rng.randn(*images.shape)
+    if n_params == 1:
+        images /= images[2].copy()
+    return images.astype('float32')
+
+
+class Timer(object):
+    """
+    Record the wall time of named stages, synchronising all processes of
+    comm before and after each one.
+    """
+    def __init__(self, comm=None):
+        self.comm = comm
+        self.times = {}
+
+    def __call__(self, name):
+        self.name = name
+        return self
+
+    def __enter__(self):
+        if self.comm is not None:
+            self.comm.Barrier()
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        if self.comm is not None:
+            self.comm.Barrier()
+        self.times[self.name] = time.time() - self.start
+
+
+def run_case(size, n_temps, n_params, backend='serial', workers=1,
+             search='scan', n_widths=7, n_heights=31, noise=0.0,
+             scratch_dir=None, comm=None):
+    """
+    Run the pipeline once on a synthetic cube and time each stage.
+
+    workers is the number of kernel threads for the serial backend and of
+    worker processes for the pool backend. The mpi backend uses every
+    process of comm, all of which must call this.
+
+    Returns a dict describing the case, with the time of each stage in
+    seconds on the root process (None elsewhere).
+    """
+    rank = comm.Get_rank() if comm is not None else 0
+    timer = Timer(comm)
+    if rank == 0:
+        model_dir = tempfile.mkdtemp(dir=scratch_dir, prefix='bench-')
+    try:
+        with timer('responses'):
+            resp = load_temp_responses()
+        parvals = benchmark_grid(n_params, n_temps, n_widths, n_heights)
+        with timer('model'):
+            if rank == 0:
+                model = synthetic_model(parvals, n_params,
+                                        cache_dir=model_dir, cache_size=None,
+                                        force_temp_scan=True)
+        index = None
+        if rank == 0:
+            images = synthetic_images(size, n_params, resp, noise)
+            if search == 'index':
+                index = build_model_index(model)
+
+        with timer('distribute'):
+            if rank == 0:
+                mask = valid_pixels(images)
+                packed = images[:, mask].reshape((images.shape[0], 1, -1))
+            if backend == 'mpi':
+                from mpiutils import scatter_columns, node_shared_array
+                packed = scatter_columns(comm, packed if rank == 0 else None)
+                model, model_win = node_shared_array(
+                    comm, model if rank == 0 else None)
+                if search == 'index':
+                    index = comm.bcast(index, root=0)
+        with timer('fit'):
+            if backend == 'pool':
+                from pool import fit_pool
+                temps, n_examined = fit_pool(packed, model, parvals,
+                                             n_params, search=search,
+                                             index=index, n_workers=workers)
+            else:
+                temps, n_examined = fit_images(
+                    packed, model, parvals, n_params, search=search,
+                    index=index, n_threads=workers if backend == 'serial'
+                    else 1)
+        with timer('gather'):
+            if backend == 'mpi':
+                from mpiutils import gather_columns
+                temps = gather_columns(comm, temps)
+                model_win.Free()
+            if rank == 0:
+                temps = unpack_results(temps, mask)
+        with timer('save'):
+            if rank == 0:
+                fname = path.join(model_dir, 'tempmap.fits')
+                write_tempmap(fname, temps, {'instrume': 'temperature'})
+                file_bytes = path.getsize(fname)
+    finally:
+        if rank == 0:
+            shutil.rmtree(model_dir)
+    if rank != 0:
+        return None
+
+    n_pixels = int(mask.sum())
+    n_vals = len(parvals)
+    fit_time = max(timer.times['fit'], 1e-9)
+    case = {'size': size, 'n_temps': n_temps, 'n_params': n_params,
+            'backend': backend, 'search': search, 'n_vals': n_vals,
+            'n_pixels': n_pixels, 'file_bytes': file_bytes,
+            'workers': comm.Get_size() if backend == 'mpi' else workers,
+            'times': timer.times,
+            'pixels_per_second': n_pixels / fit_time,
+            'models_per_second': n_pixels * float(n_vals) / fit_time}
+    if n_examined is not None:
+        case['models_examined'] = float(np.sum(n_examined, dtype=np.int64))
+    return case
+
+
+def case_key(case):
+    """Settings identifying a case, for matching it between runs."""
+    return tuple(case[name] for name in ['size', 'n_temps', 'n_params',
+                                         'backend', 'search', 'workers'])
+
+
+def machine_info():
+    """Description of the machine and software the benchmark ran on."""
+    return {'host': platform.node(), 'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.sysconf('SC_NPROCESSORS_ONLN'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'omp_num_threads': os.environ.get('OMP_NUM_THREADS'),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def sweep(output, sizes=(64, 128), n_temps=(36, 141), n_params=(1, 3),
+          backends=('serial', 'pool'), workers=(1, None), search='scan',
+          repeats=3, comm=None, verbose=True, **kwargs):
+    """
+    Run every combination of the given settings and write the results to
+    output as JSON.
+
+    Parameters
+    ----------
+    output : str
+        File to write the results to.
+    sizes : list
+        Image sizes; each image is size x size pixels.
+    n_temps : list
+        Numbers of temperatures in the model grid.
+    n_params : list
+        Numbers of fitted parameters.
+    backends : list
+        Any of 'serial', 'pool' and 'mpi'. Cases for the mpi backend need
+        the benchmark to be run under mpiexec and use every process.
+    workers : list
+        Thread or worker process counts (see run_case); None is one per
+        core.
+    repeats : int
+        Number of runs of each case. The time recorded for each stage is
+        the shortest of the runs.
+
+    Further keyword arguments are passed to run_case.
+
+    Returns
+    -------
+    results : dict
+        Machine description and list of cases, as written to output.
+    """
+    rank = comm.Get_rank() if comm is not None else 0
+    ncores = os.sysconf('SC_NPROCESSORS_ONLN')
+    workers = sorted(set(w or ncores for w in workers))
+    cases = []
+    for size, nt, npar, backend in product(sizes, n_temps, n_params,
+                                           backends):
+        for nw in ([None] if backend == 'mpi' else workers):
+            if backend != 'mpi' and rank != 0:
+                continue
+            runs = [run_case(size, nt, npar, backend, nw, search,
+                             comm=comm if backend == 'mpi' else None,
+                             **kwargs) for i in range(repeats)]
+            if rank != 0:
+                continue
+            case = runs[0]
+            case['runs'] = [run['times'] for run in runs]
+            case['times'] = dict((stage, min(run['times'][stage]
+                                             for run in runs))
+                                 for stage in stages)
+            fit_time = max(case['times']['fit'], 1e-9)
+            case['pixels_per_second'] = case['n_pixels'] / fit_time
+            case['models_per_second'] = case['n_pixels'] * \
+                float(case['n_vals']) / fit_time
+            cases.append(case)
+            if verbose:
+                print '{size}px {n_temps}T {n_params}p {backend} x{workers}: ' \
+                    'fit {fit:.3f}s ({rate:.3g} models/s)'.format(
+                        fit=fit_time, rate=case['models_per_second'], **case)
+    if rank != 0:
+        return None
+    results = {'machine': machine_info(), 'cases': cases}
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    return results
+
+
+def compare_results(old, new, threshold=1.2, min_time=1e-3):
+    """
+    Compare two benchmark result files.
+
+    Returns (case, stage, old time, new time) for every stage of the cases
+    in both files that got slower by more than threshold times, ignoring
+    stages that took less than min_time seconds in both.
+    """
+    old = dict((case_key(case), case) for case in json.load(open(old))['cases'])
+    slower = []
+    for case in json.load(open(new))['cases']:
+        before = old.get(case_key(case))
+        if before is None:
+            continue
+        for stage in stages:
+            t_old, t_new = before['times'][stage], case['times'][stage]
+            if max(t_old, t_new) >= min_time and \
+                    t_new > threshold * max(t_old, 1e-9):
+                slower.append((case_key(case), stage, t_old, t_new))
+    return slower
+
+
+if __name__ == '__main__':
+    if len(argv) < 2:
+        print __doc__
+        sys.exit(1)
+    if argv[1] == 'compare':
+        slower = compare_results(argv[2], argv[3],
+                                 float(argv[4]) if len(argv) > 4 else 1.2)
+        for key, stage, t_old, t_new in slower:
+            print '{} {}: {:.3f}s -> {:.3f}s'.format(key, stage, t_old, t_new)
+        sys.exit(1 if slower else 0)
+    options = eval(argv[2]) if len(argv) > 2 else {}
+    comm = None
+    if 'mpi' in options.get('backends', ()):
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    sweep(argv[1], comm=comm, **options)
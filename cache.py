@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk caches shared between CoronaTemps runs.
+
+Cached files are named by a hash of everything that went into them, so runs
+with the same configuration share a file and runs with different
+configurations can never pick up the wrong one. Files are written under a
+temporary name and renamed into place once complete, so any number of jobs
+can read a cache directory while another job is adding to it.
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+from os import path
+from utils import emission_table
+
+# Bump when the layout of cached model tables changes
+MODEL_FORMAT = 1
+
+# Mode of a file created normally, given to cached files as mkstemp makes
+# them private. The umask can only be read by setting it, which is not
+# thread-safe, so it is read once on import.
+_umask = os.umask(0)
+os.umask(_umask)
+_file_mode = 0o666 & ~_umask
+
+
+def default_cache_dir():
+    """
+    Root directory for cached files: $CORONATEMPS_CACHE if it is set,
+    otherwise ~/.cache/CoronaTemps.
+    """
+    return os.environ.get('CORONATEMPS_CACHE',
+                          path.expanduser('~/.cache/CoronaTemps'))
+
+
+def hash_items(*items):
+    """
+    Return a hex digest identifying a sequence of arrays and simple values.
+    """
+    digest = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            item = np.ascontiguousarray(item)
+            digest.update(str(item.dtype).encode())
+            digest.update(str(item.shape).encode())
+            digest.update(item.tobytes())
+        else:
+            digest.update(repr(item).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class CacheDir(object):
+    """
+    A directory of cached files evicted least-recently-used first once their
+    total size exceeds max_bytes. A file's modification time is used as its
+    last-use time and is updated whenever it is read through get().
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Created by another job in the meantime
+                if not path.isdir(cache_dir):
+                    raise
+
+    def filename(self, key, ext=''):
+        return path.join(self.cache_dir, key + ext)
+
+    def get(self, key, ext=''):
+        """Return the path of a cached file, or None if there isn't one."""
+        fname = self.filename(key, ext)
+        try:
+            os.utime(fname, None)
+        except OSError:
+            return None
+        return fname
+
+    def put(self, key, write, ext=''):
+        """
+        Add a file to the cache. write is called with a temporary filename to
+        create the file at; it is then moved into place atomically.
+        """
+        fname = self.filename(key, ext)
+        fd, tmpname = tempfile.mkstemp(dir=self.cache_dir,
+                                       prefix='.tmp-', suffix=ext)
+        # So that a shared cache can be read by everyone using it
+        os.fchmod(fd, _file_mode)
+        os.close(fd)
+        try:
+            write(tmpname)
+            os.rename(tmpname, fname)
+        except:
+            if path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        self.evict(keep=fname)
+        return fname
+
+    def evict(self, keep=None):
+        """
+        Remove least-recently-used files until the cache fits in max_bytes.
+        Jobs that already have a removed file open can carry on using it.
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            fname = path.join(self.cache_dir, name)
+            if name.startswith('.tmp-') or not path.isfile(fname):
+                continue
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if fname == keep:
+                continue
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= size
+
+
+def model_key(parvals, resp, n_params, corrections, norm=None):
+    """
+    Hash identifying the synthetic emission table for a parameter grid,
+    set of temperature responses and response correction setting.
+    """
+    return hash_items('synth_emiss', MODEL_FORMAT, n_params, corrections,
+                      norm, np.asarray(parvals, dtype='float64'),
+                      np.asarray(resp, dtype='float64'))
+
+
+def load_model(parvals, resp, n_params, corrections=True, norm=None,
+               cache_dir=None, max_bytes=2**30, force=False, verbose=False):
+    """
+    Load the synthetic emission table for a parameter grid from the model
+    cache, building and caching it first if necessary.
+
+    Parameters
+    ----------
+    parvals : numpy.ndarray
+        DEM parameters of every model, shape (n_vals, 3).
+    resp : numpy.ndarray
+        Temperature responses used to build the table, after any
+        normalisation.
+    n_params : int
+        Number of fitted parameters. With one parameter the table is
+        normalised to the 171 channel.
+    corrections : bool
+        Whether empirical corrections were applied to resp.
+    norm : bool, optional
+        Passed to utils.emission_table.
+    cache_dir : str, optional
+        Directory of the model cache. Defaults to a 'models' directory in
+        default_cache_dir().
+    max_bytes : int, optional
+        Size limit of the model cache. None for no limit.
+    force : bool
+        Rebuild the table even if it is already in the cache.
+
+    Returns
+    -------
+    model : numpy.memmap
+        Read-only synthetic emission table, shape (n_vals, n_wlens).
+    """
+    if cache_dir is None:
+        cache_dir = path.join(default_cache_dir(), 'models')
+    cache = CacheDir(cache_dir, max_bytes)
+    key = model_key(parvals, resp, n_params, corrections, norm)
+    fname = None if force else cache.get(key, '.npy')
+    if fname is not None:
+        try:
+            model = np.load(fname, mmap_mode='r')
+        except (IOError, OSError):
+            # Evicted by another job since it was found; build it again
+            fname = None
+        else:
+            if verbose:
+                print 'Using cached synthetic emission data {}'.format(fname)
+    if fname is None:
+        if verbose:
+            print 'No synthetic emission data found. Re-scanning temperature range.'
+
+        def write(tmpname):
+            model = np.lib.format.open_memmap(
+                tmpname, mode='w+', dtype='float32',
+                shape=(len(parvals), resp.shape[0]))
+            emission_table(parvals, resp, norm=norm, out=model)
+            if n_params == 1:
+                model /= np.array(model[:, 2:3])
+            model.flush()
+            del model
+        fname = cache.put(key, write, '.npy')
+        model = np.load(fname, mmap_mode='r')
+    return model
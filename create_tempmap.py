@@ -6,128 +6,114 @@ Created on Thu Jun  5 15:15:09 2014
 """
 
 from __future__ import division
-from matplotlib import use
-use('agg')
-import matplotlib.pyplot as plt
-from matplotlib import cm, _cm
-from matplotlib import patches
 import numpy as np
 import sunpy
 from sunpy.map import Map, GenericMap
-from sunpy.instr.aia import aiaprep
-from sunpy.net import vso
-from scipy.io.idl import readsav as read
 from sys import argv
-from os import path, system, makedirs
+from os import path
 import datetime as dt
-from sunpy.time.timerange import TimeRange as tr
-import glob
 from itertools import product
-from mpi4py import MPI
-from utils import gaussian, load_temp_responses
-from astropy.units import Unit
-try:
-    from fits import calc_fits
-    print 'Fortran extension imported successfully'
-except ImportError:
-    print 'Current extension is broken, missing or incompatible.\n'\
-        +'Compiling Fortran extension.'
-    system(path.expanduser('f2py -c -m fits ~/CoronaTemps/fitsmodule.f90'))
-    from fits import calc_fits
+from utils import load_temp_responses, valid_pixels
+from archive import archive_index
+from acquire import fetch_missing
+from prep import prep_image, prep_images, check_grid
+from cache import load_model
+import instrument
+from grids import load_grid, is_product_grid
+from fitting import build_model_index, fit_images, fit_summary, fit_warm, \
+    path_counts, pack_previous, warm_start_from_map, refine_fits, \
+    fit_quantised, merge_quantise_stats
 
 
 home = path.expanduser('~')
-comm = MPI.COMM_WORLD
-rank = comm.Get_rank()
-size = comm.Get_size()
-
-args = []
-for a in argv[1:]:
-    for f in [eval, sunpy.time.parse_time]:
-        try:
-            a = f(a)
-            break
-        except:
-            continue
-    args.append(a)
-
-date, n_params, data_dir, datfile, submap, verbose, force_temp_scan = args
-
 wlens = ['094', '131', '171', '193', '211', '335']
 t0 = 5.6
-thiswlen = None
 
-if rank == 0:
+
+def find_channel(date, wlen, data_dir, verbose=False):
+    """
+    Return the archive file for one wavelength at the given time,
+    downloading it first if necessary.
+    """
+    if date == 'model':
+        fits_dir = path.join(data_dir, 'synthetic', wlen)
+        return path.join(fits_dir, 'model.fits')
+    archive = archive_index(data_dir)
+    filename = archive.find(wlen, date, tolerance=12)
+    if filename is None:
+        if verbose: print 'No data found for {}. Downloading...'.format(wlen)
+        report = fetch_missing([date], data_dir, [wlen], verbose=verbose)
+        if not report.ok:
+            raise IOError('No {} data for {}\n{}'.format(wlen, date, report))
+        filename = archive.nearest(wlen, date, tolerance=12) or \
+            sorted(sum(report.fetched.values(), []))[0]
+    if verbose: print 'File found: ', filename
+    return filename
+
+
+def load_channel(date, wlen, data_dir, submap=None, verbose=False):
+    """
+    Find (or download) and prepare the AIA image for one wavelength, scaled
+    to counts per second.
+    """
+    filename = find_channel(date, wlen, data_dir, verbose)
+    if date == 'model':
+        return Map(filename)
+    return prep_image(filename, submap)
+
+
+def load_images(date, n_params, data_dir, datfile=None, submap=None,
+                verbose=False, n_workers=None, pool=None):
+    """
+    Find, load and prepare the AIA images to be fitted. The images are
+    prepared in parallel by n_workers processes (default one per channel),
+    or by a multiprocessing.Pool passed as pool; see prep.prep_images.
+
+    Returns the images as a float32 array of shape (n_wlens, ny, nx) and the
+    header of the 171 image.
+    """
     if datfile:
-        images = {}
-        f = open(datfile)
-        # Loop through wavelengths
-        for line in f:
+        # Average the images listed for each wavelength
+        filelists = {}
+        for line in open(datfile):
             if line[:3] in wlens:
-                allwlenmaps = []
                 thiswlen = line[:3]
+                filelists[thiswlen] = []
                 print 'Loading {} files'.format(thiswlen)
             elif 'fits' in line:
-                thismap = aiaprep(Map(line[:-1]))
-                thismap.data /= thismap.exposure_time
-                allwlenmaps.append(thismap)
-            elif line.strip() in ['', '\n']:
-                if thiswlen:
-                    wlenmap = allwlenmaps[-1]
-                    for thismap in allwlenmaps[:-1]:
-                        wlenmap.data += thismap.data
-                    wlenmap.data /= len(allwlenmaps)
-                    images[thiswlen] = wlenmap
- 
-        images = [images[w] for w in wlens]
-    else:
+                filelists[thiswlen].append(line[:-1])
+        prepped = prep_images(sum([filelists[w] for w in wlens], []),
+                              n_workers=n_workers, pool=pool)
         images = []
-        #imagefiles = []
-        for wl, wlen in enumerate(wlens):
-            if date == 'model':
-                fits_dir = path.join(data_dir, 'synthetic', wlen)
-                images.append(Map(path.join(fits_dir, 'model.fits')))
-                continue
-            else:
-                fits_dir = path.join(data_dir, '{:%Y/*/*}/{}'.format(date, wlen))
-            if verbose: print 'Searching {} for AIA data'.format(fits_dir)
-            timerange = tr(date - dt.timedelta(seconds=5),
-                           date + dt.timedelta(seconds=11))
-            ntimes = int(timerange.seconds())
-            times = [time.start() for time in timerange.split(ntimes)]
-            for time in times:
-                filename = path.join(fits_dir,
-                    #'aia*{0:%Y?%m?%d}?{0:%H?%M?%S}*lev1?fits'.format(time))
-                    'AIA{0:%Y%m%d_%H%M_*.fits}'.format(time))
-                if verbose: print filename
-                filelist = glob.glob(filename)
-                if verbose: print filelist
-                if filelist != []:
-                    if verbose: print 'File found: ', filelist[0]
-                    #imagefiles.append(filelist[0])
-                    temp_im = aiaprep(Map(filelist[0]))
-                    if submap:
-                        temp_im = temp_im.submap(*submap)
-                    temp_im.data /= temp_im.exposure_time # Can probably increase speed a bit by making this * (1.0/exp_time)
-                    images.append(temp_im)
-                    break
+        for wlen in wlens:
+            wlenmap = None
+            for thismap in [next(prepped) for f in filelists[wlen]]:
+                if wlenmap is None:
+                    wlenmap = thismap
                 else:
-                    pass
-            if len(images) < wl+1:
-                if verbose: print 'No data found for {}. Downloading...'.format(wlen)
-                client = vso.VSOClient()
-                qr = client.query(vso.attrs.Time(timerange.start(), timerange.end()),
-                                  vso.attrs.Wave(wlen, wlen),
-                                  vso.attrs.Instrument('aia'),
-                                  vso.attrs.Provider('JSOC'))
-                dwpath = path.join(fits_dir.replace('*/*', '{:%m/%d}'.format(date)),
-                                   '{file}')
-                res = client.get(qr, path=dwpath, site='NSO').wait()
-                temp_im = aiaprep(Map(res))
-                if submap:
-                    temp_im = temp_im.submap(*submap)
-                temp_im.data /= temp_im.exposure_time # Can probably increase speed a bit by making this * (1.0/exp_time)
-                images.append(temp_im)
+                    check_grid(thismap, wlenmap.data.shape, wlenmap.meta,
+                               wlen)
+                    wlenmap.data += thismap.data
+            wlenmap.data /= len(filelists[wlen])
+            images.append(wlenmap)
+    elif date == 'model':
+        images = [load_channel(date, wlen, data_dir) for wlen in wlens]
+    else:
+        # Fetch every missing channel at once before loading any
+        with instrument.stage('fetch'):
+            report = fetch_missing([date], data_dir, wlens, verbose=verbose)
+        if not report.ok:
+            raise IOError('Missing AIA data for {}\n{}'.format(date, report))
+        with instrument.stage('find'):
+            filenames = [find_channel(date, wlen, data_dir, verbose)
+                         for wlen in wlens]
+        with instrument.stage('prep'):
+            images = list(prep_images(filenames, submap, n_workers,
+                                      pool=pool))
+
+    # The channels are compared pixel by pixel, so must share one grid
+    for wlen, image in zip(wlens, images):
+        check_grid(image, images[0].data.shape, images[0].meta, wlen)
 
     # Normalise images to 171A if only using one parameter
     if n_params == 1:
@@ -136,102 +122,406 @@ if rank == 0:
         for i in range(len(wlens)):
             images[i].data /= normim
     header = images[2].meta.copy()
-    images = np.array([im.data for im in images])
-
-# Scatter image data to each process
-if rank == 0:
-    #[images[..., (p/size)*images.shape[2]:((p+1)/size)*images.shape[2]] \
-    #    for p in range(size)]
-    temp = []
-    for p in range(size):
-        mini = (p/size)*images.shape[2]
-        maxi = ((p+1)/size)*images.shape[2]
-        temp.append(images[..., mini:maxi])
-        if verbose: print p, mini, maxi, images[..., mini:maxi].shape
-    images = temp
-    if verbose: print len(images), images[0].shape
-else:
-    images = None
-images = comm.scatter(images, root=0)
-
-# Get dimensions of image
-x, y = images[0].shape
-if verbose:
-    print 'Image size, rank {}:'.format(rank), x, y
-    print 'Image maxes, rank {}:'.format(rank), [im.max() for im in images]
-n_wlens = images.shape[0]
-temp = np.arange(t0, 7.01, 0.01)
-if n_params == 1:
-    # Assume a width of the gaussian DEM distribution and normalise the height
-    widths = [0.1]
-    heights = [1.0]
-else:
-    widths = np.arange(0.1, 0.8, 0.1)
-    heights = 10.0 ** np.arange(20, 35.1, 0.1)
-    # TODO: check if either of the above are sensible ranges of numbers
-parvals = np.array([i for i in product(temp, widths, heights)])
-n_vals = len(temp) * len(widths) * len(heights)
-if verbose: print len(temp), len(widths), len(heights), n_vals, n_vals*6
-
-if rank == 0:
-    try:
-        if force_temp_scan:
-            raise IOError
-        model = np.memmap(filename='synth_emiss_{}pars'.format(n_params),
-                          dtype='float32', mode='r', shape=(n_vals, n_wlens))
-    except IOError:
-        if verbose: print 'No synthetic emission data found. Re-scanning temperature range.'
-        resp = load_temp_responses()
-        if n_params == 1:
-            resp /= resp[2, :]
-            resp[np.isnan(resp)] = 0
-        if verbose:
-            print resp.min(axis=1), np.nanmin(resp, axis=1)
-            print resp.max(axis=1), np.nanmax(resp, axis=1)
-        logt = np.arange(0, 15.05, 0.05)
-        delta_t = logt[1] - logt[0]
-        model = np.memmap(filename='synth_emiss_{}pars'.format(n_params),
-                          dtype='float32', mode='w+', shape=(n_vals, n_wlens))
-        for p, params in enumerate(parvals):
-            dem = gaussian(logt, *params)
-            f = resp * dem
-            model[p, :] = np.sum(f, axis=1) * delta_t
-        if verbose:
-            print model.max(axis=0)
-            print model[np.isnan(model)].size
-        if n_params == 1:
-            normmod = model[:, 2].reshape((n_vals, 1))
-            model /= normmod
-        model.flush()
-        if verbose: print model.max(axis=0)
-else:
-    model = None
-
-model = comm.bcast(model, root=0)
-
-if verbose:
-    if rank == 0: print 'Calculating temperature values...'
-    print rank, images.shape, model.shape, parvals.shape, n_vals, n_wlens, x, y, n_params
-    print [im.max() for im in images]
-    print model.max(axis=0)
-if n_params == 1:
-    parvals = parvals[:, 0]
-temps = calc_fits(images, model, parvals, n_vals, n_wlens, x, y, n_params)
-# Convert EM values to log scale if there are any
-if temps.shape[2] > 2: temps[..., 2] = np.log10(temps[..., 2])
-if verbose: print 'Done.'
-
-# Get data all back in one place and save it
-temps = comm.gather(temps, root=0)
-if rank == 0:
-    if verbose: print len(temps), temps[0].shape
-    temp = np.zeros(shape=(x, y*size, n_params+1))
-    for p in range(size):
-        mini = (p/size)*temp.shape[1]
-        maxi = ((p+1)/size)*temp.shape[1]
-        temp[:, mini:maxi, :] = temps[p]
-        if verbose: print p, mini, maxi, temp[:, mini:maxi, :].shape
-    temps = temp
-    if verbose: print 'End ct', temps.shape, temps[..., 0].mean(), temps[..., 1].mean()
-    tempmap = GenericMap(temps, header)
-    tempmap.save(path.expanduser('~/CoronaTemps/temporary.fits'))
+    images = np.array([im.data for im in images], dtype='float32')
+    return images, header
+
+
+def prepare_images(date, n_params, data_dir, datfile=None, submap=None,
+                   max_radius=1.5, verbose=False, pool=None):
+    """
+    Load the images to be fitted and pack the pixels worth fitting into a
+    list. pool is passed to load_images.
+
+    Returns the packed intensities, shape (n_wlens, 1, n_pixels), the mask
+    of fitted pixels and the header of the 171 image.
+    """
+    images, header = load_images(date, n_params, data_dir, datfile, submap,
+                                 verbose, pool=pool)
+    # Synthetic model data has no solar WCS to restrict the radius with
+    mask = valid_pixels(images, None if date == 'model' else header,
+                        max_radius)
+    if verbose: print 'Fitting {} of {} pixels'.format(mask.sum(), mask.size)
+    images = images[:, mask].reshape((len(wlens), 1, -1))
+    return images, mask, header
+
+
+def unpack_results(fitted, mask):
+    """
+    Put the results for a packed list of pixels, shape (1, n_pixels, n),
+    back into a frame of shape mask.shape + (n,), with NaN where no fit was
+    made.
+    """
+    temps = np.zeros(mask.shape + (fitted.shape[2],), dtype='float32')
+    temps[:] = np.nan
+    temps[mask] = fitted[0]
+    return temps
+
+
+def parameter_grid(n_params, solve_em=False, t_step=0.01, grid=None):
+    """
+    Return the temperature, width and height axes of the model grid and the
+    parameters of every model in it, shape (n_vals, 3). Temperatures run
+    from t0 to 7.0 in steps of t_step in log(T), unless a grid saved by
+    grids.save_grid (or a grid tuple) is given to use instead.
+    """
+    if grid is not None:
+        return load_grid(grid, n_params, solve_em)
+    temp = np.arange(t0, 7.0 + t_step / 2.0, t_step)
+    if n_params == 1:
+        # Assume a width of the gaussian DEM distribution and normalise the height
+        widths = [0.1]
+        heights = [1.0]
+    else:
+        widths = np.arange(0.1, 0.8, 0.1)
+        heights = 10.0 ** np.arange(20, 35.1, 0.1)
+        # TODO: check if either of the above are sensible ranges of numbers
+    if solve_em:
+        # Model emission for unit EM; the best EM is found for each pixel
+        heights = [1.0]
+    parvals = np.array([i for i in product(temp, widths, heights)])
+    return temp, widths, heights, parvals
+
+
+def model_responses(n_params, corrections=True):
+    """
+    Temperature responses the synthetic emission table is built from,
+    normalised to the 171 channel for one parameter.
+    """
+    resp = load_temp_responses(corrections=corrections)
+    if n_params == 1:
+        resp /= resp[2, :]
+        resp[np.isnan(resp)] = 0
+    return resp
+
+
+def synthetic_model(parvals, n_params, solve_em=False, corrections=True,
+                    cache_dir=None, cache_size=2**30, force_temp_scan=False,
+                    verbose=False):
+    """
+    Load the synthetic emission table for a parameter grid from the model
+    cache, building it if necessary.
+    """
+    resp = model_responses(n_params, corrections)
+    if verbose:
+        print resp.min(axis=1), np.nanmin(resp, axis=1)
+        print resp.max(axis=1), np.nanmax(resp, axis=1)
+    model = load_model(parvals, resp, n_params, corrections=corrections,
+                       norm=False if solve_em else None, cache_dir=cache_dir,
+                       max_bytes=cache_size, force=force_temp_scan,
+                       verbose=verbose)
+    if verbose: print model.max(axis=0)
+    return model
+
+
+def quantise_options(quantise):
+    """
+    Keyword arguments for fitting.fit_quantised from a quantise argument: a
+    resolution, a dict of arguments or True for the defaults.
+    """
+    if isinstance(quantise, dict):
+        return dict(quantise)
+    if quantise is True:
+        return {}
+    return {'resolution': quantise}
+
+
+def print_quantise_stats(stats):
+    """Print the combined stats of quantised fits (see fit_quantised)."""
+    print 'Quantised fit: {n_pixels} pixels in {n_groups} groups ' \
+        '({ratio:.1f} pixels per fit); largest error in {n_checked} pixels ' \
+        'checked: {max_t_error:.3g} in log(T), {max_fit_error:.3g} in ' \
+        'goodness of fit'.format(**merge_quantise_stats(stats))
+
+
+def create_tempmap(date, n_params=1, data_dir=None, datfile=None, submap=None,
+                   verbose=False, force_temp_scan=False, n_threads=0,
+                   solve_em=False, search='scan', corrections=True,
+                   cache_dir=None, cache_size=2**30, max_radius=1.5,
+                   comm=None, backend='serial', n_workers=None,
+                   previous=None, tol=0.01, radius=(5, 1, 5), summary=None,
+                   timing=None, refine=False, t_step=0.01, grid=None,
+                   quantise=None):
+    """
+    Calculate the temperatures for one set of AIA images.
+
+    Parameters
+    ----------
+    date : datetime or 'model'
+        Observation time of the images, or 'model' to fit the synthetic data
+        in data_dir/synthetic.
+    n_params : 1 or 3
+        Fit the temperature only (with a fixed DEM width), or the
+        temperature, DEM width and emission measure.
+    data_dir : str
+        Root of the AIA data archive.
+    datfile : str, optional
+        File listing the images to average for each wavelength, used instead
+        of searching data_dir.
+    submap : tuple, optional
+        Arguments to Map.submap selecting the region to fit.
+    n_threads : int
+        Number of threads used by the fitting kernel in each process. The
+        default uses all available cores in the serial backend, and one
+        thread per process with comm or the pool backend, whose processes
+        already share the cores.
+    solve_em : bool
+        With n_params=3, solve for each pixel's emission measure rather than
+        scanning a grid of them.
+    search : {'scan' | 'index'}
+        Full scan of the model table, or search of a sorted index of it
+        (same results, fewer models examined).
+    corrections : bool
+        Apply empirical corrections to the temperature responses.
+    cache_dir, cache_size :
+        Location and size limit of the synthetic emission cache; see
+        cache.load_model.
+    max_radius : float or None
+        Only fit pixels within this many solar radii of disk centre.
+    comm : mpi4py.MPI.Comm, optional
+        Communicator to share the fitting between. By default everything is
+        done in this process.
+    backend : {'serial' | 'pool'}
+        Without comm, fit in this process with the threaded kernel or share
+        the fit between a pool of n_workers worker processes (default one
+        per core).
+    previous : temperature.TemperatureMap, optional
+        Map of the previous frame to warm-start the fit from, using tol and
+        radius as described in fitting.fit_warm. Only available with the
+        serial backend and a full scan of the model grid.
+    summary : dict or True, optional
+        Also summarise the misfit landscape of every pixel with
+        fitting.fit_summary, passing it these keyword arguments (True for
+        the defaults). Only available with the serial backend and a full
+        scan of the model grid.
+    refine : bool or dict
+        Estimate each pixel's parameters between the grid nodes by a search
+        around its best node; see fitting.refine_fits, which is passed a
+        dict as keyword arguments. Not available with solve_em or warm
+        starts.
+    t_step : float
+        Spacing of the temperature grid in log(T). The fit takes time in
+        proportion to the number of temperatures.
+    grid : str or tuple, optional
+        Model grid saved by grids.save_grid, such as an adaptive grid from
+        grids.make_grid, to use instead of the uniform one (t_step is then
+        ignored). Refinement and warm starts need every combination of its
+        axes, so are not available with pruned grids.
+    quantise : float, dict or True, optional
+        With one parameter, fit pixels whose intensities agree to within
+        this relative resolution only once; see fitting.fit_quantised, which
+        is passed a dict as keyword arguments (True for the defaults). The
+        ratio of pixels to fits and the largest error against an exact fit
+        of a sample of pixels are printed. Not available with warm starts or
+        summaries.
+    timing : str or object, optional
+        Record the time taken by each stage of the run and the rate of the
+        fitting kernel, and report them at the end to this file (as JSON
+        lines) or sink; see instrument.enable. Recording stays on
+        afterwards. Without it, stages are only recorded if instrumentation
+        is already enabled, e.g. by $CORONATEMPS_INSTRUMENT.
+
+    Returns
+    -------
+    data, meta : numpy.ndarray, dict
+        Fit results of shape (ny, nx, n_params+1) and the header to go with
+        them, on the root process. Other processes return None.
+    summary : dict
+        Only if summary is given: the arrays returned by fit_summary,
+        expanded to frames of shape (ny, nx) or (ny, nx, n) with NaN where
+        no fit was made.
+    """
+    solve_em = solve_em and n_params != 1
+    if solve_em and search != 'scan':
+        raise ValueError("Only search='scan' is available with solve_em")
+    if previous is not None and (solve_em or search != 'scan' or
+                                 comm is not None or backend != 'serial'):
+        raise ValueError('Warm starts need the serial backend, a full model '
+                         "grid and search='scan'")
+    if summary and (solve_em or search != 'scan' or previous is not None or
+                    comm is not None or backend != 'serial'):
+        raise ValueError('Fit summaries need the serial backend, a full '
+                         "model grid and search='scan'")
+    if comm is not None and not n_threads:
+        # Every rank threading over all the cores would oversubscribe them
+        n_threads = 1
+    if refine and (solve_em or previous is not None):
+        raise ValueError('Refinement needs a full model grid and no warm '
+                         'start')
+    if quantise and (n_params != 1 or previous is not None or summary):
+        raise ValueError('Quantised fits need one parameter and no warm '
+                         'start or summary')
+    if timing is not None:
+        instrument.enable(timing)
+    if comm is not None:
+        from mpiutils import scatter_columns, gather_columns, \
+            node_shared_array
+        rank, size = comm.Get_rank(), comm.Get_size()
+    else:
+        rank, size = 0, 1
+
+    if rank == 0:
+        images, mask, header = prepare_images(date, n_params, data_dir,
+                                              datfile, submap, max_radius,
+                                              verbose)
+    else:
+        images = None
+
+    # Scatter image data to each process
+    if comm is not None:
+        with instrument.stage('scatter'):
+            images = scatter_columns(comm, images, root=0)
+
+    temp, widths, heights, parvals = parameter_grid(n_params, solve_em,
+                                                    t_step, grid)
+    if (refine or previous is not None) and \
+            not is_product_grid(temp, widths, heights, parvals):
+        raise ValueError('Refinement and warm starts need a grid with every '
+                         'combination of its axes')
+    n_vals = len(parvals)
+    if verbose: print len(temp), len(widths), len(heights), n_vals, n_vals*6
+
+    with instrument.stage('model'):
+        if rank == 0:
+            model = synthetic_model(parvals, n_params, solve_em, corrections,
+                                    cache_dir, cache_size, force_temp_scan,
+                                    verbose)
+        else:
+            model = None
+        if comm is not None:
+            # One read-only copy of the model per node, shared by its
+            # processes
+            model, model_win = node_shared_array(comm, model)
+
+        index = None
+        if search == 'index':
+            if rank == 0:
+                index = build_model_index(model)
+            if comm is not None:
+                index = comm.bcast(index, root=0)
+
+    if verbose:
+        if rank == 0: print 'Calculating temperature values...'
+        print rank, images.shape, model.shape, parvals.shape, n_vals, n_params
+    if previous is not None:
+        # Warm start from the previous map and the images it was fitted to
+        prev_images = load_images(sunpy.time.parse_time(previous.date),
+                                  n_params, data_dir, None, submap, verbose)[0]
+        previous = warm_start_from_map(previous, prev_images,
+                                       [temp, widths, heights])
+
+    def fit(block):
+        """Fit a block of pixels with the selected backend and search."""
+        if backend == 'pool' and comm is None:
+            from pool import fit_pool
+            return fit_pool(block, model, parvals, n_params, solve_em,
+                            search, index, n_workers, n_threads or 1)
+        return fit_images(block, model, parvals, n_params, solve_em, search,
+                          index, n_threads)
+
+    quantised = None
+    with instrument.stage('fit'):
+        if previous is not None:
+            temps, current, path = fit_warm(
+                images, model, parvals[:, 0] if n_params == 1 else parvals,
+                (len(temp), len(widths), len(heights)),
+                pack_previous(previous, mask), tol, radius, n_threads)
+            n_examined = None
+            print 'Warm start: {}'.format(path_counts(path))
+        elif summary:
+            options = summary if isinstance(summary, dict) else {}
+            temps, summary = fit_summary(images, model, parvals, n_params,
+                                         n_threads=n_threads, **options)
+            n_examined = None
+        elif quantise:
+            temps, n_examined, quantised = fit_quantised(
+                images, model, parvals, fit=fit, **quantise_options(quantise))
+        else:
+            temps, n_examined = fit(images)
+    if refine:
+        with instrument.stage('refine'):
+            temps = refine_fits(images, model, temps, [temp, widths, heights],
+                                n_params, **(refine if isinstance(refine, dict)
+                                             else {}))
+    n_pixels = images.shape[1] * images.shape[2]
+    instrument.count('pixels', n_pixels)
+    if quantised is not None:
+        # Groups of pixels fitted, plus the pixels checked exactly
+        n_fits = quantised['n_groups'] + quantised['n_checked']
+        instrument.count('groups', quantised['n_groups'])
+    else:
+        n_fits = n_pixels
+    if n_examined is not None:
+        instrument.count('models', int(n_examined.sum(dtype=np.int64)))
+    elif previous is None:
+        instrument.count('models', n_fits * n_vals)
+    if n_examined is not None:
+        n_examined = np.array([n_examined.sum(dtype=np.int64),
+                               n_examined.size])
+        if comm is not None:
+            n_examined = comm.reduce(n_examined, root=0)
+        if rank == 0:
+            print 'Index search examined {:.1f} of {} models per pixel'.format(
+                n_examined[0] / float(max(n_examined[1], 1)), n_vals)
+    if quantised is not None:
+        quantised = [quantised] if comm is None else \
+            comm.gather(quantised, root=0)
+        if rank == 0:
+            print_quantise_stats(quantised)
+    if verbose: print 'Done.'
+
+    # Get data all back in one place
+    with instrument.stage('gather'):
+        if comm is not None:
+            temps = gather_columns(comm, temps, root=0)
+            model_win.Free()
+        if rank == 0:
+            temps = unpack_results(temps, mask)
+    instrument.report(comm, 'create_tempmap')
+    if rank != 0:
+        return None
+    if verbose: print 'End ct', temps.shape, np.nanmean(temps[..., 0]), np.nanmean(temps[..., 1])
+
+    if summary:
+        for name, values in summary.items():
+            if values.ndim == 2:
+                values = unpack_results(values[..., np.newaxis], mask)[..., 0]
+            else:
+                values = unpack_results(values, mask)
+            summary[name] = values
+        return temps, header, summary
+    return temps, header
+
+
+if __name__ == '__main__':
+    from mpi4py import MPI
+
+    if len(argv) == 2 and argv[1].endswith('.pickle'):
+        # Arguments and keyword arguments pickled by
+        # temperature.create_tempmap_mpi
+        import cPickle as pickle
+        with open(argv[1], 'rb') as f:
+            args, options = pickle.load(f)
+    else:
+        args = []
+        for a in argv[1:]:
+            for f in [eval, sunpy.time.parse_time]:
+                try:
+                    a = f(a)
+                    break
+                except:
+                    continue
+            args.append(a)
+        # Optional dictionary of extra keyword arguments to create_tempmap
+        options = dict(args[7]) if len(args) > 7 else {}
+        args = args[:7]
+    # Name of the file to save the results to
+    output = options.pop('output',
+                         path.expanduser('~/CoronaTemps/temporary.fits'))
+
+    comm = MPI.COMM_WORLD
+    result = create_tempmap(*args, comm=comm, **options)
+    if result is not None:
+        with instrument.stage('save'):
+            tempmap = GenericMap(*result)
+            tempmap.save(output, clobber=True)
+        instrument.report(label='save')
@@ -1,31 +1,510 @@
-SUBROUTINE calc_fits(images, model, parvals, n_vals, n_wlens, x, y, n_pars, results)
+SUBROUTINE calc_fits(images, model, parvals, n_vals, n_wlens, x, y, n_pars, results, n_threads)
 
+! Find the best-fitting model for every pixel by a full scan of the model
+! table. Pixels are shared between OpenMP threads; n_threads <= 0 uses the
+! OpenMP default (OMP_NUM_THREADS or the number of cores).
+! The model table is stored one channel vector per column so that the inner
+! loop over wavelengths reads contiguous memory. From Python, pass model.T
+! for a C-ordered (n_vals, n_wlens) array to avoid a copy.
+
+!$ USE omp_lib
 IMPLICIT NONE
 INTEGER, INTENT(IN) :: n_vals, n_wlens, x, y, n_pars
+! Release the GIL so other Python threads can run during a fit
+!f2py threadsafe
+!f2py integer optional, intent(in) :: n_threads = 0
+INTEGER, INTENT(IN) :: n_threads
 REAL, DIMENSION(n_vals, n_pars), INTENT(IN) :: parvals
-REAL, DIMENSION(n_vals, n_wlens), INTENT(IN) :: model
+REAL, DIMENSION(n_wlens, n_vals), INTENT(IN) :: model
 REAL, DIMENSION(n_wlens, x, y), INTENT(IN) :: images
 REAL, DIMENSION(x, y, n_pars+1), INTENT(OUT) :: results
-INTEGER :: i, j, t, w
-REAL :: error, total_error, this_fit, best_fit
+INTEGER :: i, j, t, w, best_t, nt
+REAL :: total_error, this_fit, best_fit
+
+nt = 1
+!$ nt = omp_get_max_threads()
+IF (n_threads > 0) nt = n_threads
 
+!$OMP PARALLEL DO COLLAPSE(2) NUM_THREADS(nt) SCHEDULE(DYNAMIC, 64) &
+!$OMP PRIVATE(i, j, t, w, best_t, total_error, this_fit, best_fit)
 DO j = 1, y
   DO i = 1, x
     best_fit = 1e38 ! Arbitrarily large number
+    best_t = 1
     DO t = 1, n_vals
       total_error = 0.0
       DO w = 1, n_wlens
-        error = ABS(images(w,i,j) - model(t, w))
-        total_error = total_error + error
+        total_error = total_error + ABS(images(w,i,j) - model(w, t))
       END DO
       this_fit = total_error / REAL(n_wlens)
       IF (this_fit < best_fit) THEN
         best_fit = this_fit
-        results(i, j, 1:n_pars) = parvals(t, :)
-        results(i, j, n_pars+1) = this_fit
+        best_t = t
       END IF
     END DO
+    results(i, j, 1:n_pars) = parvals(best_t, :)
+    results(i, j, n_pars+1) = best_fit
   END DO
 END DO
+!$OMP END PARALLEL DO
 
 END SUBROUTINE calc_fits
+
+SUBROUTINE calc_fits_em(images, model, parvals, n_vals, n_wlens, x, y, n_pars, results, n_threads)
+
+! Find the best-fitting model for every pixel when the emission measure is
+! not part of the model grid. model holds the emission produced by each DEM
+! shape for unit emission measure, so the predicted intensities are linear in
+! the emission measure, EM. For each pixel and shape the EM minimising
+!   SUM(ABS(images(:,i,j) - EM * model(:,t)))
+! is the median of the ratios images/model weighted by model, which is found
+! exactly by sorting the n_wlens ratios. Results hold the shape parameters,
+! followed by the EM and the goodness of fit.
+
+!$ USE omp_lib
+IMPLICIT NONE
+INTEGER, INTENT(IN) :: n_vals, n_wlens, x, y, n_pars
+! Release the GIL so other Python threads can run during a fit
+!f2py threadsafe
+!f2py integer optional, intent(in) :: n_threads = 0
+INTEGER, INTENT(IN) :: n_threads
+REAL, DIMENSION(n_vals, n_pars), INTENT(IN) :: parvals
+REAL, DIMENSION(n_wlens, n_vals), INTENT(IN) :: model
+REAL, DIMENSION(n_wlens, x, y), INTENT(IN) :: images
+REAL, DIMENSION(x, y, n_pars+2), INTENT(OUT) :: results
+REAL, DIMENSION(n_wlens) :: ratio, weight
+INTEGER :: i, j, t, w, k, n, best_t, nt
+REAL :: total_error, this_fit, best_fit, em, best_em, total_weight, cumul, r, wt
+
+nt = 1
+!$ nt = omp_get_max_threads()
+IF (n_threads > 0) nt = n_threads
+
+!$OMP PARALLEL DO COLLAPSE(2) NUM_THREADS(nt) SCHEDULE(DYNAMIC, 64) &
+!$OMP PRIVATE(i, j, t, w, k, n, best_t, total_error, this_fit, best_fit, &
+!$OMP         em, best_em, total_weight, cumul, r, wt, ratio, weight)
+DO j = 1, y
+  DO i = 1, x
+    best_fit = 1e38 ! Arbitrarily large number
+    best_em = 0.0
+    best_t = 1
+    DO t = 1, n_vals
+      ! Insertion sort of the ratios for channels the model contributes to
+      n = 0
+      total_weight = 0.0
+      DO w = 1, n_wlens
+        IF (model(w, t) > 0.0) THEN
+          r = images(w, i, j) / model(w, t)
+          wt = model(w, t)
+          k = n
+          DO WHILE (k > 0)
+            IF (ratio(k) <= r) EXIT
+            ratio(k+1) = ratio(k)
+            weight(k+1) = weight(k)
+            k = k - 1
+          END DO
+          ratio(k+1) = r
+          weight(k+1) = wt
+          n = n + 1
+          total_weight = total_weight + wt
+        END IF
+      END DO
+      ! Weighted median, restricted to physical (non-negative) values
+      em = 0.0
+      cumul = 0.0
+      DO k = 1, n
+        cumul = cumul + weight(k)
+        IF (2.0 * cumul >= total_weight) THEN
+          em = MAX(ratio(k), 0.0)
+          EXIT
+        END IF
+      END DO
+      total_error = 0.0
+      DO w = 1, n_wlens
+        total_error = total_error + ABS(images(w,i,j) - em * model(w, t))
+      END DO
+      this_fit = total_error / REAL(n_wlens)
+      IF (this_fit < best_fit) THEN
+        best_fit = this_fit
+        best_em = em
+        best_t = t
+      END IF
+    END DO
+    results(i, j, 1:n_pars) = parvals(best_t, :)
+    results(i, j, n_pars+1) = best_em
+    results(i, j, n_pars+2) = best_fit
+  END DO
+END DO
+!$OMP END PARALLEL DO
+
+END SUBROUTINE calc_fits_em
+
+SUBROUTINE calc_fits_indexed(images, model, parvals, keys, order, n_vals, n_idx, n_wlens, x, y, n_pars, &
+                             results, n_examined, n_threads)
+
+! Find the same best-fitting model as calc_fits without scanning the whole
+! table. keys holds the sum over channels of each indexed model, sorted in
+! ascending order, and order the (1-based) model each key belongs to.
+! Because ABS(SUM(d) - SUM(m)) <= SUM(ABS(d - m)), models are examined
+! outwards from the pixel's own channel sum and the search stops once the
+! key difference alone exceeds the best misfit found so far. Ties are
+! broken towards the lowest model number, as in the full scan.
+! n_examined returns the number of models examined for each pixel.
+
+!$ USE omp_lib
+IMPLICIT NONE
+INTEGER, INTENT(IN) :: n_vals, n_idx, n_wlens, x, y, n_pars
+! Release the GIL so other Python threads can run during a fit
+!f2py threadsafe
+!f2py integer optional, intent(in) :: n_threads = 0
+INTEGER, INTENT(IN) :: n_threads
+REAL, DIMENSION(n_vals, n_pars), INTENT(IN) :: parvals
+REAL, DIMENSION(n_wlens, n_vals), INTENT(IN) :: model
+REAL(8), DIMENSION(n_idx), INTENT(IN) :: keys
+INTEGER, DIMENSION(n_idx), INTENT(IN) :: order
+REAL, DIMENSION(n_wlens, x, y), INTENT(IN) :: images
+REAL, DIMENSION(x, y, n_pars+1), INTENT(OUT) :: results
+INTEGER, DIMENSION(x, y), INTENT(OUT) :: n_examined
+! Relative safety margin on the stopping criterion to allow for rounding
+REAL(8), PARAMETER :: margin = 1.0d0 - 1.0d-5
+INTEGER :: i, j, t, w, k, lo, hi, mid, up, dn, best_t, nt, n_exam
+REAL :: total_error, this_fit, best_fit
+REAL(8) :: s, gap_up, gap_dn, gap
+
+nt = 1
+!$ nt = omp_get_max_threads()
+IF (n_threads > 0) nt = n_threads
+
+!$OMP PARALLEL DO COLLAPSE(2) NUM_THREADS(nt) SCHEDULE(DYNAMIC, 64) &
+!$OMP PRIVATE(i, j, t, w, k, lo, hi, mid, up, dn, best_t, n_exam, &
+!$OMP         total_error, this_fit, best_fit, s, gap_up, gap_dn, gap)
+DO j = 1, y
+  DO i = 1, x
+    best_fit = 1e38 ! Arbitrarily large number
+    best_t = 1
+    n_exam = 0
+    s = 0.0d0
+    DO w = 1, n_wlens
+      s = s + images(w, i, j)
+    END DO
+    IF (s == s .AND. n_idx > 0) THEN
+      ! First key >= s
+      lo = 1
+      hi = n_idx + 1
+      DO WHILE (lo < hi)
+        mid = (lo + hi) / 2
+        IF (keys(mid) < s) THEN
+          lo = mid + 1
+        ELSE
+          hi = mid
+        END IF
+      END DO
+      up = lo
+      dn = lo - 1
+      DO
+        gap_up = HUGE(gap_up)
+        gap_dn = HUGE(gap_dn)
+        IF (up <= n_idx) gap_up = keys(up) - s
+        IF (dn >= 1) gap_dn = s - keys(dn)
+        IF (gap_up <= gap_dn) THEN
+          gap = gap_up
+          k = up
+        ELSE
+          gap = gap_dn
+          k = dn
+        END IF
+        IF (gap == HUGE(gap)) EXIT
+        IF (gap * margin > REAL(best_fit, 8) * REAL(n_wlens, 8)) EXIT
+        IF (k == up) THEN
+          up = up + 1
+        ELSE
+          dn = dn - 1
+        END IF
+        t = order(k)
+        n_exam = n_exam + 1
+        total_error = 0.0
+        DO w = 1, n_wlens
+          total_error = total_error + ABS(images(w,i,j) - model(w, t))
+        END DO
+        this_fit = total_error / REAL(n_wlens)
+        IF (this_fit < best_fit .OR. (this_fit == best_fit .AND. t < best_t)) THEN
+          best_fit = this_fit
+          best_t = t
+        END IF
+      END DO
+    END IF
+    results(i, j, 1:n_pars) = parvals(best_t, :)
+    results(i, j, n_pars+1) = best_fit
+    n_examined(i, j) = n_exam
+  END DO
+END DO
+!$OMP END PARALLEL DO
+
+END SUBROUTINE calc_fits_indexed
+
+SUBROUTINE calc_fits_warm(images, model, parvals, prev_images, prev_best, prev_fit, n_vals, n_wlens, x, y, &
+                          n_pars, nt, nw, nh, rt, rw, rh, tol, results, best, path, n_threads)
+
+! Fit a frame starting from the solution for the previous one. The model
+! table must be a regular (nt, nw, nh) grid with the last axis varying
+! fastest. prev_best holds each pixel's previous best model (0 if none),
+! prev_fit its goodness of fit and prev_images the intensities it was fitted
+! to. For each pixel:
+!   path = 1  every channel changed by at most tol (relative): keep the
+!             previous model
+!   path = 2  search only the models within (rt, rw, rh) grid steps of the
+!             previous one
+!   path = 3  as 2, but the fit got worse than before, so fall back to a
+!             full scan
+!   path = 0  no previous solution: full scan
+! best returns the best model of each pixel, for use with the next frame.
+
+!$ USE omp_lib
+IMPLICIT NONE
+INTEGER, INTENT(IN) :: n_vals, n_wlens, x, y, n_pars, nt, nw, nh, rt, rw, rh
+REAL, INTENT(IN) :: tol
+! Release the GIL so other Python threads can run during a fit
+!f2py threadsafe
+!f2py integer optional, intent(in) :: n_threads = 0
+INTEGER, INTENT(IN) :: n_threads
+REAL, DIMENSION(n_vals, n_pars), INTENT(IN) :: parvals
+REAL, DIMENSION(n_wlens, n_vals), INTENT(IN) :: model
+REAL, DIMENSION(n_wlens, x, y), INTENT(IN) :: images, prev_images
+INTEGER, DIMENSION(x, y), INTENT(IN) :: prev_best
+REAL, DIMENSION(x, y), INTENT(IN) :: prev_fit
+REAL, DIMENSION(x, y, n_pars+1), INTENT(OUT) :: results
+INTEGER, DIMENSION(x, y), INTENT(OUT) :: best, path
+INTEGER :: i, j, t, w, it, iw, ih, jt, jw, jh, pb, best_t, nt_omp
+LOGICAL :: changed
+REAL :: total_error, this_fit, best_fit
+
+nt_omp = 1
+!$ nt_omp = omp_get_max_threads()
+IF (n_threads > 0) nt_omp = n_threads
+
+!$OMP PARALLEL DO COLLAPSE(2) NUM_THREADS(nt_omp) SCHEDULE(DYNAMIC, 64) &
+!$OMP PRIVATE(i, j, t, w, it, iw, ih, jt, jw, jh, pb, best_t, changed, &
+!$OMP         total_error, this_fit, best_fit)
+DO j = 1, y
+  DO i = 1, x
+    best_fit = 1e38 ! Arbitrarily large number
+    best_t = 1
+    pb = prev_best(i, j)
+    path(i, j) = 0
+    IF (pb >= 1 .AND. pb <= n_vals) THEN
+      changed = .FALSE.
+      DO w = 1, n_wlens
+        IF (.NOT. (ABS(images(w,i,j) - prev_images(w,i,j)) <= tol * ABS(prev_images(w,i,j)))) THEN
+          changed = .TRUE.
+        END IF
+      END DO
+      IF (.NOT. changed) THEN
+        path(i, j) = 1
+        best_t = pb
+        total_error = 0.0
+        DO w = 1, n_wlens
+          total_error = total_error + ABS(images(w,i,j) - model(w, pb))
+        END DO
+        best_fit = total_error / REAL(n_wlens)
+      ELSE
+        path(i, j) = 2
+        ih = MOD(pb - 1, nh)
+        iw = MOD((pb - 1) / nh, nw)
+        it = (pb - 1) / (nh * nw)
+        ! Visit the neighbourhood in increasing model order so that ties go
+        ! to the lowest model number, as in the full scan
+        DO jt = MAX(it - rt, 0), MIN(it + rt, nt - 1)
+          DO jw = MAX(iw - rw, 0), MIN(iw + rw, nw - 1)
+            DO jh = MAX(ih - rh, 0), MIN(ih + rh, nh - 1)
+              t = (jt * nw + jw) * nh + jh + 1
+              total_error = 0.0
+              DO w = 1, n_wlens
+                total_error = total_error + ABS(images(w,i,j) - model(w, t))
+              END DO
+              this_fit = total_error / REAL(n_wlens)
+              IF (this_fit < best_fit) THEN
+                best_fit = this_fit
+                best_t = t
+              END IF
+            END DO
+          END DO
+        END DO
+        IF (best_fit > prev_fit(i, j)) path(i, j) = 3
+      END IF
+    END IF
+    IF (path(i, j) == 0 .OR. path(i, j) == 3) THEN
+      best_fit = 1e38
+      best_t = 1
+      DO t = 1, n_vals
+        total_error = 0.0
+        DO w = 1, n_wlens
+          total_error = total_error + ABS(images(w,i,j) - model(w, t))
+        END DO
+        this_fit = total_error / REAL(n_wlens)
+        IF (this_fit < best_fit) THEN
+          best_fit = this_fit
+          best_t = t
+        END IF
+      END DO
+    END IF
+    results(i, j, 1:n_pars) = parvals(best_t, :)
+    results(i, j, n_pars+1) = best_fit
+    best(i, j) = best_t
+  END DO
+END DO
+!$OMP END PARALLEL DO
+
+END SUBROUTINE calc_fits_warm
+
+SUBROUTINE calc_fits_summary(images, model, parvals, t_bin, w_bin, t_values, w_values, n_vals, n_wlens, x, y, &
+                             n_pars, n_t, n_w, k, n_mt, n_mw, delta, accept, results, top_models, top_fits, &
+                             marg_t, marg_w, stats, n_threads)
+
+! Full scan of the model table, as calc_fits, which also summarises the
+! misfit landscape of each pixel in the same pass instead of storing it.
+! t_bin and w_bin give the (1-based) temperature and width node of each
+! model, whose values are t_values and w_values. For each pixel:
+!   top_models, top_fits  the k best models (1-based) and their misfits,
+!                         best first; ties go to the lowest model number
+!   marg_t, marg_w        marginal distributions over temperature and
+!                         width, weighting each model by
+!                         EXP(-(fit - best_fit) / (delta * MEAN(ABS(images))))
+!                         and summing over the other parameters. They are
+!                         only returned if n_mt = n_t and n_mw = n_w (pass 1
+!                         otherwise); their means and standard deviations
+!                         are always in stats(:, :, 1:4).
+!   stats(:, :, 5:8)      lowest and highest temperature and width of any
+!                         model with fit <= best_fit * (1 + accept)
+! The weights are accumulated relative to the best fit so far, rescaling
+! the sums whenever it improves, so they cannot overflow.
+
+!$ USE omp_lib
+IMPLICIT NONE
+INTEGER, INTENT(IN) :: n_vals, n_wlens, x, y, n_pars, n_t, n_w, k, n_mt, n_mw
+REAL, INTENT(IN) :: delta, accept
+! Release the GIL so other Python threads can run during a fit
+!f2py threadsafe
+!f2py integer optional, intent(in) :: n_threads = 0
+INTEGER, INTENT(IN) :: n_threads
+REAL, DIMENSION(n_vals, n_pars), INTENT(IN) :: parvals
+REAL, DIMENSION(n_wlens, n_vals), INTENT(IN) :: model
+INTEGER, DIMENSION(n_vals), INTENT(IN) :: t_bin, w_bin
+REAL, DIMENSION(n_t), INTENT(IN) :: t_values
+REAL, DIMENSION(n_w), INTENT(IN) :: w_values
+REAL, DIMENSION(n_wlens, x, y), INTENT(IN) :: images
+REAL, DIMENSION(x, y, n_pars+1), INTENT(OUT) :: results
+INTEGER, DIMENSION(x, y, k), INTENT(OUT) :: top_models
+REAL, DIMENSION(x, y, k), INTENT(OUT) :: top_fits
+REAL, DIMENSION(x, y, n_mt), INTENT(OUT) :: marg_t
+REAL, DIMENSION(x, y, n_mw), INTENT(OUT) :: marg_w
+REAL, DIMENSION(x, y, 8), INTENT(OUT) :: stats
+REAL(8), DIMENSION(n_t) :: acc_t
+REAL(8), DIMENSION(n_w) :: acc_w
+REAL, DIMENSION(n_t) :: prof_t
+REAL, DIMENSION(n_w) :: prof_w
+REAL, DIMENSION(k) :: kf
+INTEGER, DIMENSION(k) :: kt
+INTEGER :: i, j, t, w, m, nt
+REAL :: total_error, this_fit, best_fit, scale, limit, lo, hi
+REAL(8) :: wt, total, mean, var
+
+nt = 1
+!$ nt = omp_get_max_threads()
+IF (n_threads > 0) nt = n_threads
+
+!$OMP PARALLEL DO COLLAPSE(2) NUM_THREADS(nt) SCHEDULE(DYNAMIC, 64) &
+!$OMP PRIVATE(i, j, t, w, m, total_error, this_fit, best_fit, scale, limit, &
+!$OMP         lo, hi, wt, total, mean, var, acc_t, acc_w, prof_t, prof_w, kf, kt)
+DO j = 1, y
+  DO i = 1, x
+    best_fit = 1e38 ! Arbitrarily large number
+    kf = 1e38
+    kt = 1
+    acc_t = 0.0d0
+    acc_w = 0.0d0
+    prof_t = 1e38
+    prof_w = 1e38
+    scale = 0.0
+    DO w = 1, n_wlens
+      scale = scale + ABS(images(w,i,j))
+    END DO
+    scale = MAX(delta * scale / REAL(n_wlens), TINY(scale))
+    DO t = 1, n_vals
+      total_error = 0.0
+      DO w = 1, n_wlens
+        total_error = total_error + ABS(images(w,i,j) - model(w, t))
+      END DO
+      this_fit = total_error / REAL(n_wlens)
+      IF (.NOT. this_fit < 1e38) CYCLE
+      IF (this_fit < best_fit) THEN
+        ! Rescale the weights so far to the new best fit
+        wt = EXP(-REAL(best_fit - this_fit, 8) / scale)
+        acc_t = acc_t * wt
+        acc_w = acc_w * wt
+        best_fit = this_fit
+      END IF
+      wt = EXP(-REAL(this_fit - best_fit, 8) / scale)
+      acc_t(t_bin(t)) = acc_t(t_bin(t)) + wt
+      acc_w(w_bin(t)) = acc_w(w_bin(t)) + wt
+      prof_t(t_bin(t)) = MIN(prof_t(t_bin(t)), this_fit)
+      prof_w(w_bin(t)) = MIN(prof_w(w_bin(t)), this_fit)
+      IF (this_fit < kf(k)) THEN
+        m = k
+        DO WHILE (m > 1)
+          IF (.NOT. this_fit < kf(m-1)) EXIT
+          kf(m) = kf(m-1)
+          kt(m) = kt(m-1)
+          m = m - 1
+        END DO
+        kf(m) = this_fit
+        kt(m) = t
+      END IF
+    END DO
+    results(i, j, 1:n_pars) = parvals(kt(1), :)
+    results(i, j, n_pars+1) = kf(1)
+    top_models(i, j, :) = kt
+    top_fits(i, j, :) = kf
+
+    total = SUM(acc_t)
+    IF (total > 0.0d0) THEN
+      acc_t = acc_t / total
+      acc_w = acc_w / total
+    END IF
+    IF (n_mt == n_t) marg_t(i, j, :) = REAL(acc_t)
+    IF (n_mw == n_w) marg_w(i, j, :) = REAL(acc_w)
+    mean = SUM(acc_t * t_values)
+    var = SUM(acc_t * (t_values - mean) ** 2)
+    stats(i, j, 1) = REAL(mean)
+    stats(i, j, 2) = REAL(SQRT(var))
+    mean = SUM(acc_w * w_values)
+    var = SUM(acc_w * (w_values - mean) ** 2)
+    stats(i, j, 3) = REAL(mean)
+    stats(i, j, 4) = REAL(SQRT(var))
+
+    ! Range of the nodes whose best model is acceptable
+    limit = best_fit * (1.0 + accept)
+    lo = 1e38
+    hi = -1e38
+    DO m = 1, n_t
+      IF (prof_t(m) <= limit) THEN
+        lo = MIN(lo, t_values(m))
+        hi = MAX(hi, t_values(m))
+      END IF
+    END DO
+    stats(i, j, 5) = lo
+    stats(i, j, 6) = hi
+    lo = 1e38
+    hi = -1e38
+    DO m = 1, n_w
+      IF (prof_w(m) <= limit) THEN
+        lo = MIN(lo, w_values(m))
+        hi = MAX(hi, w_values(m))
+      END IF
+    END DO
+    stats(i, j, 7) = lo
+    stats(i, j, 8) = hi
+  END DO
+END DO
+!$OMP END PARALLEL DO
+
+END SUBROUTINE calc_fits_summary
@@ -0,0 +1,644 @@
+# -*- coding: utf-8 -*-
+"""
+Python-side helpers for the compiled fitting kernels in the fits extension.
+"""
+
+import numpy as np
+try:
+    from fits import calc_fits, calc_fits_em, calc_fits_indexed, \
+        calc_fits_warm, calc_fits_summary
+except ImportError:
+    raise ImportError('Fortran extension is missing or incompatible. Build it '
+                      'with "python setup.py build_ext --inplace" in the '
+                      'CoronaTemps directory.')
+
+
+def build_model_index(model):
+    """
+    Build the search index used by calc_fits_indexed for a model table.
+
+    Parameters
+    ----------
+    model : numpy.ndarray
+        Synthetic emission table of shape (n_vals, n_wlens).
+
+    Returns
+    -------
+    keys : numpy.ndarray
+        Sum over channels of each model, sorted in ascending order.
+    order : numpy.ndarray
+        The (1-based) row of the model table each key belongs to. Rows with
+        non-finite values can never be the best fit and are left out.
+    """
+    keys = np.sum(model, axis=1, dtype=np.float64)
+    rows = np.where(np.isfinite(keys))[0]
+    order = rows[np.argsort(keys[rows], kind='mergesort')]
+    return keys[order], (order + 1).astype(np.int32)
+
+
+def fit_indexed(images, model, parvals, index=None, n_threads=0):
+    """
+    Find the best-fitting model for each pixel using a sorted model index.
+
+    Gives exactly the same results as calc_fits, but only examines models
+    whose summed emission is within the best misfit found so far of the
+    pixel's summed intensity.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        Intensities of shape (n_wlens, x, y).
+    model : numpy.ndarray
+        Synthetic emission table of shape (n_vals, n_wlens).
+    parvals : numpy.ndarray
+        Parameter values of each model, shape (n_vals, n_pars) or (n_vals,).
+    index : tuple, optional
+        Output of build_model_index(model). Built if not given; pass it in
+        to reuse one index for several images.
+    n_threads : int
+        Number of OpenMP threads. The default uses all available cores.
+
+    Returns
+    -------
+    results : numpy.ndarray
+        Best-fit parameters and goodness of fit, shape (x, y, n_pars+1).
+    n_examined : numpy.ndarray
+        Number of models examined for each pixel, shape (x, y).
+    """
+    if index is None:
+        index = build_model_index(model)
+    keys, order = index
+    if parvals.ndim == 1:
+        parvals = parvals.reshape((-1, 1))
+    return calc_fits_indexed(images, model.T, parvals, keys, order,
+                             n_threads=n_threads)
+
+
+def fit_images(images, model, parvals, n_params, solve_em=False,
+               search='scan', index=None, n_threads=0):
+    """
+    Fit every pixel of an image block of shape (n_wlens, x, y) against the
+    model table with the selected kernel.
+
+    Returns the fit results, shape (x, y, n_params+1), with any emission
+    measures converted to log scale, and the number of models examined per
+    pixel (None unless search='index').
+    """
+    n_wlens, x, y = images.shape
+    n_vals = model.shape[0]
+    n_examined = None
+    if n_params == 1:
+        parvals = parvals[:, 0]
+    if solve_em:
+        temps = calc_fits_em(images, model.T, parvals[:, :2], n_vals, n_wlens,
+                             x, y, 2, n_threads)
+    elif search == 'index':
+        temps, n_examined = fit_indexed(images, model, parvals, index,
+                                        n_threads)
+    else:
+        temps = calc_fits(images, model.T, parvals, n_vals, n_wlens, x, y,
+                          n_params, n_threads)
+    # Convert EM values to log scale if there are any
+    if temps.shape[2] > 2: temps[..., 2] = np.log10(temps[..., 2])
+    return temps, n_examined
+
+
+# Planes of the stats returned by calc_fits_summary
+summary_stats = ['t_mean', 't_std', 'width_mean', 'width_std', 't_low',
+                 't_high', 'width_low', 'width_high']
+
+
+def fit_summary(images, model, parvals, n_params, k=5, delta=0.1,
+                accept=0.1, marginals=False, n_threads=0):
+    """
+    Fit every pixel of an image block by a full scan of the model table and
+    summarise how well constrained each fit is, at about the cost of the
+    fit itself.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        Intensities of shape (n_wlens, x, y).
+    model : numpy.ndarray
+        Synthetic emission table of shape (n_vals, n_wlens).
+    parvals : numpy.ndarray
+        Parameters of each model, shape (n_vals, 3), from
+        create_tempmap.parameter_grid.
+    n_params : 1 or 3
+        Number of parameters fitted.
+    k : int
+        Number of best models to keep for each pixel.
+    delta : float
+        Misfit, relative to the pixel's mean intensity, over which a model's
+        weight in the marginal distributions falls by a factor of e.
+    accept : float
+        Models within this fraction of the best misfit count as acceptable
+        solutions.
+    marginals : bool
+        Also return the marginal distributions over temperature and width
+        themselves, rather than just their moments.
+    n_threads : int
+        Number of OpenMP threads. The default uses all available cores.
+
+    Returns
+    -------
+    results : numpy.ndarray
+        Best-fit parameters and goodness of fit, shape (x, y, n_params+1),
+        with any emission measures converted to log scale; the same as
+        fit_images.
+    summary : dict
+        Arrays of shape (x, y) named as in summary_stats: the mean and
+        standard deviation of the temperature and width distributions, and
+        the range of temperatures and widths of the acceptable solutions.
+        Also 'top_models' (0-based rows of the model table) and 'top_fits',
+        of shape (x, y, k), and if marginals is set 'marginal_t' and
+        'marginal_width', of shape (x, y, n_temps) and (x, y, n_widths).
+    """
+    n_wlens, x, y = images.shape
+    t_values, t_bin = np.unique(parvals[:, 0], return_inverse=True)
+    w_values, w_bin = np.unique(parvals[:, 1], return_inverse=True)
+    pars = parvals[:, :1] if n_params == 1 else parvals
+    results, top_models, top_fits, marg_t, marg_w, stats = calc_fits_summary(
+        images, model.T, pars, (t_bin + 1).astype(np.int32),
+        (w_bin + 1).astype(np.int32), t_values, w_values, k,
+        len(t_values) if marginals else 1, len(w_values) if marginals else 1,
+        delta, accept, n_threads=n_threads)
+    if results.shape[2] > 2: results[..., 2] = np.log10(results[..., 2])
+    summary = dict((name, stats[..., i])
+                   for i, name in enumerate(summary_stats))
+    summary['top_models'] = top_models - 1
+    summary['top_fits'] = top_fits
+    if marginals:
+        summary['marginal_t'] = marg_t
+        summary['marginal_width'] = marg_w
+    return results, summary
+
+
+def grid_index(values, axes):
+    """
+    Find the nearest node of a regular parameter grid to sets of parameter
+    values.
+
+    Parameters
+    ----------
+    values : list of numpy.ndarray
+        Values of each parameter, all of the same shape.
+    axes : list of array-like
+        Sorted node values along each axis of the grid, in the order of
+        parvals from create_tempmap.parameter_grid.
+
+    Returns
+    -------
+    index : numpy.ndarray
+        1-based number of the nearest model, or 0 where any value is not
+        finite.
+    """
+    index = np.zeros(np.shape(values[0]), dtype=np.int64)
+    finite = np.ones(index.shape, dtype=bool)
+    for value, axis in zip(values, axes):
+        axis = np.asarray(axis, dtype='float64')
+        value = np.asarray(value, dtype='float64')
+        finite &= np.isfinite(value)
+        value = np.where(finite, value, axis[0])
+        k = np.clip(np.searchsorted(axis, value), 1, max(len(axis) - 1, 1))
+        if len(axis) > 1:
+            k -= (value - axis[k-1]) < (axis[k] - value)
+        else:
+            k[:] = 0
+        index = index * len(axis) + k
+    return np.where(finite, index + 1, 0).astype(np.int32)
+
+
+def refine_fits(images, model, results, axes, n_params, t_range=0.1,
+                levels=5, chunk_size=4096):
+    """
+    Estimate each pixel's best-fit parameters between the nodes of a regular
+    model grid by a bounded search around its best node.
+
+    The emission of the models is interpolated linearly between the nodes,
+    so that the misfit can be found for any temperature and, with three
+    parameters, DEM width. With three parameters the best emission measure
+    for each is found exactly, as the weighted median used by calc_fits_em,
+    rather than from the height axis. Temperature and width are searched
+    together, as an error in one shifts the best value of the other by
+    several nodes: first over the nodes within t_range of the best node in
+    log(T), for widths in quarter-node steps up to one node either side of
+    it, then by steps of half a node, halved levels times, to whichever
+    neighbouring point fits better.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        Intensities of shape (n_wlens, x, y) the results were fitted to.
+    model : numpy.ndarray
+        Synthetic emission table of shape (n_vals, n_wlens).
+    results : numpy.ndarray
+        Fit results from fit_images (or fit_pool), shape (x, y,
+        n_params+1), with emission measures in log scale.
+    axes : list
+        Temperature, width and height axes of the model grid, as returned
+        by create_tempmap.parameter_grid.
+    n_params : 1 or 3
+        Number of parameters fitted.
+    t_range : float
+        Range in log(T) either side of the best node searched at first when
+        there is more than one width. Otherwise, and at least, one node
+        either side is searched.
+    levels : int
+        Number of halvings of the step, which sets the resolution of the
+        estimates to 2**-levels of the node spacing.
+    chunk_size : int
+        Number of pixels refined at once, to limit temporary memory use.
+
+    Returns
+    -------
+    refined : numpy.ndarray
+        Copy of results with continuous estimates of the parameters, the
+        emission measure in log scale, and the goodness of fit of the
+        refined parameters. Pixels for which no better fit is found keep
+        their node values.
+    """
+    n_wlens = images.shape[0]
+    temp = np.asarray(axes[0], dtype='float64')
+    n_t = len(temp)
+    if n_params == 1:
+        widths, heights = np.zeros(1), np.ones(1)
+    else:
+        widths = np.asarray(axes[1], dtype='float64')
+        heights = np.asarray(axes[2], dtype='float64')
+    if len(model) != n_t * len(widths) * len(heights):
+        raise ValueError('Refinement needs a grid with every combination of '
+                         'its axes')
+    # Emission of each DEM shape per unit height, from the models of one
+    # height (a height of 1 may be peak-normalised rather than scaled)
+    k = int(np.argmax(heights != 1.0)) if n_params != 1 else 0
+    emission = model.reshape((n_t, len(widths), len(heights), n_wlens))
+    emission = emission[:, :, k].astype('float64') / heights[k]
+    n_w = len(widths)
+    # Without widths to trade off against, the best temperature is already
+    # within a node of the best node
+    reach = 0
+    if n_t > 1:
+        reach = 1
+    if n_t > 1 and n_w > 1:
+        reach = max(int(np.ceil(t_range / np.median(np.diff(temp)) - 1e-6)),
+                    1)
+    # Offsets in width searched first, and around each point later
+    w_start = np.linspace(-1, 1, 9) if n_w > 1 else [0]
+    w_sides = [-1, 0, 1] if n_w > 1 else [0]
+    refined = np.array(results, dtype='float32')
+    flat = refined.reshape((-1, refined.shape[2]))
+    pixels = images.reshape((n_wlens, -1))
+
+    def interpolate(table, pos):
+        lower = np.clip(np.floor(pos).astype(np.int64), 0,
+                        max(len(table) - 2, 0))
+        upper = np.minimum(lower + 1, len(table) - 1)
+        frac = (pos - lower)[:, np.newaxis]
+        return lower, upper, frac
+
+    def misfit(t_pos, w_pos, data):
+        """Misfit and emission measure at fractional node positions."""
+        t0, t1, a = interpolate(temp, t_pos)
+        w0, w1, b = interpolate(widths, w_pos)
+        predicted = (1 - a) * ((1 - b) * emission[t0, w0] +
+                               b * emission[t0, w1]) + \
+            a * ((1 - b) * emission[t1, w0] + b * emission[t1, w1])
+        if n_params == 1:
+            return np.mean(np.abs(data - predicted), axis=1), None
+        # Weighted median of the ratios, over the channels with emission
+        weight = np.where(predicted > 0, predicted, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(weight > 0, data / predicted, np.inf)
+        order = np.argsort(ratio, axis=1)
+        ratio = np.take_along_axis(ratio, order, axis=1)
+        cumul = np.cumsum(np.take_along_axis(weight, order, axis=1), axis=1)
+        median = np.argmax(2.0 * cumul >= cumul[:, -1:], axis=1)
+        em = np.maximum(ratio[np.arange(len(median)), median], 0.0)
+        with np.errstate(invalid='ignore'):
+            fit = np.mean(np.abs(data - em[:, np.newaxis] * predicted),
+                          axis=1)
+        return fit, em
+
+    for start in range(0, len(flat), chunk_size):
+        chunk = flat[start:start+chunk_size]
+        data = pixels[:, start:start+chunk_size].T.astype('float64')
+        t_node = grid_index([chunk[:, 0]], [temp]).astype(np.int64) - 1
+        fitted = t_node >= 0
+        if n_params == 1:
+            w_node = np.zeros(len(chunk), dtype=np.int64)
+        else:
+            w_node = grid_index([chunk[:, 1]], [widths]).astype(np.int64) - 1
+            fitted &= w_node >= 0
+        best = np.full(len(chunk), np.inf)
+        best_t = np.where(fitted, t_node, 0).astype('float64')
+        best_w = np.where(fitted, w_node, 0).astype('float64')
+        best_em = np.zeros(len(chunk))
+
+        def search(t_pos, w_pos):
+            t_pos = np.clip(t_pos, 0, n_t - 1)
+            w_pos = np.clip(w_pos, 0, n_w - 1)
+            fit, em = misfit(t_pos, w_pos, data)
+            better = fit < best
+            best[better] = fit[better]
+            best_t[better] = t_pos[better]
+            best_w[better] = w_pos[better]
+            if em is not None:
+                best_em[better] = em[better]
+
+        centre_t, centre_w = best_t.copy(), best_w.copy()
+        for dt in range(-reach, reach + 1):
+            for dw in w_start:
+                search(centre_t + dt, centre_w + dw)
+        step = 0.5
+        for level in range(levels):
+            centre_t, centre_w = best_t.copy(), best_w.copy()
+            for dt in [-step, 0, step]:
+                for dw in [step * d for d in w_sides]:
+                    if dt or dw:
+                        search(centre_t + dt, centre_w + dw)
+            step /= 2.0
+        ok = fitted & np.isfinite(best)
+        if n_params != 1:
+            ok &= best_em > 0
+            chunk[ok, 1] = np.interp(best_w, np.arange(n_w), widths)[ok]
+            chunk[ok, 2] = np.log10(best_em[ok])
+        chunk[ok, 0] = np.interp(best_t, np.arange(n_t), temp)[ok]
+        chunk[ok, -1] = best[ok]
+    return refined
+
+
+def quantise_pixels(images, resolution=0.01):
+    """
+    Group the pixels whose intensities agree to within a relative
+    resolution.
+
+    Every intensity is rounded to the nearest of a set of levels spaced
+    evenly in log scale, a factor (1 + resolution) apart, and pixels with
+    the same levels in every channel form a group. Pixels with an intensity
+    that is not positive and finite are not quantised; each is a group of
+    its own.
+
+    Returns
+    -------
+    levels : numpy.ndarray
+        Mean intensities of the pixels of each group, shape (n_wlens, 1,
+        n_groups). These are closer to the pixels than the levels they were
+        rounded to, so fit them better.
+    groups : numpy.ndarray
+        Group of each pixel, in the order of images.reshape((n_wlens, -1)).
+    """
+    n_wlens = images.shape[0]
+    pixels = images.reshape((n_wlens, -1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.log(pixels.astype('float64'))
+    ok = np.all(np.isfinite(logs), axis=0)
+    step = np.log1p(resolution)
+    codes = np.round(logs[:, ok] / step).astype(np.int64)
+    if codes.size:
+        lowest = codes.min(axis=1)
+        spans = codes.max(axis=1) - lowest + 1
+    else:
+        lowest = spans = np.ones(n_wlens, dtype=np.int64)
+    if np.prod(spans.astype('float64')) < 2.0**62:
+        # Sorting one key per pixel is much quicker than sorting rows
+        key = np.zeros(codes.shape[1], dtype=np.int64)
+        for code, low, span in zip(codes, lowest, spans):
+            key = key * span + (code - low)
+        inverse = np.unique(key, return_inverse=True)[1]
+    else:
+        inverse = np.unique(codes.T, axis=0, return_inverse=True)[1]
+    n_groups = inverse.max() + 1 if inverse.size else 0
+    groups = np.empty(pixels.shape[1], dtype=np.int64)
+    groups[ok] = inverse
+    groups[~ok] = n_groups + np.arange(np.sum(~ok))
+    counts = np.bincount(groups)
+    levels = np.array([np.bincount(groups, channel) for channel in pixels])
+    levels /= counts
+    return levels.astype('float32').reshape((n_wlens, 1, -1)), groups
+
+
+def nearest_rows(values, column):
+    """Row of column (e.g. parvals[:, 0]) nearest to each of values."""
+    order = np.argsort(column, kind='mergesort')
+    column = column[order]
+    pos = np.clip(np.searchsorted(column, values), 1, max(len(column) - 1, 1))
+    pos -= (values - column[pos - 1]) < (column[pos] - values)
+    return order[pos]
+
+
+def fit_quantised(images, model, parvals, resolution=0.01, fit=None,
+                  check=1000, seed=0, chunk_size=65536):
+    """
+    One-parameter fit of an image block that fits each group of pixels
+    with the same quantised intensities (see quantise_pixels) once.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        Intensities normalised to the 171 channel, shape (n_wlens, x, y).
+    model, parvals :
+        Model table and parameters of a one-parameter grid, as for
+        fit_images.
+    resolution : float
+        Relative resolution of the quantisation.
+    fit : callable, optional
+        Function fitting a block of intensities and returning the results and
+        the numbers of models examined, as fit_images does (the default, with
+        a full scan). Pass e.g. a call to pool.fit_pool to fit the groups
+        with a pool of workers.
+    check : int
+        Number of pixels, chosen at random, to also fit without quantisation
+        to measure the error it introduces.
+    chunk_size : int
+        Number of pixels whose goodness of fit is calculated at once.
+
+    Returns
+    -------
+    results : numpy.ndarray
+        Fit results of shape (x, y, 2). Each pixel gets the temperature found
+        for its group and the goodness of fit of that model to the pixel's
+        own intensities.
+    n_examined : numpy.ndarray or None
+        Number of models examined for each group, as returned by fit.
+    stats : dict
+        Numbers of pixels ('n_pixels'), groups fitted ('n_groups') and
+        pixels checked ('n_checked'), and for the checked pixels the largest
+        differences from the unquantised fit in log(T) ('max_t_error') and
+        goodness of fit ('max_fit_error'), and the fraction given a different
+        temperature ('t_changed').
+    """
+    n_wlens, x, y = images.shape
+    if fit is None:
+        fit = lambda block: fit_images(block, model, parvals, 1)
+    levels, groups = quantise_pixels(images, resolution)
+    fitted, n_examined = fit(levels)
+    results = fitted[0, groups]
+    pixels = images.reshape((n_wlens, -1))
+    rows = nearest_rows(fitted[0, :, 0], parvals[:, 0])[groups]
+    for start in range(0, len(groups), chunk_size):
+        stop = start + chunk_size
+        results[start:stop, 1] = np.mean(
+            np.abs(pixels[:, start:stop].T - model[rows[start:stop]]),
+            axis=1, dtype='float64')
+
+    stats = {'n_pixels': len(groups), 'n_groups': levels.shape[2],
+             'n_checked': 0, 'max_t_error': 0.0, 'max_fit_error': 0.0,
+             't_changed': 0.0}
+    if check and len(groups):
+        sample = np.random.RandomState(seed).permutation(len(groups))[:check]
+        exact = fit(pixels[:, sample].reshape((n_wlens, 1, -1)))[0][0]
+        error = np.abs(results[sample] - exact)
+        stats.update({'n_checked': len(sample),
+                      'max_t_error': float(error[:, 0].max()),
+                      'max_fit_error': float(error[:, 1].max()),
+                      't_changed': float(np.mean(error[:, 0] > 0))})
+    return results.reshape((x, y, 2)), n_examined, stats
+
+
+def merge_quantise_stats(stats):
+    """
+    Combine the stats of several calls of fit_quantised (e.g. for each tile
+    or process), adding the overall ratio of pixels to groups ('ratio').
+    """
+    merged = {}
+    for name in ['n_pixels', 'n_groups', 'n_checked']:
+        merged[name] = sum(s[name] for s in stats)
+    for name in ['max_t_error', 'max_fit_error']:
+        merged[name] = max([s[name] for s in stats] or [0.0])
+    merged['t_changed'] = sum(s['t_changed'] * s['n_checked']
+                              for s in stats) / max(merged['n_checked'], 1)
+    merged['ratio'] = merged['n_pixels'] / float(max(merged['n_groups'], 1))
+    return merged
+
+
+def warm_start_from_map(tmap, images, axes):
+    """
+    Set up a warm start from a TemperatureMap and the images it was fitted
+    to, for use as the previous argument of fit_warm.
+
+    Parameters
+    ----------
+    tmap : temperature.TemperatureMap
+        Map for the previous frame.
+    images : numpy.ndarray
+        Intensities the map was fitted to, shape (n_wlens, ny, nx).
+    axes : list
+        Temperature, width and height axes of the model grid.
+
+    Returns
+    -------
+    previous : tuple
+        Previous intensities, best model and goodness of fit for every pixel
+        of the frame.
+    """
+    if tmap.n_params == 1:
+        values = [tmap.data, np.zeros(tmap.shape) + axes[1][0],
+                  np.zeros(tmap.shape) + axes[2][0]]
+        axes = [axes[0], axes[1][:1], axes[2][:1]]
+    else:
+        # Emission measures are stored in log scale
+        values = [tmap.data, tmap.dem_width, tmap.emission_measure]
+        axes = [axes[0], axes[1], np.log10(axes[2])]
+    best = grid_index(values, axes)
+    return (np.asarray(images, dtype='float32'), best,
+            np.asarray(tmap.goodness_of_fit, dtype='float32'))
+
+
+def fit_warm(images, model, parvals, grid_shape, previous=None, tol=0.01,
+             radius=(5, 1, 5), n_threads=0):
+    """
+    Fit an image block starting from the solution for the previous frame.
+
+    Pixels whose intensities changed by at most tol (relative) in every
+    channel keep their previous model. Other pixels search only the models
+    within radius grid steps of their previous one, and fall back to a full
+    scan if their fit is worse than before.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        Intensities of shape (n_wlens, x, y).
+    model, parvals :
+        Model table and parameters, as for calc_fits.
+    grid_shape : tuple
+        Number of temperatures, widths and heights in the model grid.
+    previous : tuple, optional
+        Previous intensities, best model and goodness of fit for the same
+        pixels, with shapes (n_wlens, x, y), (x, y) and (x, y). Without it
+        every pixel is fitted by a full scan.
+    tol : float
+        Largest relative change in any channel for a pixel to keep its
+        previous solution.
+    radius : tuple
+        Size of the neighbourhood searched, in grid steps along each axis.
+    n_threads : int
+        Number of OpenMP threads. The default uses all available cores.
+
+    Returns
+    -------
+    results : numpy.ndarray
+        Best-fit parameters and goodness of fit, shape (x, y, n_pars+1),
+        with any emission measures converted to log scale.
+    current : tuple
+        Intensities, best model and goodness of fit for each pixel, to pass
+        as previous when fitting the next frame.
+    path : numpy.ndarray
+        How each pixel was fitted (see path_counts).
+    """
+    n_wlens, x, y = images.shape
+    if parvals.ndim == 1:
+        parvals = parvals.reshape((-1, 1))
+    if previous is None:
+        previous = (images, np.zeros((x, y), dtype=np.int32),
+                    np.zeros((x, y), dtype='float32'))
+    prev_images, prev_best, prev_fit = previous
+    nt, nw, nh = grid_shape
+    rt, rw, rh = radius
+    results, best, path = calc_fits_warm(images, model.T, parvals,
+                                         prev_images, prev_best, prev_fit,
+                                         nt, nw, nh, rt, rw, rh, tol,
+                                         n_threads=n_threads)
+    current = (images, best, results[..., -1].copy())
+    if results.shape[2] > 2: results[..., 2] = np.log10(results[..., 2])
+    return results, current, path
+
+
+def pack_previous(previous, mask):
+    """
+    Select the warm-start state of the pixels in mask from full-frame state
+    (as returned by warm_start_from_map or unpack_previous), in the packed
+    layout of create_tempmap.prepare_images. Returns None if the frames are
+    of different shapes.
+    """
+    if previous is None or previous[1].shape != mask.shape:
+        return None
+    images, best, fit = previous
+    return (images[:, mask].reshape((images.shape[0], 1, -1)),
+            best[mask].reshape((1, -1)), fit[mask].reshape((1, -1)))
+
+
+def unpack_previous(current, mask):
+    """
+    Expand the warm-start state of a packed list of pixels, as returned by
+    fit_warm, to full frames. Pixels outside mask have no previous solution.
+    """
+    images, best, fit = current
+    full_images = np.zeros((images.shape[0],) + mask.shape, dtype='float32')
+    full_images[:, mask] = images[:, 0, :]
+    full_best = np.zeros(mask.shape, dtype=np.int32)
+    full_best[mask] = best[0]
+    full_fit = np.zeros(mask.shape, dtype='float32')
+    full_fit[mask] = fit[0]
+    return full_images, full_best, full_fit
+
+
+def path_counts(path):
+    """
+    Count how many pixels took each path through fit_warm: kept their
+    previous solution, were fitted from a neighbourhood search, fell back to
+    a full scan, or had no previous solution.
+    """
+    counts = np.bincount(np.ravel(path), minlength=4)
+    return {'kept': counts[1], 'neighbourhood': counts[2],
+            'fallback': counts[3], 'full': counts[0]}
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive model grids.
+
+The default grid of create_tempmap.parameter_grid spaces temperatures
+uniformly, although the AIA responses change much faster at some
+temperatures than at others. Many of its models therefore have nearly the
+same emission as their neighbours, yet every one of them costs the same
+time in the fit of every pixel. make_grid builds a smaller grid instead:
+
+    - temperatures are placed in proportion to how fast the emission of the
+      model DEMs changes with temperature (adaptive_temperatures), and
+    - models whose emission is within a tolerance of the last model kept at
+      a lower temperature (with the same width and height) are dropped
+      (prune_models).
+
+Grids are saved to .npz files with save_grid and passed to create_tempmap
+(or TemperatureMap, create_tempmap_tiled and validation.validate) as grid=.
+The synthetic emission table for a grid is cached like any other, keyed on
+its parameters.
+
+Usage:
+
+    python grids.py <n_params> <grid.npz> [<options>]
+
+where options is a dict of keyword arguments to make_grid.
+"""
+
+import numpy as np
+from sys import argv
+from itertools import product
+from utils import emission_table
+
+# Bump when the layout of saved grids changes
+GRID_FORMAT = 1
+
+
+def temperature_sensitivity(resp, n_params, widths=(0.1,), t_min=5.6,
+                            t_max=7.0, step=0.001):
+    """
+    How fast the emission of Gaussian DEMs changes with their mean
+    temperature.
+
+    Parameters
+    ----------
+    resp : numpy.ndarray
+        Temperature responses the model table is built from (see
+        create_tempmap.model_responses).
+    n_params : 1 or 3
+        With one parameter the emission is normalised to the 171 channel,
+        as in the model table.
+    widths : list
+        DEM widths to average the sensitivity over.
+    t_min, t_max, step : float
+        Range and spacing in log(T) of the temperatures to evaluate.
+
+    Returns
+    -------
+    logt, sensitivity : numpy.ndarray
+        Temperatures, and the absolute rate of change of the logarithm of
+        the emission with log(T) at each, averaged over channels and widths.
+    """
+    logt = np.arange(t_min, t_max + step / 2.0, step)
+    parvals = np.array([i for i in product(logt, widths, [1.0])])
+    emission = emission_table(parvals, resp).reshape(
+        (len(logt), len(widths), resp.shape[0]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if n_params == 1:
+            emission /= emission[..., 2:3]
+        slope = np.abs(np.gradient(np.log(emission), step, axis=0))
+    slope[~np.isfinite(slope)] = 0
+    return logt, slope.mean(axis=(1, 2))
+
+
+def adaptive_temperatures(logt, sensitivity, resolution=None, min_step=0.002,
+                          max_step=0.05):
+    """
+    Temperatures spaced so that the emission changes by about resolution
+    (in its logarithm, averaged over channels) from one to the next.
+
+    By default resolution is the largest change between neighbours of a
+    uniform grid with steps of 0.01, so that the grid tells temperatures
+    apart at least as well as that one everywhere. Spacings are kept
+    between min_step and max_step, and the first and last of logt are
+    always included.
+    """
+    if resolution is None:
+        resolution = 0.01 * sensitivity.max()
+    density = np.clip(sensitivity / resolution, 1.0 / max_step,
+                      1.0 / min_step)
+    nodes = np.concatenate([[0], np.cumsum(0.5 * (density[1:] +
+                                                  density[:-1]) *
+                                           np.diff(logt))])
+    n_steps = int(np.ceil(nodes[-1] - 1e-9))
+    temp = np.interp(np.linspace(0, nodes[-1], n_steps + 1), nodes, logt)
+    return np.unique(np.round(temp, 4))
+
+
+def prune_models(model, grid_shape, tol=0.01, floor=0.0):
+    """
+    Find the models of a grid that are not near-duplicates.
+
+    Parameters
+    ----------
+    model : numpy.ndarray
+        Synthetic emission table of a full grid in the order of
+        create_tempmap.parameter_grid, shape (n_vals, n_wlens).
+    grid_shape : tuple
+        Number of temperatures, widths and heights in the grid.
+    tol : float
+        Working up in temperature for each width and height, a model is
+        dropped if its misfit (mean absolute difference over channels) to
+        the last model kept is at most tol times that model's mean
+        emission.
+    floor : float
+        Emission below which differences are not told apart: the relative
+        misfit is taken against at least this mean emission. Models fainter
+        than this are mostly dropped.
+
+    Returns
+    -------
+    keep : numpy.ndarray
+        Boolean mask of the models to keep. Models with non-finite emission
+        are never kept, as they can never be the best fit.
+    """
+    n_temps = grid_shape[0]
+    rows = np.asarray(model, dtype='float64').reshape((n_temps, -1,
+                                                       model.shape[1]))
+    finite = np.all(np.isfinite(rows), axis=2)
+    keep = np.zeros(rows.shape[:2], dtype=bool)
+    last = np.zeros(rows.shape[1:])
+    seen = np.zeros(rows.shape[1], dtype=bool)
+    for it in range(n_temps):
+        misfit = np.mean(np.abs(rows[it] - last), axis=1)
+        scale = np.maximum(np.mean(np.abs(last), axis=1), floor)
+        new = finite[it] & (~seen | (misfit > tol * scale))
+        last[new] = rows[it][new]
+        seen |= new
+        keep[it] = new
+    return keep.ravel()
+
+
+def make_grid(n_params, solve_em=False, resolution=None, tol=0.01, floor=0.0,
+              min_step=0.002, max_step=0.05, corrections=True, cache_dir=None,
+              cache_size=2**30, verbose=False):
+    """
+    Build an adaptive model grid.
+
+    Parameters
+    ----------
+    n_params : 1 or 3
+        Number of parameters the grid is for.
+    solve_em : bool
+        With three parameters, build the grid for fits that solve for the
+        emission measure (a single unit height).
+    resolution, min_step, max_step :
+        Placement of the temperatures; see adaptive_temperatures. The
+        sensitivity is averaged over the widths of the default grid.
+    tol, floor :
+        Pruning of near-duplicate models; see prune_models. tol=0 keeps
+        every model of the product grid. floor is an emission in DN/s and
+        only applies to three-parameter grids with a height axis.
+    corrections, cache_dir, cache_size :
+        As for create_tempmap.create_tempmap. The emission table of the full
+        product grid is built, and cached, for the pruning.
+
+    Returns
+    -------
+    temp, widths, heights, parvals :
+        As returned by create_tempmap.parameter_grid. After pruning, parvals
+        only has some of the combinations of the axes.
+    """
+    # Imported here as create_tempmap loads grids through this module
+    from create_tempmap import t0, parameter_grid, model_responses, \
+        synthetic_model
+    solve_em = solve_em and n_params != 1
+    widths, heights = parameter_grid(n_params, solve_em)[1:3]
+    resp = model_responses(n_params, corrections)
+    logt, sensitivity = temperature_sensitivity(resp, n_params, widths, t0)
+    temp = adaptive_temperatures(logt, sensitivity, resolution, min_step,
+                                 max_step)
+    parvals = np.array([i for i in product(temp, widths, heights)])
+    if tol > 0:
+        model = synthetic_model(parvals, n_params, solve_em, corrections,
+                                cache_dir, cache_size)
+        if n_params == 1 or solve_em:
+            floor = 0.0
+        keep = prune_models(model, (len(temp), len(widths), len(heights)),
+                            tol, floor)
+        parvals = parvals[keep]
+    if verbose:
+        steps = np.diff(temp)
+        print '{} temperatures (steps {:.4f} to {:.4f}), {} of {} ' \
+            'models kept'.format(len(temp), steps.min(), steps.max(),
+                                 len(parvals),
+                                 len(temp) * len(widths) * len(heights))
+    return temp, np.asarray(widths), np.asarray(heights), parvals
+
+
+def is_product_grid(temp, widths, heights, parvals):
+    """
+    Whether parvals has every combination of the axes, as refinement and
+    warm starts need.
+    """
+    return len(parvals) == len(temp) * len(widths) * len(heights)
+
+
+def save_grid(fname, grid, n_params, solve_em=False):
+    """
+    Save a grid (temp, widths, heights, parvals) for fits with n_params
+    parameters to a .npz file.
+    """
+    temp, widths, heights, parvals = grid
+    np.savez(fname, format=GRID_FORMAT, n_params=n_params,
+             solve_em=bool(solve_em and n_params != 1), temp=temp,
+             widths=widths, heights=heights, parvals=parvals)
+
+
+def load_grid(grid, n_params, solve_em=False):
+    """
+    Load a grid saved by save_grid, checking that it was made for fits
+    with n_params parameters and the same solve_em setting. A grid tuple is
+    checked as far as it can be and returned as it is.
+
+    Returns
+    -------
+    temp, widths, heights, parvals :
+        As returned by create_tempmap.parameter_grid.
+    """
+    solve_em = bool(solve_em and n_params != 1)
+    if isinstance(grid, basestring):
+        saved = np.load(grid)
+        if int(saved['format']) != GRID_FORMAT:
+            raise ValueError('{} is not a grid of format {}'.format(
+                grid, GRID_FORMAT))
+        if int(saved['n_params']) != n_params or \
+                bool(saved['solve_em']) != solve_em:
+            raise ValueError('{} was made for n_params={} and solve_em={}'
+                             .format(grid, int(saved['n_params']),
+                                     bool(saved['solve_em'])))
+        grid = [saved[name] for name in ['temp', 'widths', 'heights',
+                                         'parvals']]
+    temp, widths, heights, parvals = grid
+    if parvals.ndim != 2 or parvals.shape[1] != 3 or \
+            (n_params == 1 or solve_em) and len(heights) != 1:
+        raise ValueError('Grid does not fit n_params={} and solve_em={}'
+                         .format(n_params, solve_em))
+    return temp, widths, heights, parvals
+
+
+if __name__ == '__main__':
+    if len(argv) < 3:
+        print __doc__
+        raise SystemExit(1)
+    options = eval(argv[3]) if len(argv) > 3 else {}
+    n_params = int(argv[1])
+    grid = make_grid(n_params, verbose=True, **options)
+    save_grid(argv[2], grid, n_params, options.get('solve_em', False))
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and counters for CoronaTemps runs.
+
+Code being measured marks its stages and counts what it processed:
+
+    with stage('fit'):
+        ...
+    count('pixels', n_pixels)
+
+Each process accumulates the wall and CPU time of every named stage and the
+totals of every counter. report() collects these from all processes of an
+MPI communicator on rank 0 and passes one record summarising the run to a
+sink, by default a JSON-lines file, and starts accumulating afresh. The
+record also gives the rate at which the fitting kernel got through pixels
+and models.
+
+Instrumentation is off unless enable() is called or $CORONATEMPS_INSTRUMENT
+names a file to log to; while it is off stage() and count() do nothing. A
+sink is any object with a write(record) method taking a dict, such as a
+JSONLinesSink or a MemorySink.
+"""
+
+import os
+import json
+import time
+import platform
+
+_recorder = []
+
+
+class JSONLinesSink(object):
+    """Append each record to fname as one line of JSON."""
+    def __init__(self, fname):
+        self.fname = fname
+
+    def write(self, record):
+        with open(self.fname, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class MemorySink(object):
+    """Keep the records in a list, records."""
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+
+class _Stage(object):
+    """Context manager adding its wall and CPU time to a Recorder."""
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        times = os.times()
+        self.cpu = times[0] + times[1]
+        self.wall = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.time() - self.wall
+        times = os.times()
+        cpu = times[0] + times[1] - self.cpu
+        self.recorder.add_stage(self.name, wall, cpu)
+        return False
+
+
+class _NullStage(object):
+    """Context manager that does nothing, used while disabled."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class Recorder(object):
+    """
+    Stage times and counters of one process, reported to sink.
+
+    CPU times are those of the process itself (including the kernel's
+    OpenMP threads) and not of any worker processes it starts.
+    """
+    def __init__(self, sink):
+        self.sink = sink
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def add_stage(self, name, wall, cpu):
+        entry = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0,
+                                              'cpu': 0.0})
+        entry['calls'] += 1
+        entry['wall'] += wall
+        entry['cpu'] += cpu
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        return {'host': platform.node(), 'pid': os.getpid(),
+                'stages': self.stages, 'counters': self.counters}
+
+
+def enable(sink):
+    """
+    Start recording, reporting to sink: a file name for a JSONLinesSink, or
+    a sink object.
+    """
+    if isinstance(sink, basestring):
+        sink = JSONLinesSink(sink)
+    disable()
+    _recorder.append(Recorder(sink))
+
+
+def disable():
+    """Stop recording, discarding anything not yet reported."""
+    del _recorder[:]
+
+
+def enabled():
+    return bool(_recorder)
+
+
+def stage(name):
+    """Context manager timing a named stage; stages can be repeated."""
+    if _recorder:
+        return _recorder[0].stage(name)
+    return _null_stage
+
+
+def count(name, value):
+    """Add value to the named counter."""
+    if _recorder:
+        _recorder[0].count(name, value)
+
+
+def aggregate(summaries, label=None):
+    """
+    Combine the summaries of each process into a record of the run.
+
+    For each stage the record gives the number of calls, the wall time of
+    the slowest process (wall) and the mean over processes (wall_mean), and
+    the CPU time of all processes together. Counters are summed. The
+    kernel's pixels and models per second are the 'pixels' and 'models'
+    counters over the wall time of the 'fit' stage.
+    """
+    stages = {}
+    names = set(name for summary in summaries for name in summary['stages'])
+    for name in names:
+        entries = [summary['stages'][name] for summary in summaries
+                   if name in summary['stages']]
+        walls = [entry['wall'] for entry in entries]
+        stages[name] = {'calls': max(entry['calls'] for entry in entries),
+                        'wall': max(walls),
+                        'wall_mean': sum(walls) / len(summaries),
+                        'cpu': sum(entry['cpu'] for entry in entries)}
+    counters = {}
+    for summary in summaries:
+        for name, value in summary['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+    record = {'label': label, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'n_ranks': len(summaries), 'stages': stages,
+              'counters': counters, 'ranks': summaries}
+    if 'fit' in stages and stages['fit']['wall'] > 0:
+        for name in ['pixels', 'models']:
+            if name in counters:
+                record['{}_per_second'.format(name)] = \
+                    counters[name] / stages['fit']['wall']
+    return record
+
+
+def report(comm=None, label=None):
+    """
+    Report what has been recorded since the last report and start afresh.
+
+    With comm, every process of the communicator must call this; the record
+    is written by rank 0 only. Returns the record written (None on other
+    ranks or while disabled).
+    """
+    if not _recorder:
+        return None
+    recorder = _recorder[0]
+    summary = recorder.summary()
+    recorder.reset()
+    summaries = [summary] if comm is None else comm.gather(summary, root=0)
+    if summaries is None:
+        return None
+    record = aggregate(summaries, label)
+    recorder.sink.write(record)
+    return record
+
+
+if os.environ.get('CORONATEMPS_INSTRUMENT'):
+    enable(os.environ['CORONATEMPS_INSTRUMENT'])
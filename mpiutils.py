@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for distributing images and models between MPI processes.
+
+Images and results are moved with the buffer-based collectives (Scatterv,
+Gatherv, Bcast) rather than the pickle-based lowercase ones, and the model
+table is held once per node in a shared-memory window. The bytes passed
+between processes are added to the 'mpi_bytes' counter of the instrument
+module by the processes receiving (or, for a gather, sending) them.
+"""
+
+import numpy as np
+from mpi4py import MPI
+from utils import split_counts
+import instrument
+
+
+def scatter_columns(comm, images, root=0):
+    """
+    Split an image cube of shape (n_wlens, x, y) on root along its last axis
+    and send each process its share of columns. A packed list of pixels can
+    be split evenly by passing it with shape (n_wlens, 1, n_pixels).
+
+    Returns the local part as a float32 array of shape (n_wlens, x, y_local)
+    in Fortran order, so it can be passed to the fitting kernels without a
+    copy.
+    """
+    rank, size = comm.Get_rank(), comm.Get_size()
+    shape = images.shape if rank == root else None
+    n_wlens, x, y = comm.bcast(shape, root=root)
+    counts, displs = split_counts(y, size)
+    block = x * n_wlens
+    recvbuf = np.empty((counts[rank], x, n_wlens), dtype='float32')
+    if rank == root:
+        sendbuf = np.ascontiguousarray(images.T, dtype='float32')
+        sendbuf = [sendbuf, counts * block, displs * block, MPI.FLOAT]
+    else:
+        sendbuf = None
+    comm.Scatterv(sendbuf, recvbuf, root=root)
+    if rank != root:
+        instrument.count('mpi_bytes', recvbuf.nbytes)
+    return recvbuf.T
+
+
+def gather_columns(comm, results, root=0):
+    """
+    Collect per-process results of shape (x, y_local, n) on root and join
+    them along their second axis, reversing scatter_columns.
+
+    Returns the full (x, y, n) float32 array on root and None elsewhere.
+    """
+    rank = comm.Get_rank()
+    x, y, n = results.shape
+    counts = np.array(comm.allgather(y))
+    displs = np.zeros_like(counts)
+    displs[1:] = np.cumsum(counts)[:-1]
+    block = x * n
+    sendbuf = np.ascontiguousarray(results.transpose(1, 0, 2),
+                                   dtype='float32')
+    if rank == root:
+        recvbuf = np.empty((counts.sum(), x, n), dtype='float32')
+        comm.Gatherv(sendbuf, [recvbuf, counts * block, displs * block,
+                               MPI.FLOAT], root=root)
+        return recvbuf.transpose(1, 0, 2)
+    else:
+        comm.Gatherv(sendbuf, None, root=root)
+        instrument.count('mpi_bytes', sendbuf.nbytes)
+        return None
+
+
+def node_shared_array(comm, array):
+    """
+    Make an array held by rank 0 available read-only to every process, with
+    a single copy per node in an MPI shared-memory window.
+
+    Returns the shared array and its window. Keep the window referenced for
+    as long as the array is used and call its Free method afterwards.
+    """
+    rank = comm.Get_rank()
+    node = comm.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+    leader = node.Get_rank() == 0
+    # Rank 0 has the lowest rank on its node, so it is also rank 0 here
+    leaders = comm.Split(0 if leader else MPI.UNDEFINED, key=rank)
+
+    meta = (array.shape, array.dtype.str) if rank == 0 else None
+    shape, dtype = comm.bcast(meta, root=0)
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize if leader else 0
+    win = MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm=node)
+    buf, itemsize = win.Shared_query(0)
+    shared = np.ndarray(buffer=buf, dtype=dtype, shape=shape)
+    if leader:
+        if rank == 0:
+            shared[...] = array
+        leaders.Bcast(shared, root=0)
+        if rank != 0:
+            instrument.count('mpi_bytes', shared.nbytes)
+        leaders.Free()
+    node.Barrier()
+    node.Free()
+    shared.flags.writeable = False
+    return shared, win
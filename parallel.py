@@ -1,34 +1,30 @@
-import os
-import glob
-import subprocess
-from time import sleep
+# -*- coding: utf-8 -*-
+"""
+Download the AIA data for a set of observation times ahead of fitting them,
+fetching all the missing channels concurrently.
+
+    python parallel.py <data_dir> <date> [<date> ...]
+"""
+
+import sys
 from sunpy.time import parse_time as parse
+from acquire import fetch_missing
+
 
-wlens = ['94', '131', '171', '193', '211', '335']
+def download(dates, data_dir, fetcher=None, max_workers=6, retries=3,
+             verbose=False):
+    """
+    Fetch every channel missing from data_dir for each of a list of times.
+    Returns the acquire.AcquisitionReport, which lists any failures.
+    """
+    dates = [parse(date) for date in dates]
+    report = fetch_missing(dates, data_dir, fetcher=fetcher,
+                           max_workers=max_workers, retries=retries,
+                           verbose=verbose)
+    print report
+    return report
 
-def download(date):
-    date = parse(date)
-    # Loop through wavelengths
-    for w, wlen in enumerate(wlens):
-        data_dir = '/whatever/'
-        fits_dir = os.path.join(data_dir, '{}/{:%Y/%m/%d}/'.format(wlen, date))
-        searchname = os.path.join(fits_dir, '*{:%H:%M}*fits'.format(date))
-        countfiles = glob.glob(searchname)
-        if countfiles == 1:
-            f = open('runfile_{}'.format(w), 'w')
-            f.write("python getdata.py {} {} {}".format(date, wlen, fits_dir))
-            f.close()
-        # Download data if not enough found
-        subprocess.call("qsub runfile_{}".format(w))
 
-    running = True
-    iterations = 0
-    while running:
-        if subprocess.check_output('qstat') != '':
-            running = False
-        elif iterations > 7200:
-            
-        sleep(1)
-        iterations += 1
-    
-    return
\ No newline at end of file
+if __name__ == '__main__':
+    report = download(sys.argv[2:], sys.argv[1], verbose=True)
+    sys.exit(0 if report.ok else 1)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Single-node backend sharing the fitting between a pool of worker processes.
+
+The images, results and (unless it is already a read-only memmap, whose
+pages the operating system shares between processes anyway) the model table
+are held in shared memory, which the workers inherit when they are forked,
+so nothing is copied per worker. Every pixel is fitted independently, so the
+results are identical to those of the serial and MPI backends.
+"""
+
+import ctypes
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+from utils import split_counts
+from fitting import fit_images
+
+# Arrays and settings inherited by the worker processes
+_shared = {}
+
+
+def shared_array(shape, dtype):
+    """
+    Allocate a numpy array in shared memory that is inherited by processes
+    started afterwards.
+    """
+    dtype = np.dtype(dtype)
+    raw = RawArray(ctypes.c_char, max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return np.frombuffer(raw, dtype=dtype,
+                         count=int(np.prod(shape))).reshape(shape)
+
+
+def default_workers():
+    """Number of worker processes to use: one per core."""
+    return mp.cpu_count()
+
+
+def _init_worker(shared):
+    _shared.update(shared)
+
+
+def _fit_chunk(bounds):
+    start, stop = bounds
+    images = _shared['images'][..., start:stop]
+    temps, n_examined = fit_images(images, _shared['model'],
+                                   _shared['parvals'], **_shared['kwargs'])
+    _shared['results'][:, start:stop, :] = temps
+    if n_examined is not None:
+        _shared['n_examined'][:, start:stop] = n_examined
+
+
+def fit_pool(images, model, parvals, n_params, solve_em=False, search='scan',
+             index=None, n_workers=None, n_threads=1, chunks_per_worker=4):
+    """
+    Fit an image block of shape (n_wlens, x, y) with a pool of worker
+    processes, each fitting a share of its columns.
+
+    Arguments and results are as for fitting.fit_images. n_workers defaults
+    to one per core, each running a single-threaded kernel. Columns are
+    handed out in chunks_per_worker chunks per worker to even out the load.
+    """
+    n_wlens, x, y = images.shape
+    if n_workers is None:
+        n_workers = default_workers()
+    n_workers = max(min(n_workers, y), 1)
+    n_out = n_params + 1
+    if y == 0:
+        return fit_images(images, model, parvals, n_params, solve_em, search,
+                          index, n_threads)
+
+    shared = {'parvals': parvals, 'model': model,
+              'kwargs': {'n_params': n_params, 'solve_em': solve_em,
+                         'search': search, 'index': index,
+                         'n_threads': n_threads}}
+    shared['images'] = shared_array(images.shape, 'float32')
+    shared['images'][...] = images
+    if not isinstance(model, np.memmap):
+        shared['model'] = shared_array(model.shape, model.dtype)
+        shared['model'][...] = model
+    shared['results'] = shared_array((x, y, n_out), 'float32')
+    if search == 'index' and not solve_em:
+        shared['n_examined'] = shared_array((x, y), 'int32')
+
+    counts, displs = split_counts(y, min(n_workers * chunks_per_worker, y))
+    bounds = [(start, start + count) for start, count in zip(displs, counts)]
+    workers = mp.Pool(n_workers, initializer=_init_worker, initargs=(shared,))
+    try:
+        workers.map(_fit_chunk, bounds, chunksize=1)
+    finally:
+        workers.close()
+        workers.join()
+
+    return shared['results'], shared.get('n_examined')
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Preparation of AIA level 1 images to level 1.5 for fitting and display.
+
+When only a region of the disk is wanted, just a padded cutout around it is
+registered (rotated to solar north and resampled to 0.6 arcsec per pixel)
+rather than the whole 4096x4096 frame. The cutout is resampled straight onto
+the sun-centred pixel grid of a full level 1.5 frame, restricted to the
+region, so every channel prepared for the same region has the same shape and
+reference pixel. Several images can be prepared in parallel by a pool of
+worker processes, since the registration holds the GIL. Images are returned in
+float32, normalised to counts per second.
+
+Prepared images are kept in an on-disk cache keyed by the identity of the
+source file (path, size and modification time) and the preparation
+settings, so every stage that needs the same image registers it only once.
+"""
+
+import os
+import numpy as np
+import multiprocessing as mp
+from os import path
+from itertools import product
+from scipy.ndimage import map_coordinates
+from sunpy.map import Map
+from sunpy.instr.aia import aiaprep
+from cache import CacheDir, default_cache_dir, hash_items
+
+# Bump when the way images are prepared changes
+PREP_FORMAT = 2
+
+# Pixel size of level 1.5 images, in arcsec
+plate_scale = 0.6
+
+
+def cutout_range(meta, submap, pad=16):
+    """
+    Range of level 1 data coordinates to cut out of an image so that it
+    covers the region submap = (xrange, yrange), in arcsec, once registered.
+
+    The corners of the region are rotated both ways by the roll angle about
+    the reference coordinate and the box around them is padded by pad
+    pixels on each side.
+    """
+    theta = np.deg2rad(meta.get('crota2', 0.0))
+    x0, y0 = meta['crval1'], meta['crval2']
+    xs, ys = [], []
+    for angle in [theta, -theta]:
+        c, s = np.cos(angle), np.sin(angle)
+        for x, y in product(submap[0], submap[1]):
+            xs.append(x0 + c * (x - x0) - s * (y - y0))
+            ys.append(y0 + s * (x - x0) + c * (y - y0))
+    padx = pad * abs(meta['cdelt1'])
+    pady = pad * abs(meta['cdelt2'])
+    return [min(xs) - padx, max(xs) + padx], [min(ys) - pady, max(ys) + pady]
+
+
+def level15_range(arange):
+    """
+    First and last pixel of a full level 1.5 frame whose centres lie in the
+    range arange, in arcsec from Sun centre, counting from the pixel just
+    above or right of the centre.
+
+    aiaprep places the Sun centre at the centre of the 4096x4096 frame, on a
+    pixel corner, so pixel i is centred at (i + 0.5) * plate_scale.
+    """
+    return (int(np.ceil(arange[0] / plate_scale - 0.5 - 1e-6)),
+            int(np.floor(arange[1] / plate_scale - 0.5 + 1e-6)))
+
+
+def register_cutout(aiamap, submap):
+    """
+    Register a cutout of a level 1 AIA image as aiaprep does a full frame,
+    and crop the region submap = (xrange, yrange), in arcsec, from it.
+
+    The cutout is rotated to solar north and resampled by cubic
+    interpolation onto the pixels of a full level 1.5 frame that lie in the
+    region (see level15_range), so the result does not depend on where the
+    cutout was taken or on the roll and scale of the level 1 image. Pixels
+    outside the cutout are set to its minimum.
+    """
+    meta = aiamap.meta
+    (i0, i1), (j0, j1) = level15_range(submap[0]), level15_range(submap[1])
+    dx = (np.arange(i0, i1 + 1) + 0.5) * plate_scale - meta['crval1']
+    dy = (np.arange(j0, j1 + 1) + 0.5) * plate_scale - meta['crval2']
+    dx, dy = dx[None, :], dy[:, None]
+    theta = np.deg2rad(meta.get('crota2', 0.0))
+    c, s = np.cos(theta), np.sin(theta)
+    # Level 1 array coordinates of the centre of each level 1.5 pixel
+    px = (c * dx + s * dy) / meta['cdelt1'] + meta['crpix1'] - 1
+    py = (c * dy - s * dx) / meta['cdelt2'] + meta['crpix2'] - 1
+    data = map_coordinates(np.asarray(aiamap.data, dtype='float64'),
+                           [py, px], order=3, mode='constant',
+                           cval=aiamap.min())
+    newmeta = meta.copy()
+    for key in ['pc1_1', 'pc1_2', 'pc2_1', 'pc2_2']:
+        newmeta.pop(key, None)
+    newmeta.update({'naxis1': data.shape[1], 'naxis2': data.shape[0],
+                    'crpix1': 0.5 - i0, 'crpix2': 0.5 - j0,
+                    'crval1': 0.0, 'crval2': 0.0,
+                    'cdelt1': plate_scale, 'cdelt2': plate_scale,
+                    'crota2': 0.0, 'lvl_num': 1.5})
+    newmeta['r_sun'] = newmeta['rsun_obs'] / plate_scale
+    return Map(data, newmeta)
+
+
+def check_grid(image, shape, meta, name):
+    """
+    Check that a prepared image is on the pixel grid of another with the
+    given shape and header (the same shape, reference pixel and pixel size),
+    as the fit compares the channels pixel by pixel. Raises ValueError
+    naming the image if not.
+    """
+    if image.data.shape != shape:
+        raise ValueError('{} image has shape {}, expected {}'.format(
+            name, image.data.shape, shape))
+    for key in ['crpix1', 'crpix2', 'cdelt1', 'cdelt2']:
+        if key in image.meta and key in meta and \
+                abs(image.meta[key] - meta[key]) > 1e-3:
+            raise ValueError('{} image has {} = {}, expected {}'.format(
+                name, key, image.meta[key], meta[key]))
+
+
+def prep_key(filename, submap=None, pad=16):
+    """
+    Hash identifying the prepared version of a file with the given
+    settings.
+    """
+    stat = os.stat(filename)
+    return hash_items('prepped', PREP_FORMAT, path.abspath(filename),
+                      stat.st_size, stat.st_mtime, submap, pad)
+
+
+def prep_cache(cache_dir=None, cache_size=2**34):
+    """
+    The cache of prepared images: cache_dir, by default a 'prepped'
+    directory in cache.default_cache_dir(), holding up to cache_size bytes.
+    """
+    if cache_dir is None:
+        cache_dir = path.join(default_cache_dir(), 'prepped')
+    return CacheDir(cache_dir, cache_size)
+
+
+def prep_image(filename, submap=None, pad=16, use_cache=True, cache_dir=None,
+               cache_size=2**34):
+    """
+    Load an AIA level 1 file and prepare it to level 1.5.
+
+    Parameters
+    ----------
+    filename : str
+        File to load.
+    submap : tuple, optional
+        Arguments to Map.submap selecting the region wanted. Ranges in
+        arcsec are registered from a cutout padded by pad pixels; ranges in
+        pixels need the full frame registering first.
+    use_cache : bool
+        Read the prepared image from the cache of prepared images if it is
+        there, and add it otherwise.
+    cache_dir, cache_size :
+        Location and size limit of the cache; see prep_cache.
+
+    Returns
+    -------
+    aiamap : sunpy.map.GenericMap
+        Registered image in counts per second, with float32 data.
+    """
+    if use_cache:
+        cache = prep_cache(cache_dir, cache_size)
+        key = prep_key(filename, submap, pad)
+        cached = cache.get(key, '.fits')
+        if cached is not None:
+            try:
+                aiamap = Map(cached)
+                aiamap.data = np.array(aiamap.data, dtype='float32')
+                return aiamap
+            except (IOError, OSError):
+                # Evicted by another job since it was found
+                pass
+
+    aiamap = Map(filename)
+    if submap and (len(submap) < 3 or submap[2] == 'data'):
+        aiamap = aiamap.submap(*cutout_range(aiamap.meta, submap, pad))
+        aiamap = register_cutout(aiamap, submap)
+    else:
+        aiamap = aiaprep(aiamap)
+        if submap:
+            aiamap = aiamap.submap(*submap)
+    data = np.array(aiamap.data, dtype='float32')
+    data *= 1.0 / aiamap.exposure_time
+    aiamap.data = data
+
+    if use_cache:
+        cache.put(key, lambda tmpname: aiamap.save(tmpname, clobber=True),
+                  '.fits')
+    return aiamap
+
+
+def _prep_worker(args):
+    filename, submap, pad, kwargs = args
+    aiamap = prep_image(filename, submap, pad, **kwargs)
+    return aiamap.data, dict(aiamap.meta)
+
+
+def prep_images(filenames, submap=None, n_workers=None, pad=16, pool=None,
+                **kwargs):
+    """
+    Prepare several AIA level 1 files in parallel with prep_image, which is
+    passed any further keyword arguments.
+
+    n_workers defaults to one process per file still to be prepared (up to
+    one per core); files already in the cache are read in this process, as
+    is everything with n_workers=1. Returns a generator of the prepared maps
+    in the order of filenames, so each can be dealt with as soon as it and
+    the ones before it are ready.
+
+    A multiprocessing.Pool to use can be passed as pool instead, and is left
+    running. Pass one when calling from any thread but the main one, as
+    forking a new pool while other threads run can deadlock the workers.
+    """
+    filenames = list(filenames)
+    todo = filenames
+    if kwargs.get('use_cache', True):
+        cache = prep_cache(kwargs.get('cache_dir'),
+                           kwargs.get('cache_size', 2**34))
+        todo = [fname for fname in filenames if not path.exists(
+            cache.filename(prep_key(fname, submap, pad), '.fits'))]
+    if n_workers is None:
+        n_workers = min(len(todo), mp.cpu_count())
+    if (pool is None and n_workers <= 1) or len(todo) <= 1:
+        for fname in filenames:
+            yield prep_image(fname, submap, pad, **kwargs)
+        return
+    workers = pool if pool is not None else mp.Pool(n_workers)
+    try:
+        jobs = [(fname, submap, pad, kwargs) for fname in todo]
+        prepped = workers.imap(_prep_worker, jobs)
+        for fname in filenames:
+            if fname in todo:
+                data, meta = next(prepped)
+                yield Map(data, meta)
+            else:
+                yield prep_image(fname, submap, pad, **kwargs)
+    finally:
+        if pool is None:
+            workers.terminate()
+            workers.join()
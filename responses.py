@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+AIA temperature response functions.
+
+The responses are distributed as an IDL save file (aia_tresp), which is slow
+to parse. It is converted once into a .npy table in the cache, keyed by the
+identity of the save file, and the table is memory-mapped and kept for the
+rest of the process, so loading responses after the first time is
+effectively free.
+"""
+
+import os
+import numpy as np
+from os import path
+from cache import CacheDir, default_cache_dir, hash_items
+
+# Channels in the response table, in row order after the log(T) axis
+channels = ['94', '131', '171', '193', '211', '335', '304']
+
+# Bump when the layout of the converted table changes
+RESPONSE_FORMAT = 1
+
+# Tables already loaded by this process, by source file
+_tables = {}
+
+
+def response_file():
+    """
+    Find the IDL save file of AIA temperature responses: $CORONATEMPS_TRESP
+    if it is set, otherwise aia_tresp in the CoronaTemps directory.
+    """
+    if os.environ.get('CORONATEMPS_TRESP'):
+        return os.environ['CORONATEMPS_TRESP']
+    return path.join(path.dirname(path.abspath(__file__)), 'aia_tresp')
+
+
+class ResponseTable(object):
+    """
+    Temperature responses of the AIA channels.
+
+    Attributes
+    ----------
+    logt : numpy.ndarray
+        log10 temperatures the responses are tabulated at.
+    table : numpy.ndarray
+        Read-only array of shape (len(channels)+1, n_temps): logt followed
+        by the response of each channel.
+
+    The response of a channel is returned by indexing with its wavelength,
+    e.g. table['171'] or table[94].
+    """
+    def __init__(self, table):
+        self.table = table
+        self.logt = table[0]
+
+    def __getitem__(self, wlen):
+        return self.table[1 + channels.index(str(int(wlen)))]
+
+
+def load_responses(source=None, cache_dir=None):
+    """
+    Load the AIA temperature responses as a ResponseTable.
+
+    Parameters
+    ----------
+    source : str, optional
+        IDL save file to read. Defaults to response_file().
+    cache_dir : str, optional
+        Directory to keep the converted table in. Defaults to a 'responses'
+        directory in cache.default_cache_dir().
+    """
+    if source is None:
+        source = response_file()
+    stat = os.stat(source)
+    key = hash_items('aia_tresp', RESPONSE_FORMAT, path.abspath(source),
+                     stat.st_size, stat.st_mtime)
+    if key in _tables:
+        return _tables[key]
+    if cache_dir is None:
+        cache_dir = path.join(default_cache_dir(), 'responses')
+    cache = CacheDir(cache_dir)
+    fname = cache.get(key, '.npy')
+    if fname is None:
+        def write(tmpname):
+            from scipy.io.idl import readsav
+            tresp = readsav(source)
+            rows = [tresp['logt']] + [tresp['resp{}'.format(wlen)]
+                                      for wlen in channels]
+            np.save(tmpname, np.array(rows, dtype='float64'))
+        fname = cache.put(key, write, '.npy')
+    _tables[key] = ResponseTable(np.load(fname, mmap_mode='r'))
+    return _tables[key]
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Batch production of temperature maps for a series of observation times.
+
+The synthetic emission model is loaded once for the whole series, and the
+stages for consecutive frames overlap: while frame N is being fitted, the
+images for frame N+1 are found and prepared in one background thread and
+the results for frame N-1 are written in another. The fitting kernels
+release the GIL, so the three stages run concurrently.
+"""
+
+import Queue
+import threading
+import multiprocessing as mp
+import datetime as dt
+import sunpy
+from create_tempmap import wlens, parameter_grid, synthetic_model, \
+    prepare_images, unpack_results
+from fitting import build_model_index, fit_images, fit_warm, path_counts, \
+    pack_previous, unpack_previous
+from temperature import save_tempmap
+
+
+def series_times(start, end, cadence):
+    """
+    Return the observation times from start to end (inclusive) at the given
+    cadence, which is a timedelta or a number of seconds.
+    """
+    start = sunpy.time.parse_time(start)
+    end = sunpy.time.parse_time(end)
+    if not isinstance(cadence, dt.timedelta):
+        cadence = dt.timedelta(seconds=cadence)
+    dates = []
+    date = start
+    while date <= end:
+        dates.append(date)
+        date += cadence
+    return dates
+
+
+def tempmap_series(start, end, cadence, data_dir, maps_dir, n_params=1,
+                   submap=None, verbose=False, force_temp_scan=False,
+                   n_threads=0, solve_em=False, search='scan',
+                   corrections=True, cache_dir=None, cache_size=2**30,
+                   max_radius=1.5, prefetch=1, warm_start=False, tol=0.01,
+                   radius=(5, 1, 5), compression=None):
+    """
+    Create and save temperature maps for every frame in a time range.
+
+    Parameters
+    ----------
+    start, end : str or datetime
+        First and last observation times of the series.
+    cadence : timedelta or float
+        Time between frames (in seconds if a number).
+    data_dir : str
+        Root of the AIA data archive.
+    maps_dir : str
+        Directory to save the maps in, as read by TemperatureMap.
+    prefetch : int
+        Number of frames loaded ahead of the one being fitted.
+    warm_start : bool
+        Fit each frame starting from the solution for the one before, with
+        the given tol and radius; see fitting.fit_warm. The number of pixels
+        taking each path is printed for every frame.
+    compression : str, optional
+        Tile compression for the saved maps; see tmapfile.write_tempmap.
+
+    The remaining arguments are as for create_tempmap.create_tempmap.
+
+    Returns
+    -------
+    saved : list
+        File names of the saved maps, in time order.
+    failed : list
+        (date, exception) for every frame that could not be made.
+    """
+    dates = series_times(start, end, cadence)
+    solve_em = solve_em and n_params != 1
+    if warm_start and (solve_em or search != 'scan'):
+        raise ValueError('warm_start needs a full model grid and search='
+                         "'scan'")
+
+    # Everything that does not depend on the frame is set up once
+    temp, widths, heights, parvals = parameter_grid(n_params, solve_em)
+    grid_shape = (len(temp), len(widths), len(heights))
+    model = synthetic_model(parvals, n_params, solve_em, corrections,
+                            cache_dir, cache_size, force_temp_scan, verbose)
+    index = build_model_index(model) if search == 'index' else None
+
+    loaded = Queue.Queue(maxsize=prefetch)
+    fitted = Queue.Queue(maxsize=1)
+    saved, failed = [], []
+
+    def load():
+        for date in dates:
+            try:
+                frame = prepare_images(date, n_params, data_dir,
+                                       submap=submap, max_radius=max_radius,
+                                       verbose=verbose, pool=workers)
+            except Exception as err:
+                frame = err
+            loaded.put((date, frame))
+        loaded.put(None)
+
+    def write():
+        while True:
+            item = fitted.get()
+            if item is None:
+                break
+            date, data, meta = item
+            try:
+                saved.append(save_tempmap(data, meta, maps_dir, date,
+                                          n_params, compression))
+            except Exception as err:
+                if verbose: print 'Saving map for {} failed: {}'.format(
+                    date, err)
+                failed.append((date, err))
+            else:
+                if verbose: print 'Saved map for {}'.format(date)
+
+    # The processes that prepare the images are started before the threads,
+    # as forking while other threads run is not safe
+    workers = mp.Pool(min(len(wlens), mp.cpu_count()))
+    loader = threading.Thread(target=load)
+    writer = threading.Thread(target=write)
+    loader.daemon = writer.daemon = True
+    loader.start()
+    writer.start()
+    previous = None
+    try:
+        while True:
+            item = loaded.get()
+            if item is None:
+                break
+            date, frame = item
+            if isinstance(frame, Exception):
+                if verbose: print 'No map for {}: {}'.format(date, frame)
+                failed.append((date, frame))
+                continue
+            images, mask, header = frame
+            if warm_start:
+                temps, current, path = fit_warm(
+                    images, model, parvals[:, 0] if n_params == 1 else parvals,
+                    grid_shape, pack_previous(previous, mask), tol, radius,
+                    n_threads)
+                previous = unpack_previous(current, mask)
+                print '{}: {}'.format(date, path_counts(path))
+            else:
+                temps = fit_images(images, model, parvals, n_params,
+                                   solve_em, search, index, n_threads)[0]
+            meta = header.copy()
+            meta['date-obs'] = str(date)
+            fitted.put((date, unpack_results(temps, mask), meta))
+    finally:
+        fitted.put(None)
+        writer.join()
+        workers.terminate()
+        workers.join()
+
+    return saved, failed
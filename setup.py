@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Build script for the compiled fitting kernel.
+
+Build the extension once, in place, after checking out or updating the code:
+
+    python setup.py build_ext --inplace
+
+The kernel is built with OpenMP so that a single call to calc_fits uses all
+cores available to it. Set OMP_NUM_THREADS (or pass n_threads) to limit this,
+e.g. when running several MPI ranks per node.
+"""
+
+from numpy.distutils.core import setup, Extension
+
+fits = Extension('fits',
+                 sources=['fitsmodule.f90'],
+                 extra_f90_compile_args=['-O3', '-fopenmp'],
+                 extra_link_args=['-lgomp'])
+
+setup(name='CoronaTemps',
+      description='Tools for calculating the temperature of the solar corona '
+                  'from EUV emission.',
+      ext_modules=[fits])
@@ -13,22 +13,112 @@ from matplotlib import patches
 import numpy as np
 import sunpy
 from sunpy.map import Map, GenericMap
-from sunpy.instr.aia import aiaprep
 from sys import argv
 from os import path, makedirs
 import subprocess32 as subp
-from scipy.io.idl import readsav as read
-import glob
+import shutil
+import tempfile
+import cPickle as pickle
+from create_tempmap import create_tempmap
+from archive import archive_index
+from prep import prep_image
+from utils import estimate_em
+from tmapfile import plane_names, read_tempmap, write_tempmap
+import instrument
 
 
 home = path.expanduser('~')
 cortemps = path.join(home, 'CoronaTemps')
 
 
+def create_tempmap_mpi(n_procs, *args, **kwargs):
+    """
+    Run create_tempmap.py under mpiexec with n_procs processes and return its
+    results. Arguments are as for create_tempmap.create_tempmap; each process
+    fits with one thread unless n_threads is given. They are pickled, and
+    the results passed back, through a private temporary directory, so
+    several calls can run at once.
+
+    Warm starts (previous) and fit summaries are not available, and timing
+    can only be a file name, as the fit runs in other processes. Raises
+    ValueError if any of these, or an argument that cannot be pickled, is
+    given.
+    """
+    if kwargs.get('previous') is not None or kwargs.get('summary'):
+        raise ValueError('Warm starts and fit summaries are not available '
+                         'with the MPI backend')
+    timing = kwargs.get('timing')
+    if timing and not isinstance(timing, basestring):
+        raise ValueError('timing must be a file name with the MPI backend')
+    tmpdir = tempfile.mkdtemp(prefix='tempmap-')
+    try:
+        kwargs['output'] = path.join(tmpdir, 'tempmap.fits')
+        options = path.join(tmpdir, 'options.pickle')
+        with open(options, 'wb') as f:
+            try:
+                pickle.dump((args, kwargs), f, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError) as err:
+                raise ValueError('Arguments cannot be passed to the MPI '
+                                 'backend: {}'.format(err))
+        cmdargs = ["mpiexec", "-n", str(n_procs), "python",
+                   path.join(cortemps, 'create_tempmap.py'), options]
+        subp.check_call(cmdargs)
+        newmap = Map(kwargs['output'])
+        data, meta = np.array(newmap.data), newmap.meta
+    finally:
+        shutil.rmtree(tmpdir)
+    return data, meta
+
+
+def save_tempmap(data, meta, maps_dir, date, n_params=1, compression=None,
+                 summary=None):
+    """
+    Save temperature map results of shape (ny, nx, n_params+1), or a list
+    of their planes, in maps_dir under the name TemperatureMap looks for
+    them, and return the file name. Each plane is saved as a float32 FITS
+    extension, tile-compressed if compression is given, followed by any
+    fit summaries given; see tmapfile.write_tempmap.
+    """
+    if not path.exists(maps_dir):
+        makedirs(maps_dir)
+    fname = path.join(maps_dir, '{:%Y-%m-%dT%H_%M_%S}.fits'.format(date))
+    if n_params != 1:
+        fname = fname.replace('.fits', '_full.fits')
+    write_tempmap(fname, data, meta, compression, extra=summary)
+    return fname
+
+
+def _plane(name):
+    """
+    Attribute holding one product of the fit, read from the map file the
+    first time it is used.
+    """
+    def get(self):
+        try:
+            plane = self._planes[name]
+        except (AttributeError, KeyError):
+            raise AttributeError(name)
+        if callable(plane):
+            plane = self._planes[name] = plane()
+        return plane
+
+    def set(self, value):
+        self._planes[name] = value
+    return property(get, set)
+
+
 class TemperatureMap(GenericMap):
+    dem_width = _plane('dem_width')
+    emission_measure = _plane('emission_measure')
+    goodness_of_fit = _plane('goodness_of_fit')
+
     def __init__(self, date=None, n_params=1, data_dir=None, maps_dir=None, 
                  fname=None, infofile=None, submap=None, verbose=False,
-                 force_temp_scan=False):
+                 force_temp_scan=False, n_threads=0, solve_em=False,
+                 search='scan', backend='serial', n_procs=None,
+                 previous=None, max_memory=2**30, summary=None,
+                 timing=None, refine=False, t_step=0.01, grid=None,
+                 quantise=None):
         if (not fname and not date) or (fname and date):
             print """You must specify either a date and time for which to create
                 temperatures or the name of a file containing a valid 
@@ -59,23 +149,51 @@ class TemperatureMap(GenericMap):
 
         if verbose: print fname, data_dir
 
+        # Planes other than the temperatures are read when first used
+        self._planes = {}
+        self.summary_names = []
         try:
-            newmap = Map(fname)
-            GenericMap.__init__(self, newmap.data[..., 0], newmap.meta)
-            self.goodness_of_fit = newmap.data[..., -1]
-            if newmap.data.shape[2] != 2:
-                self.dem_width = newmap.data[..., 1]
-                self.emission_measure = newmap.data[..., 2]
-        except ValueError:
-            cmdargs = ["python", path.join(cortemps, 'create_tempmap.py'),
-                date, n_params, data_dir, infofile, submap, verbose, force_temp_scan]
-            if n_params != 1:
-                cmdargs = ["mpiexec", "-n", 16] + cmdargs
-            cmdargs = [str(cmd) for cmd in cmdargs]
-            status = subp.call(cmdargs)
-            newmap = Map(path.join(cortemps, 'temporary.fits'))
-            subp.call(["rm", path.join(cortemps, 'temporary.fits')])
-            data, meta = newmap.data, newmap.meta
+            meta, planes = read_tempmap(fname)
+        except (IOError, ValueError):
+            planes = None
+        if planes is None and backend == 'tiled':
+            # Fit tile by tile straight into the file for this map
+            from tiling import create_tempmap_tiled
+            if not path.exists(path.dirname(fname)):
+                makedirs(path.dirname(fname))
+            create_tempmap_tiled(date, fname, n_params, data_dir, submap,
+                                 verbose, force_temp_scan, n_threads=n_threads,
+                                 solve_em=solve_em, search=search,
+                                 max_memory=max_memory, timing=timing,
+                                 refine=refine, t_step=t_step, grid=grid,
+                                 quantise=quantise)
+            meta, planes = read_tempmap(fname)
+            meta['date-obs'] = str(date)
+
+        if planes is not None:
+            GenericMap.__init__(self, planes.pop('temperature')(), meta)
+            self._planes.update(planes)
+            self.summary_names = sorted(name for name in planes if
+                                        name.upper() not in plane_names)
+        else:
+            args = (date, n_params, data_dir, infofile, submap, verbose,
+                    force_temp_scan)
+            kwargs = {'n_threads': n_threads, 'solve_em': solve_em,
+                      'search': search, 'timing': timing,
+                      'refine': refine, 't_step': t_step, 'grid': grid,
+                      'quantise': quantise}
+            if backend == 'mpi':
+                data, meta = create_tempmap_mpi(n_procs or 16, *args,
+                                                previous=previous,
+                                                summary=summary, **kwargs)
+            else:
+                result = create_tempmap(*args, backend=backend,
+                                        n_workers=n_procs, previous=previous,
+                                        summary=summary, **kwargs)
+                data, meta = result[:2]
+                if summary:
+                    self._planes.update(result[2])
+                    self.summary_names = sorted(result[2])
             if verbose: print data.shape
             GenericMap.__init__(self, data[..., 0], meta)
             if data.shape[2] != 2:
@@ -89,14 +207,6 @@ class TemperatureMap(GenericMap):
                 if n_params != 1:
                     print self.dem_width.shape
                     print self.emission_measure.shape
-            lowx, highx = (self.xrange[0] / self.scale['x'],
-                           self.xrange[1] / self.scale['x'])
-            lowy, highy = (self.yrange[0] / self.scale['y'],
-                           self.yrange[1] / self.scale['y'])
-            x_grid, y_grid = np.mgrid[lowx:highx-1, lowy:highy-1]
-            r_grid = np.sqrt((x_grid ** 2.0) + (y_grid ** 2.0))
-            outer_rad = (self.rsun_arcseconds * 1.5) / self.scale['x']
-            self.data[r_grid > outer_rad] = None
             self.meta['date-obs'] = str(date)
 
         tmapcubehelix = _cm.cubehelix(s=2.8, r=0.7, h=2.0, gamma=1.0)
@@ -166,7 +276,8 @@ class TemperatureMap(GenericMap):
         data_dir = self.data_dir
         maps_dir = self.maps_dir
         
-        date = self.date
+        date = sunpy.time.parse_time(self.date)
+        archive = archive_index(data_dir)
         nmaps = 2 + len(extra_maps)
         if context_wlen:
             nrows = 2
@@ -179,12 +290,11 @@ class TemperatureMap(GenericMap):
         self.plot()#*temp_args, **temp_kwargs)
         plt.colorbar(orientation='horizontal')
         
-        displaymap = Map(data_dir+'{0}/{1:%Y/%m/%d}/aia*{0}*t{1:%H?%M}*lev1?fits'\
-            .format(display_wlen, date))
-        if isinstance(displaymap, list):
-            displaymap = displaymap[0]
-        displaymap = aiaprep(displaymap)
-        displaymap /= displaymap.exposure_time
+        display_file = archive.find(display_wlen, date, tolerance=60)
+        if display_file is None:
+            print 'AIA data not found :('
+            return
+        displaymap = prep_image(display_file)
         
         fig.add_subplot(nrows, nmaps, 1, axisbg='k')
         displaymap.plot()#*wlen_args, **wlen_kwargs)
@@ -192,11 +302,11 @@ class TemperatureMap(GenericMap):
         
         if context_wlen and self.region != None:
             context_plot = fig.add_subplot(nrows, 1, nrows)
-            contextmap = Map(data_dir+'{0}/{1:%Y/%m/%d}/aia*{0}*t{1:%H?%M}*lev1?fits'.format(context_wlen, date))
-            if isinstance(contextmap, list):
-                contextmap = contextmap[0]
             x, y = self.region_coordinate['x'], self.region_coordinate['y']
-            contextmap = contextmap.submap([-1000, 1000], [y-300, y+300])
+            # Only the strip around the region is registered
+            contextmap = prep_image(archive.find(context_wlen, date,
+                                                 tolerance=60),
+                                    ([-1000, 1000], [y-300, y+300]))
             # Need to figure out how to get 'subimsize' from self. Use the default 150'' for now
             #rect = patches.Rectangle([x-subdx, y-subdx], subimsize[0], subimsize[1], color='white', fill=False)
             rect = patches.Rectangle([x-150, y-150], 300, 300, color='white',
@@ -238,21 +348,31 @@ class TemperatureMap(GenericMap):
         
         return
     
-    def save(self):
+    def save(self, compression=None):
         date = sunpy.time.parse_time(self.date)
-        if not path.exists(self.maps_dir):
-            makedirs(self.maps_dir)
-        fname = path.join(self.maps_dir,
-                          '{:%Y-%m-%dT%H_%M_%S}.fits'.format(date))
-        alldata = np.zeros((self.shape[0], self.shape[1], self.n_params+1))
-        alldata[..., 0] = self.data
+        planes = [self.data]
         if self.n_params != 1:
-            fname = fname.replace('.fits', '_full.fits')
-            alldata[..., 1] = self.dem_width
-            alldata[..., 2] = self.emission_measure
-        alldata[..., -1] = self.goodness_of_fit
-        outmap = Map(alldata, self.meta.copy())
-        outmap.save(fname, clobber=True)
+            planes += [self.dem_width, self.emission_measure]
+        planes.append(self.goodness_of_fit)
+        summary = dict((name, self.summary_plane(name))
+                       for name in self.summary_names)
+        with instrument.stage('save'):
+            save_tempmap(planes, self.meta.copy(), self.maps_dir, date,
+                         self.n_params, compression, summary)
+        instrument.report(label='save')
+
+    def summary_plane(self, name):
+        """
+        Return one of the summaries of the fit's misfit landscape made with
+        the map (listed in summary_names), e.g. 't_std' or 'top_models';
+        see fitting.fit_summary.
+        """
+        if name not in self.summary_names:
+            raise KeyError('No {} summary for this map'.format(name))
+        plane = self._planes[name]
+        if callable(plane):
+            plane = self._planes[name] = plane()
+        return plane
 
 
     def min(self):
@@ -281,30 +401,17 @@ class TemperatureMap(GenericMap):
             and '211' are most likely to provide reliable results. Use of other
             channels is not recommended.
         """
-        # Load the appropriate temperature response function
-        tresp = read('/imaps/holly/home/ajl7/CoronaTemps/aia_tresp')
-        resp = tresp['resp{}'.format(wlen)]
-    
         # Get some information from the TemperatureMap and set up filenames, etc
-        tempdata = self.data.copy()
-        tempdata[np.isnan(tempdata)] = 0.0
         date = sunpy.time.parse_time(self.date)
         if not model:
-            data_dir = self.data_dir
-            fits_dir = path.join(data_dir, '{:%Y/%m/%d}/{}'.format(date, wlen))
-            filename = path.join(fits_dir,
-                                 '*{0:%Y?%m?%d}?{0:%H?%M}*fits'.format(date))
-            if wlen == '94': filename = filename.replace('94', '094')
+            filename = archive_index(self.data_dir).find(wlen, date,
+                                                         tolerance=60)
     
             # Load and appropriately process AIA data
-            filelist = glob.glob(filename)
-            if filelist == []:
+            if filename is None:
                 print 'AIA data not found :('
                 return
-            aiamap = Map(filename)
-            aiamap.data /= aiamap.exposure_time
-            aiamap = aiaprep(aiamap)
-            aiamap = aiamap.submap(self.xrange, self.yrange)
+            aiamap = prep_image(filename, (self.xrange, self.yrange))
         else:
             fname = '/imaps/holly/home/ajl7/CoronaTemps/data/synthetic/{}/model.fits'.format(wlen)
             if wlen == '94': fname = fname.replace('94', '094')
@@ -312,12 +419,7 @@ class TemperatureMap(GenericMap):
 
         # Create new Map and put EM values in it
         emmap = Map(self.data.copy(), self.meta.copy())
-        indices = np.round((tempdata - 4.0) / 0.05).astype(int)
-        indices[indices < 0] = 0
-        indices[indices > 100] = 100
-        #print emmap.shape, indices.shape, tempdata.shape, aiamap.shape, resp.shape
-        emmap.data = np.log10(aiamap.data / resp[indices])
-        #emmap.data = aiamap.data / resp[indices]
+        emmap.data = estimate_em(self.data, aiamap.data, wlen)
 
         emmapcubehelix = _cm.cubehelix(s=2.8, r=-0.7, h=1.4, gamma=1.0)
         cm.register_cmap(name='emhelix', data=emmapcubehelix)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the archive index lookups (archive.py).
+
+Run with pytest, or as a script:
+
+    python test_archive.py
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import datetime as dt
+from os import path
+from archive import ArchiveIndex, parse_filename
+
+
+def make_archive(names):
+    """Temporary archive holding empty files with the given names."""
+    data_dir = tempfile.mkdtemp(prefix='archive-')
+    day_dir = path.join(data_dir, '2011', '01', '01')
+    os.makedirs(day_dir)
+    for name in names:
+        open(path.join(day_dir, name), 'w').close()
+    return data_dir
+
+
+def test_short_name_span():
+    assert parse_filename('aia20110101_1200_0171.fits')[2] == 60
+    assert parse_filename('aia20110101_120005_0171.fits')[2] == 1
+    assert parse_filename(
+        'aia_lev1_171a_2011_01_01t12_00_00_34z_image_lev1.fits')[2] == 0
+
+
+def test_short_name_mid_minute():
+    data_dir = make_archive(['aia20110101_1200_0171.fits'])
+    try:
+        index = ArchiveIndex(data_dir, path.join(data_dir, 'index.sqlite'))
+        fname = index.find('171', dt.datetime(2011, 1, 1, 12, 0, 30),
+                           tolerance=12)
+        assert fname is not None and fname.endswith('_1200_0171.fits')
+        # Within tolerance of the end of the minute, but not beyond it
+        assert index.nearest('171', dt.datetime(2011, 1, 1, 12, 1, 10),
+                             tolerance=12) == fname
+        assert index.nearest('171', dt.datetime(2011, 1, 1, 12, 1, 20),
+                             tolerance=12) is None
+        assert index.nearest('171', dt.datetime(2011, 1, 1, 11, 59, 40),
+                             tolerance=12) is None
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_nearest_prefers_closest():
+    data_dir = make_archive(
+        ['aia20110101_1200_0171.fits',
+         'aia_lev1_171a_2011_01_01t12_00_47_34z_image_lev1.fits'])
+    try:
+        index = ArchiveIndex(data_dir, path.join(data_dir, 'index.sqlite'))
+        index.scan()
+        near = index.nearest('171', dt.datetime(2011, 1, 1, 12, 0, 48))
+        assert near.endswith('_image_lev1.fits')
+        near = index.nearest('171', dt.datetime(2011, 1, 1, 12, 0, 10))
+        assert near.endswith('_1200_0171.fits')
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_fetch_missing_short_name():
+    from acquire import fetch_missing
+
+    class NoFetcher(object):
+        def fetch(self, wlen, start, end, dest_dir):
+            raise AssertionError('fetched {} at {}'.format(wlen, start))
+
+    data_dir = make_archive(['aia20110101_1200_0171.fits'])
+    try:
+        report = fetch_missing([dt.datetime(2011, 1, 1, 12, 0, 30)],
+                               data_dir, channels=['171'],
+                               fetcher=NoFetcher(), retries=0)
+        assert report.ok and report.found == [
+            ('171', dt.datetime(2011, 1, 1, 12, 0, 30))]
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_old_index_rebuilt():
+    data_dir = make_archive(['aia20110101_1200_0171.fits'])
+    try:
+        db_file = path.join(data_dir, 'index.sqlite')
+        conn = sqlite3.connect(db_file)
+        conn.execute('CREATE TABLE files (path TEXT PRIMARY KEY, dir TEXT, '
+                     'wlen TEXT, time REAL)')
+        conn.commit()
+        conn.close()
+        index = ArchiveIndex(data_dir, db_file)
+        assert index.find('171', dt.datetime(2011, 1, 1, 12, 0, 30)) \
+            is not None
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    for name, check in sorted(globals().items()):
+        if name.startswith('test_') and callable(check):
+            check()
+            print name, 'ok'
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the fitting kernels (fits extension) and their helpers in
+fitting.py against direct searches of the model table.
+
+Needs the compiled extension (python setup.py build_ext --inplace). Run with
+pytest, or as a script:
+
+    python test_fitting.py
+"""
+
+import numpy as np
+from itertools import product
+from utils import emission_table
+from fitting import build_model_index, fit_images, fit_indexed, fit_warm, \
+    path_counts
+
+
+def random_table(rng, n_vals=400, n_wlens=6, n_duplicates=50):
+    """
+    Random model table with some rows repeated, so that pixels have tied
+    best fits, and the row number of each model as its parameter.
+    """
+    model = rng.rand(n_vals, n_wlens).astype('float32')
+    copies = rng.randint(0, n_vals, n_duplicates)
+    model[rng.randint(0, n_vals, n_duplicates)] = model[copies]
+    parvals = np.arange(n_vals, dtype='float32').reshape((-1, 1))
+    return model, parvals
+
+
+def synthetic_responses(logt=np.arange(0, 15.05, 0.05)):
+    """Smooth temperature responses peaking at different temperatures."""
+    peaks = [6.8, 7.0, 5.9, 6.2, 6.3, 6.5]
+    return np.array([1e-26 * np.exp(-(logt - peak) ** 2 / (2 * 0.15 ** 2))
+                     for peak in peaks])
+
+
+def test_indexed_matches_scan():
+    rng = np.random.RandomState(1)
+    model, parvals = random_table(rng)
+    images = rng.rand(model.shape[1], 20, 30).astype('float32')
+    # Some pixels exactly on a (possibly repeated) model
+    rows = rng.randint(0, len(model), 100)
+    images.reshape((model.shape[1], -1))[:, :100] = model[rows].T
+    scan = fit_images(images, model, parvals, 1)[0]
+    index = build_model_index(model)
+    indexed, n_examined = fit_indexed(images, model, parvals[:, 0], index)
+    assert np.array_equal(indexed, scan)
+    assert n_examined.max() <= len(model)
+
+
+def test_solve_em_matches_height_scan():
+    resp = synthetic_responses()
+    temp = np.arange(5.6, 7.0, 0.05)
+    widths = np.arange(0.1, 0.55, 0.1)
+    log_heights = np.arange(24, 29.05, 0.1)
+    parvals = np.array([i for i in product(temp, widths, 10.0 ** log_heights)])
+    model = emission_table(parvals, resp).astype('float32')
+    parvals = parvals.astype('float32')
+    shapes = np.array([i for i in product(temp, widths, [1.0])])
+    unit = emission_table(shapes, resp, norm=False).astype('float32')
+    shapes = shapes.astype('float32')
+
+    # Model DEMs on the temperature and width nodes, with EMs on the heights
+    # grid and off it
+    rng = np.random.RandomState(2)
+    n = 200
+    true_t = temp[rng.randint(2, len(temp) - 2, n)]
+    true_w = widths[rng.randint(0, len(widths), n)]
+    on_grid = log_heights[rng.randint(5, len(log_heights) - 5, n)]
+    for true_em in [on_grid, rng.uniform(24.5, 28.5, n)]:
+        dems = np.column_stack([true_t, true_w, 10.0 ** true_em])
+        images = emission_table(dems, resp).T.reshape((6, 1, n))
+        images = images.astype('float32')
+        scan = fit_images(images, model, parvals, 3)[0][0]
+        solved = fit_images(images, unit, shapes, 3, solve_em=True)[0][0]
+        assert np.allclose(solved[:, 0], true_t, atol=1e-4)
+        assert np.allclose(solved[:, 1], true_w, atol=1e-4)
+        assert np.allclose(solved[:, 2], true_em, atol=1e-4)
+        # The solved EM fits at least as well as any height of the grid
+        tol = 1e-5 * images.mean(axis=0)[0]
+        assert np.all(solved[:, 3] <= scan[:, 3] + tol)
+        if true_em is on_grid:
+            assert np.allclose(scan[:, :3], solved[:, :3], atol=1e-4)
+
+
+def test_warm_start_matches_cold_fit():
+    resp = synthetic_responses()
+    axes = [np.arange(5.6, 7.0, 0.05), np.arange(0.1, 0.55, 0.1),
+            10.0 ** np.arange(25, 28.05, 0.25)]
+    grid_shape = tuple(len(axis) for axis in axes)
+    parvals = np.array([i for i in product(*axes)])
+    model = emission_table(parvals, resp).astype('float32')
+    parvals = parvals.astype('float32')
+
+    # Every pixel exactly on a model, so that a cold fit finds it
+    rng = np.random.RandomState(4)
+    x, y = 12, 15
+    rows = rng.randint(0, len(model), x * y)
+    images = model[rows].T.reshape((-1, x, y)).copy()
+    cold, current, path = fit_warm(images, model, parvals, grid_shape)
+    assert path_counts(path)['full'] == x * y
+
+    # An unchanged frame keeps every solution
+    warm, _, path = fit_warm(images, model, parvals, grid_shape, current)
+    assert np.array_equal(warm, cold)
+    assert path_counts(path)['kept'] == x * y
+
+    # Changed pixels, near their previous model and far from it, are
+    # refitted and get the same solution as a cold fit of the new frame
+    changed = rng.rand(x, y) < 0.3
+    near = np.clip(rows + rng.randint(-2, 3, x * y), 0, len(model) - 1)
+    far = rng.randint(0, len(model), x * y)
+    new_rows = np.where(rng.rand(x * y) < 0.5, near, far)
+    new_rows = np.where(changed.ravel(), new_rows, rows)
+    changed = (new_rows != rows).reshape((x, y))
+    new_images = model[new_rows].T.reshape((-1, x, y)).copy()
+    cold = fit_images(new_images, model, parvals, 3)[0]
+    warm, _, path = fit_warm(new_images, model, parvals, grid_shape,
+                             current)
+    assert np.allclose(warm, cold, rtol=0, atol=1e-5)
+    assert np.all(path[~changed] == 1)
+    assert np.all(path[changed] > 1)
+    assert path_counts(path)['kept'] == x * y - changed.sum()
+
+
+if __name__ == '__main__':
+    for name, check in sorted(globals().items()):
+        if name.startswith('test_') and callable(check):
+            check()
+            print name, 'ok'
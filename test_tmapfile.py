@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of reading and writing temperature map files (tmapfile.py).
+
+Run with pytest, or as a script:
+
+    python test_tmapfile.py
+"""
+
+import shutil
+import tempfile
+import numpy as np
+from os import path
+from numpy.testing import assert_array_equal
+from astropy.io import fits
+import tmapfile
+from tmapfile import plane_names, write_tempmap, read_tempmap
+
+meta = {'date-obs': '2011-01-01T12:00:00', 'crpix1': 16.5, 'cdelt1': 0.6,
+        'telescop': 'SDO/AIA'}
+
+
+def results_cube(n_planes=4, shape=(24, 32)):
+    """Fit results with NaNs where no fit was made."""
+    rng = np.random.RandomState(3)
+    data = rng.rand(*(shape + (n_planes,))).astype('float32') + 5.5
+    data[:3, :5] = np.nan
+    return data
+
+
+def check_round_trip(compression):
+    tmpdir = tempfile.mkdtemp(prefix='tmapfile-')
+    try:
+        fname = path.join(tmpdir, 'map.fits')
+        data = results_cube()
+        write_tempmap(fname, data, meta, compression,
+                      extra={'t_std': data[..., 0] / 10})
+        with fits.open(fname) as hdulist:
+            assert [hdu.name for hdu in hdulist[1:]] == plane_names + \
+                ['T_STD']
+            # Decompressed planes come back in native byte order
+            assert hdulist[1].data.dtype.newbyteorder('=') == 'float32'
+        header, planes = read_tempmap(fname)
+        assert header['telescop'] == 'SDO/AIA' and header['crpix1'] == 16.5
+        for i, name in enumerate(plane_names):
+            # Lossless, NaNs included
+            assert_array_equal(planes[name.lower()](), data[..., i])
+        assert_array_equal(planes['t_std'](), data[..., 0] / 10)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_round_trip():
+    check_round_trip(None)
+
+
+def test_round_trip_compressed():
+    check_round_trip('GZIP_2')
+
+
+def test_planes_read_when_used():
+    tmpdir = tempfile.mkdtemp(prefix='tmapfile-')
+    getdata = fits.getdata
+    read = []
+
+    def counting_getdata(fname, *args, **kwargs):
+        read.append(kwargs.get('extname'))
+        return getdata(fname, *args, **kwargs)
+
+    try:
+        fname = path.join(tmpdir, 'map.fits')
+        data = results_cube()
+        write_tempmap(fname, data, meta)
+        fits.getdata = counting_getdata
+        header, planes = read_tempmap(fname)
+        assert read == []
+        temperature = planes['temperature']()
+        assert read == ['TEMPERATURE']
+        for i, name in enumerate(['dem_width', 'emission_measure',
+                                  'goodness_of_fit']):
+            assert_array_equal(planes[name](), data[..., i + 1])
+        assert read == plane_names
+        assert_array_equal(temperature, data[..., 0])
+    finally:
+        fits.getdata = getdata
+        shutil.rmtree(tmpdir)
+
+
+def test_single_cube_file():
+    tmpdir = tempfile.mkdtemp(prefix='tmapfile-')
+    try:
+        fname = path.join(tmpdir, 'old.fits')
+        for n_planes in [2, 4]:
+            data = results_cube(n_planes)
+            fits.PrimaryHDU(data, tmapfile.fits_header(meta)).writeto(
+                fname, clobber=True)
+            header, planes = read_tempmap(fname)
+            assert header['telescop'] == 'SDO/AIA'
+            names = tmapfile.names_for(n_planes)
+            assert sorted(planes) == sorted(name.lower() for name in names)
+            for i, name in enumerate(names):
+                assert_array_equal(planes[name.lower()](), data[..., i])
+        fits.PrimaryHDU(np.zeros((4, 4), dtype='float32')).writeto(
+            fname, clobber=True)
+        try:
+            read_tempmap(fname)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('2-D image read as a temperature map')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    for name, check in sorted(globals().items()):
+        if name.startswith('test_') and callable(check):
+            check()
+            print name, 'ok'
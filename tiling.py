@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded-memory fitting of full-resolution frames.
+
+The six prepared channels are written one at a time to a float32 staging
+file, and the frame is then read, fitted and written back in blocks of rows
+("tiles") whose size follows from a memory ceiling. Results go straight into
+a memory-mapped FITS file, so apart from preparing a single channel the
+memory used depends on the tile size rather than the frame size.
+"""
+
+import os
+import tempfile
+import numpy as np
+import instrument
+from utils import valid_pixels
+from acquire import fetch_missing
+from fitting import build_model_index, fit_images, refine_fits, \
+    fit_quantised
+from prep import prep_images, check_grid
+from grids import is_product_grid
+from tmapfile import names_for, create_tempmap_file, read_tempmap, \
+    write_tempmap
+from create_tempmap import wlens, find_channel, load_channel, \
+    parameter_grid, synthetic_model, unpack_results, quantise_options, \
+    print_quantise_stats
+
+def tile_bytes_per_pixel(n_wlens, n_out):
+    """
+    Generous estimate of the working memory per pixel of a tile: the tile
+    itself, the packed list of pixels and the kernel's copy of it, the
+    results before and after unpacking, and the temporaries of the pixel
+    mask.
+    """
+    return 4 * (4 * n_wlens + 2 * n_out + 4)
+
+
+def tile_rows_for(nx, n_wlens, n_out, max_memory):
+    """Number of rows of an nx-wide frame per tile within max_memory bytes."""
+    per_row = nx * tile_bytes_per_pixel(n_wlens, n_out)
+    return max(int(max_memory // per_row), 1)
+
+
+def stage_images(date, data_dir, fname, submap=None, verbose=False,
+                 n_workers=1):
+    """
+    Load and prepare the images for each wavelength and write them to a
+    staging file as they become ready. With the default n_workers=1 one
+    channel is prepared at a time; more workers prepare channels in parallel
+    at the cost of holding several full frames at once.
+
+    Returns the staged images as a read-only float32 memmap of shape
+    (n_wlens, ny, nx) and the header of the 171 image.
+    """
+    if date == 'model':
+        prepped = (load_channel(date, wlen, data_dir) for wlen in wlens)
+    else:
+        # Fetch every missing channel at once before preparing any
+        with instrument.stage('fetch'):
+            report = fetch_missing([date], data_dir, wlens, verbose=verbose)
+        if not report.ok:
+            raise IOError('Missing AIA data for {}\n{}'.format(date, report))
+        with instrument.stage('find'):
+            filenames = [find_channel(date, wlen, data_dir, verbose)
+                         for wlen in wlens]
+        prepped = prep_images(filenames, submap, n_workers)
+    staged = None
+    with instrument.stage('prep'):
+        for i, image in enumerate(prepped):
+            wlen = wlens[i]
+            if staged is None:
+                staged = np.lib.format.open_memmap(
+                    fname, mode='w+', dtype='float32',
+                    shape=(len(wlens),) + image.data.shape)
+                reference = image.meta.copy()
+            check_grid(image, staged.shape[1:], reference, wlen)
+            staged[i] = image.data
+            if wlen == '171':
+                header = image.meta.copy()
+            del image
+    staged.flush()
+    del staged
+    return np.load(fname, mmap_mode='r'), header
+
+
+def create_tempmap_tiled(date, output, n_params=1, data_dir=None,
+                         submap=None, verbose=False, force_temp_scan=False,
+                         n_threads=0, solve_em=False, search='scan',
+                         corrections=True, cache_dir=None, cache_size=2**30,
+                         max_radius=1.5, backend='serial', n_workers=None,
+                         max_memory=2**30, tile_rows=None, scratch_dir=None,
+                         prep_workers=1, compression=None, timing=None,
+                         refine=False, t_step=0.01, grid=None,
+                         quantise=None):
+    """
+    Calculate the temperatures for one set of AIA images tile by tile and
+    write them to a FITS file.
+
+    Parameters
+    ----------
+    output : str
+        Name of the temperature map file to write the results to, in the
+        layout of tmapfile.write_tempmap.
+    max_memory : int
+        Memory ceiling in bytes for the tile buffers, which sets the number
+        of rows per tile. The model table is memory-mapped from the cache and
+        not counted.
+    tile_rows : int, optional
+        Number of rows per tile, overriding max_memory.
+    scratch_dir : str, optional
+        Directory for the staging file of prepared images. Defaults to the
+        directory of output.
+    prep_workers : int
+        Number of channels prepared at once; see stage_images.
+    backend : {'serial' | 'pool'}
+        Fit each tile in this process with the threaded kernel or with a
+        pool of n_workers worker processes.
+    compression : str, optional
+        Tile compression for the saved planes; see tmapfile.write_tempmap.
+        The results are compressed once the fit is finished.
+    timing : str or object, optional
+        Record and report the time taken by each stage; see
+        create_tempmap.create_tempmap. Stages repeated for every tile are
+        added up.
+
+    The remaining arguments are as for create_tempmap.create_tempmap.
+    Averaging several images per channel (datfile) and warm starts are not
+    available here.
+
+    Returns
+    -------
+    output : str
+        Name of the file written.
+    """
+    solve_em = solve_em and n_params != 1
+    if solve_em and search != 'scan':
+        raise ValueError("Only search='scan' is available with solve_em")
+    if refine and solve_em:
+        raise ValueError('Refinement needs a full model grid')
+    if quantise and n_params != 1:
+        raise ValueError('Quantised fits need one parameter')
+    if timing is not None:
+        instrument.enable(timing)
+    n_wlens = len(wlens)
+    n_out = n_params + 1
+
+    temp, widths, heights, parvals = parameter_grid(n_params, solve_em,
+                                                    t_step, grid)
+    if refine and not is_product_grid(temp, widths, heights, parvals):
+        raise ValueError('Refinement needs a grid with every combination of '
+                         'its axes')
+    with instrument.stage('model'):
+        model = synthetic_model(parvals, n_params, solve_em, corrections,
+                                cache_dir, cache_size, force_temp_scan,
+                                verbose)
+        index = build_model_index(model) if search == 'index' else None
+
+    if scratch_dir is None:
+        scratch_dir = os.path.dirname(os.path.abspath(output))
+    fd, staging = tempfile.mkstemp(dir=scratch_dir, prefix='.staging-',
+                                   suffix='.npy')
+    os.close(fd)
+    try:
+        images, header = stage_images(date, data_dir, staging, submap,
+                                      verbose, prep_workers)
+        ny, nx = images.shape[1:]
+        if tile_rows is None:
+            tile_rows = tile_rows_for(nx, n_wlens, n_out, max_memory)
+        if verbose:
+            print 'Fitting {} x {} pixels in tiles of {} rows'.format(
+                ny, nx, tile_rows)
+        results = create_tempmap_file(output, (ny, nx), n_out, header)
+
+        def fit(block):
+            if backend == 'pool':
+                from pool import fit_pool
+                return fit_pool(block, model, parvals, n_params, solve_em,
+                                search, index, n_workers, n_threads or 1)
+            return fit_images(block, model, parvals, n_params, solve_em,
+                              search, index, n_threads)
+
+        n_fitted, n_examined, quantised = 0, 0, []
+        for start in range(0, ny, tile_rows):
+            stop = min(start + tile_rows, ny)
+            with instrument.stage('read'):
+                tile = np.array(images[:, start:stop])
+            # Normalise images to 171A if only using one parameter
+            if n_params == 1:
+                tile /= tile[2].copy()
+            if date == 'model':
+                meta = None
+            else:
+                meta = {'crpix1': header['crpix1'],
+                        'crpix2': header['crpix2'] - start,
+                        'cdelt1': header['cdelt1'],
+                        'cdelt2': header['cdelt2'],
+                        'crval1': header['crval1'],
+                        'crval2': header['crval2'],
+                        'rsun_obs': header['rsun_obs']}
+            mask = valid_pixels(tile, meta, max_radius)
+            tile = tile[:, mask].reshape((n_wlens, 1, -1))
+            n_fits = int(mask.sum())
+            with instrument.stage('fit'):
+                if quantise:
+                    temps, examined, stats = fit_quantised(
+                        tile, model, parvals, fit=fit,
+                        **quantise_options(quantise))
+                    quantised.append(stats)
+                    n_fits = stats['n_groups'] + stats['n_checked']
+                    instrument.count('groups', stats['n_groups'])
+                else:
+                    temps, examined = fit(tile)
+            if refine:
+                with instrument.stage('refine'):
+                    temps = refine_fits(tile, model, temps,
+                                        [temp, widths, heights], n_params,
+                                        **(refine if isinstance(refine, dict)
+                                           else {}))
+            del tile
+            with instrument.stage('write'):
+                temps = unpack_results(temps, mask)
+                for i, plane in enumerate(results):
+                    plane[start:stop] = temps[..., i]
+            del temps
+            n_fitted += mask.sum()
+            instrument.count('pixels', int(mask.sum()))
+            if examined is not None:
+                n_examined += examined.sum(dtype=np.int64)
+                instrument.count('models',
+                                 int(examined.sum(dtype=np.int64)))
+            else:
+                instrument.count('models', n_fits * len(parvals))
+            if verbose: print 'Rows {} to {} done'.format(start, stop)
+        for plane in results:
+            plane.flush()
+        del results, images
+    finally:
+        os.remove(staging)
+
+    if compression:
+        with instrument.stage('compress'):
+            fd, compressed = tempfile.mkstemp(dir=scratch_dir,
+                                              prefix='.tmap-', suffix='.fits')
+            os.close(fd)
+            meta, planes = read_tempmap(output)
+            write_tempmap(compressed, [planes[name.lower()]()
+                                       for name in names_for(n_out)],
+                          meta, compression)
+            os.rename(compressed, output)
+    instrument.report(label='create_tempmap_tiled')
+
+    if verbose: print 'Fitted {} of {} pixels'.format(n_fitted, ny * nx)
+    if search == 'index':
+        print 'Index search examined {:.1f} of {} models per pixel'.format(
+            n_examined / float(max(n_fitted, 1)), len(parvals))
+    if quantised:
+        print_quantise_stats(quantised)
+    return output
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Reading and writing of temperature map files.
+
+Each product of a fit is stored as its own float32 image extension, named
+after the TemperatureMap attribute it is loaded into (TEMPERATURE,
+DEM_WIDTH, EMISSION_MEASURE, GOODNESS_OF_FIT), after a primary HDU holding
+only the header. Extensions can be tile-compressed. Each plane is only read,
+memory-mapped, when it is first asked for.
+
+Summaries of the misfit landscape (see fitting.fit_summary) can be saved in
+further extensions after the products, named after the summary in upper
+case.
+
+Files written before this layout, with all products in one
+(ny, nx, n_params+1) cube, can still be read.
+"""
+
+import numpy as np
+from astropy.io import fits
+
+# Products of a three-parameter fit, in the order of the result cube; a
+# one-parameter fit only has the first and last
+plane_names = ['TEMPERATURE', 'DEM_WIDTH', 'EMISSION_MEASURE',
+               'GOODNESS_OF_FIT']
+
+# Header keywords describing the data layout, which are set from the data
+# rather than copied from a map header
+_layout_keys = ['SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'BSCALE', 'BZERO',
+                'PCOUNT', 'GCOUNT', 'XTENSION', 'EXTNAME', 'COMMENT',
+                'HISTORY', 'KEYCOMMENTS']
+
+
+def names_for(n_planes):
+    """Names of the planes of a result cube with n_planes products."""
+    if n_planes == 2:
+        return [plane_names[0], plane_names[-1]]
+    return plane_names[:n_planes]
+
+
+def fits_header(meta, header=None):
+    """
+    Copy the entries of a map header into a FITS header (by default the
+    header of an empty primary HDU), leaving out layout keywords and values
+    FITS cannot hold.
+    """
+    if header is None:
+        header = fits.PrimaryHDU().header
+    for key, value in (meta or {}).items():
+        key = key.upper()
+        if key in _layout_keys or key.startswith('NAXIS'):
+            continue
+        try:
+            header[key] = value
+        except (ValueError, TypeError):
+            continue
+    return header
+
+
+def write_tempmap(fname, data, meta, compression=None, quantize_level=None,
+                  extra=None):
+    """
+    Write the products of a fit to a temperature map file.
+
+    Parameters
+    ----------
+    fname : str
+        File to write, replacing any existing one.
+    data : numpy.ndarray or list
+        Result cube of shape (ny, nx, n_params+1), or a list of its planes.
+    meta : dict
+        Header of the map.
+    compression : str, optional
+        Tile compression for the planes. 'GZIP_1' and 'GZIP_2' are lossless
+        unless a quantize_level is given. Other types (e.g. 'RICE_1')
+        quantise the data and need an explicit quantize_level; quantised
+        planes may not keep the NaNs of unfitted pixels.
+    extra : dict, optional
+        Further arrays to save after the products, such as fit summaries,
+        keyed by name. They are saved as float32 too.
+    """
+    if isinstance(data, np.ndarray):
+        data = [data[..., i] for i in range(data.shape[-1])]
+    planes = zip(names_for(len(data)), data)
+    planes += [(name.upper(), value)
+               for name, value in sorted((extra or {}).items())]
+    hdus = [fits.PrimaryHDU(header=fits_header(meta))]
+    for name, plane in planes:
+        # Slices of a result cube must be made contiguous for compression
+        plane = np.ascontiguousarray(plane, dtype='float32')
+        if compression:
+            if quantize_level is None:
+                if not compression.startswith('GZIP'):
+                    raise ValueError('{} compression of float data needs a '
+                                     'quantize_level'.format(compression))
+                # No quantisation: lossless
+                quantize_level = 0.0
+            hdus.append(fits.CompImageHDU(plane, name=name,
+                                          compression_type=compression,
+                                          quantize_level=quantize_level))
+        else:
+            hdus.append(fits.ImageHDU(plane, name=name))
+    fits.HDUList(hdus).writeto(fname, clobber=True)
+
+
+def create_tempmap_file(fname, shape, n_planes, meta):
+    """
+    Create an uncompressed temperature map file for planes of the given
+    (ny, nx) shape, with the data left to be filled in, and return the
+    (zero-filled) planes as writable memmaps.
+    """
+    ny, nx = shape
+    nbytes = -(-ny * nx * 4 // 2880) * 2880
+    offsets = []
+    with open(fname, 'wb') as f:
+        f.write(fits_header(meta).tostring())
+        for name in names_for(n_planes):
+            header = fits.ImageHDU(np.zeros((1, 1), dtype='float32'),
+                                   name=name).header
+            header['NAXIS1'] = nx
+            header['NAXIS2'] = ny
+            f.write(header.tostring())
+            offsets.append(f.tell())
+            # Extend the file to the padded size of the plane
+            f.seek(nbytes - 1, 1)
+            f.write(b'\0')
+    return [np.memmap(fname, dtype='>f4', mode='r+', offset=offset,
+                      shape=shape) for offset in offsets]
+
+
+def read_tempmap(fname):
+    """
+    Open a temperature map file without reading its data.
+
+    Returns
+    -------
+    meta : dict
+        Map header, with lower-case keys.
+    planes : dict
+        For each product or summary in the file, a function that reads and
+        returns that plane, keyed by the lower-case plane name.
+    """
+    with fits.open(fname, memmap=True) as hdulist:
+        names = [hdu.name for hdu in hdulist[1:]]
+        header = hdulist[0].header
+    meta = dict((key.lower(), value) for key, value in header.items()
+                if key and key not in _layout_keys and
+                not key.startswith('NAXIS'))
+    # Each plane opens the file again, so no file is left open meanwhile
+    planes = {}
+    if plane_names[0] in names:
+        for name in names:
+            planes[name.lower()] = lambda name=name: fits.getdata(
+                fname, extname=name, memmap=True)
+    else:
+        # Single cube of all the products
+        if header.get('NAXIS') != 3:
+            raise ValueError('{} is not a temperature map'.format(fname))
+        for i, name in enumerate(names_for(header['NAXIS1'])):
+            planes[name.lower()] = lambda i=i: np.array(
+                fits.getdata(fname, 0, memmap=True)[..., i])
+    return meta, planes
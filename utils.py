@@ -6,35 +6,155 @@ Created on Tue May 12 14:39 2015
 """
 
 import numpy as np
-from scipy.io.idl import readsav as read
-from os.path import expanduser
 
 
-def gaussian(x, mean=0.0, std=1.0, amp=1.0):
-    """Simple function to return a Gaussian distribution"""
+def gaussian(x, mean=0.0, std=1.0, amp=1.0, norm=None):
+    """
+    Simple function to return a Gaussian distribution.
+
+    By default a distribution with amp=1 is normalised so that its sampled
+    maximum is exactly 1. Set norm=False to always return amp times the
+    analytic Gaussian, e.g. when the emission it produces is scaled linearly
+    afterwards.
+    """
     if isinstance(x, list):
         x = np.array(x)
+    if norm is None:
+        norm = (amp == 1)
     power = -((x - mean) ** 2.0) / (2.0 * (std ** 2.0))
     f = amp * np.exp(power)
-    if amp == 1:
+    if norm:
         f = f / max(f)
     return f
 
 
+def emission_table(parvals, resp, logt=None, norm=None, out=None,
+                   chunk_size=10000):
+    """
+    Calculate the synthetic emission produced by a grid of Gaussian DEMs.
+
+    Equivalent to evaluating gaussian(logt, *params, norm=norm) for each row
+    of parvals and integrating it against each temperature response, but
+    done a chunk of rows at a time as array operations.
+
+    Parameters
+    ----------
+    parvals : numpy.ndarray
+        DEM parameters (mean log(T), width, amplitude), shape (n_vals, 3).
+    resp : numpy.ndarray
+        Temperature responses sampled at logt, shape (n_wlens, len(logt)).
+    logt : numpy.ndarray, optional
+        log(T) axis of resp. Defaults to 0-15 in steps of 0.05, as returned
+        by load_temp_responses.
+    norm : bool, optional
+        Passed on to gaussian for every DEM.
+    out : numpy.ndarray, optional
+        Array of shape (n_vals, n_wlens) to store the results in, e.g. a
+        memmap.
+    chunk_size : int
+        Number of DEMs evaluated at once. Limits temporary memory use to
+        about chunk_size * len(logt) * 16 bytes.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        Synthetic emission in each channel, shape (n_vals, n_wlens).
+    """
+    if logt is None:
+        logt = np.arange(0, 15.05, 0.05)
+    parvals = np.asarray(parvals, dtype='float64')
+    delta_t = logt[1] - logt[0]
+    n_vals = parvals.shape[0]
+    if out is None:
+        out = np.zeros((n_vals, resp.shape[0]))
+    for start in range(0, n_vals, chunk_size):
+        mean, std, amp = parvals[start:start+chunk_size, :3].T[..., None]
+        dem = np.exp(-((logt - mean) ** 2.0) / (2.0 * (std ** 2.0)))
+        dem *= amp
+        if norm is None:
+            normalise = (amp[:, 0] == 1)
+        else:
+            normalise = np.repeat(bool(norm), amp.shape[0])
+        dem[normalise] /= dem[normalise].max(axis=1)[:, None]
+        out[start:start+chunk_size] = np.dot(dem, resp.T) * delta_t
+    return out
+
+
+def split_counts(n, size):
+    """
+    Split n items between size processes as evenly as possible, giving the
+    remainder to the lowest ranks. Returns the counts and displacements.
+    """
+    counts = np.zeros(size, dtype=int) + (n // size)
+    counts[:n % size] += 1
+    displs = np.zeros(size, dtype=int)
+    displs[1:] = np.cumsum(counts)[:-1]
+    return counts, displs
+
+
+def valid_pixels(images, meta=None, max_radius=1.5):
+    """
+    Find the pixels worth fitting in a stack of images.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        Intensities of shape (n_wlens, ny, nx).
+    meta : dict, optional
+        FITS header of the images. If given, pixels further than max_radius
+        solar radii from disk centre according to its WCS are excluded.
+    max_radius : float
+        Outer radius of the fitted region in solar radii.
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        Boolean array of shape (ny, nx), True for pixels with finite
+        intensities in every channel, some emission, and within max_radius.
+    """
+    mask = np.all(np.isfinite(images), axis=0)
+    mask &= np.sum(np.where(mask, images, 0), axis=0) > 0
+    if meta is not None and max_radius is not None:
+        ny, nx = mask.shape
+        x = (np.arange(nx) + 1 - meta['crpix1']) * meta['cdelt1'] \
+            + meta['crval1']
+        y = (np.arange(ny) + 1 - meta['crpix2']) * meta['cdelt2'] \
+            + meta['crval2']
+        r = np.sqrt((x[None, :] ** 2.0) + (y[:, None] ** 2.0))
+        mask &= r <= max_radius * meta['rsun_obs']
+    return mask
+
+
 def load_temp_responses(n_wlens=6, corrections=True):
+    # Imported here as the response store itself uses the cache module
+    from responses import load_responses
     resp = np.zeros((n_wlens, 301))
-    tresp = read(expanduser('~/CoronaTemps/aia_tresp'))
-    resp[0, 80:181] = tresp['resp94']
-    resp[1, 80:181] = tresp['resp131']
-    resp[2, 80:181] = tresp['resp171']
-    resp[3, 80:181] = tresp['resp193']
-    resp[4, 80:181] = tresp['resp211']
-    resp[5, 80:181] = tresp['resp335']
+    tresp = load_responses()
+    resp[0, 80:181] = tresp['94']
+    resp[1, 80:181] = tresp['131']
+    resp[2, 80:181] = tresp['171']
+    resp[3, 80:181] = tresp['193']
+    resp[4, 80:181] = tresp['211']
+    resp[5, 80:181] = tresp['335']
     if n_wlens > 6:
-        resp[6, 80:181] = tresp['resp304']
+        resp[6, 80:181] = tresp['304']
     if corrections:
         # Add empirical correction factor for 9.4nm response function below log(T)=6.3
         # (see Aschwanden et al 2011)
         resp[0:126, 0] = resp[0:126, 0]*6.7
     
     return resp
+
+
+def estimate_em(logt, intensity, wlen):
+    """
+    Approximate the emission measure (in log scale) that produces the given
+    intensity in one AIA channel from plasma at a single temperature logt,
+    as TemperatureMap.calculate_em does. Pixels with no temperature are
+    treated as being at log(T) = 4.
+    """
+    from responses import load_responses
+    resp = load_responses()[wlen]
+    logt = np.where(np.isnan(logt), 0.0, logt)
+    indices = np.clip(np.round((logt - 4.0) / 0.05).astype(int), 0, 100)
+    return np.log10(intensity / resp[indices])
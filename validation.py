@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Validation of the temperature fits against synthetic data from model DEMs.
+
+Synthetic AIA intensities are calculated in memory for a grid of Gaussian
+DEMs (temperature x width x height) and every DEM in the grid is fitted in a
+single pass, by a pool of worker processes or the threaded kernel, with the
+same model table as a real run. The results are compared with the DEMs the
+data came from, and the errors are returned as arrays of shape
+(n_widths, n_temps, n_heights), which can be saved, summarised and,
+optionally, plotted.
+"""
+
+import numpy as np
+from os import path
+from itertools import product
+from utils import emission_table, load_temp_responses, valid_pixels, \
+    estimate_em
+from fitting import build_model_index, fit_images, refine_fits
+from create_tempmap import wlens, parameter_grid, synthetic_model, \
+    unpack_results
+
+# Default grid of model DEMs
+default_temps = np.arange(5.6, 7.005, 0.01)
+default_widths = np.array([0.01, 0.1, 0.5])
+default_heights = 10 ** np.arange(20, 35, 0.1)
+
+# Channels averaged for the em_wlen options 'three' and 'all'
+em_channels = {'three': ['171', '193', '211'],
+               'all': ['94', '131', '171', '193', '211', '335']}
+
+
+def model_emission(temps, widths, heights, resp=None):
+    """
+    Synthetic emission in each channel of a grid of Gaussian DEMs, shape
+    (n_wlens, n_widths, n_temps, n_heights).
+    """
+    if resp is None:
+        resp = load_temp_responses()
+    parvals = np.array([i for i in product(widths, temps, heights)])
+    # emission_table expects (mean log(T), width, amplitude)
+    emission = emission_table(parvals[:, [1, 0, 2]], resp)
+    return emission.T.reshape((resp.shape[0], len(widths), len(temps),
+                               len(heights)))
+
+
+def validate(n_params=1, temps=None, widths=None, heights=None,
+             em_wlen='171', backend='pool', n_workers=None, n_threads=0,
+             solve_em=False, search='scan', corrections=True, cache_dir=None,
+             refine=False, t_step=0.01, grid=None, verbose=False):
+    """
+    Fit synthetic data for a grid of model DEMs and measure the errors.
+
+    Parameters
+    ----------
+    n_params : 1 or 3
+        Number of parameters fitted, as for create_tempmap.
+    temps, widths, heights : numpy.ndarray, optional
+        Mean log(T), width and height of the model DEMs. Default to
+        default_temps, default_widths and default_heights.
+    em_wlen : str
+        With one parameter, the channel the emission measure is estimated
+        from (see TemperatureMap.calculate_em), or 'three' or 'all' for the
+        mean estimate from 171, 193 and 211 or from all six channels.
+    backend : {'pool' | 'serial'}
+        Fit with a pool of n_workers worker processes (default one per
+        core) or in this process with n_threads kernel threads.
+
+    The remaining arguments are as for create_tempmap.create_tempmap.
+
+    Returns
+    -------
+    metrics : dict
+        The DEM grid ('temps', 'widths', 'heights') and arrays of shape
+        (n_widths, n_temps, n_heights): the fitted log(T) ('t_out'), log
+        emission measure ('em_out'), width for three parameters
+        ('width_out') and goodness of fit ('fit'), and the percentage
+        errors in the temperature ('t_error'), emission measure
+        ('em_error') and width ('width_error').
+    """
+    if temps is None:
+        temps = default_temps
+    if widths is None:
+        widths = default_widths
+    if heights is None:
+        heights = default_heights
+    solve_em = solve_em and n_params != 1
+
+    resp = load_temp_responses(corrections=corrections)
+    emission = model_emission(temps, widths, heights, resp)
+    images = emission.reshape((len(wlens), len(widths) * len(temps), -1))
+    images = images.astype('float32')
+    if n_params == 1:
+        images /= images[2].copy()
+    mask = valid_pixels(images)
+    packed = images[:, mask].reshape((len(wlens), 1, -1))
+    if verbose:
+        print 'Fitting {} of {} model DEMs'.format(mask.sum(), mask.size)
+
+    axes = parameter_grid(n_params, solve_em, t_step, grid)
+    grid = axes[3]
+    model = synthetic_model(grid, n_params, solve_em, corrections, cache_dir,
+                            verbose=verbose)
+    index = build_model_index(model) if search == 'index' else None
+    if backend == 'pool':
+        from pool import fit_pool
+        results = fit_pool(packed, model, grid, n_params, solve_em, search,
+                           index, n_workers, n_threads or 1)[0]
+    else:
+        results = fit_images(packed, model, grid, n_params, solve_em, search,
+                             index, n_threads)[0]
+    if refine:
+        results = refine_fits(packed, model, results, axes[:3], n_params,
+                              **(refine if isinstance(refine, dict) else {}))
+    results = unpack_results(results, mask)
+    shape = (len(widths), len(temps), len(heights))
+    results = results.reshape(shape + (results.shape[-1],))
+
+    metrics = {'temps': temps, 'widths': widths, 'heights': heights,
+               't_out': results[..., 0], 'fit': results[..., -1]}
+    if n_params == 1:
+        channels = em_channels.get(em_wlen, [em_wlen])
+        metrics['em_out'] = np.mean(
+            [estimate_em(metrics['t_out'], emission[wlens.index(
+                wlen.zfill(3))], wlen) for wlen in channels], axis=0)
+    else:
+        metrics['width_out'] = results[..., 1]
+        metrics['width_error'] = abs(widths[:, None, None] -
+                                     metrics['width_out']) \
+            / widths[:, None, None] * 100
+        metrics['em_out'] = results[..., 2]
+    metrics['t_error'] = abs(temps[None, :, None] - metrics['t_out']) \
+        / temps[None, :, None] * 100
+    metrics['em_error'] = abs(heights - 10.0 ** metrics['em_out']) \
+        / heights * 100
+    return metrics
+
+
+def summarise(metrics):
+    """
+    Smallest, mean and largest value of each metric for each DEM width, as
+    a dict of (n_widths, 3) arrays.
+    """
+    summary = {}
+    for name in ['t_out', 't_error', 'width_out', 'width_error', 'em_out',
+                 'em_error', 'fit']:
+        if name in metrics:
+            values = metrics[name].reshape((len(metrics['widths']), -1))
+            summary[name] = np.array([np.nanmin(values, axis=1),
+                                      np.nanmean(values, axis=1),
+                                      np.nanmax(values, axis=1)]).T
+    return summary
+
+
+def save_metrics(metrics, fname):
+    """Save the metrics from validate to a .npz file."""
+    np.savez_compressed(fname, **metrics)
+
+
+def load_metrics(fname):
+    """Load metrics saved by save_metrics as a dict."""
+    saved = np.load(fname)
+    return dict((name, saved[name]) for name in saved.files)
+
+
+def plot_metrics(metrics, outdir, em_wlen='171'):
+    """
+    Plot the fitted values, their errors and the goodness of fit against
+    the input log(T) and EM for each DEM width, and save the figures in
+    outdir.
+    """
+    from matplotlib import use
+    use('agg')
+    import matplotlib.pyplot as plt
+
+    temps, widths, heights = metrics['temps'], metrics['widths'], \
+        metrics['heights']
+    extent = [np.log10(heights[0]), np.log10(heights[-1]), temps[0],
+              temps[-1]]
+    three = 'width_out' in metrics
+
+    def panel(fig, i, data, title, cmap, vmin=None, vmax=None):
+        fig.add_subplot(1, 3, i)
+        plt.imshow(data, origin='lower', aspect='auto', extent=extent,
+                   cmap=cmap, vmin=vmin, vmax=vmax, interpolation='nearest')
+        plt.colorbar()
+        plt.title(title, fontsize=28)
+        plt.xlabel('Input log(EM)', fontsize=24)
+        if i == 1:
+            plt.ylabel('Input log(T)', fontsize=24)
+
+    rows = [('t', 'Solution log(T)', 'tempsolutions', (5.6, 7.0)),
+            ('em', 'Solution log(EM)', 'emsolutions', (None, None))]
+    if three:
+        rows.append(('width', 'Solution width', 'widsolutions',
+                     (widths[0], widths[-1])))
+    for w, wid in enumerate(widths):
+        fit = np.log10(metrics['fit'][w])
+        for name, title, prefix, (vmin, vmax) in rows:
+            fig = plt.figure(figsize=(24, 12))
+            panel(fig, 1, metrics[name + '_out'][w], title, 'coolwarm',
+                  vmin, vmax)
+            panel(fig, 2, metrics[name + '_error'][w],
+                  'Difference from input (%)', 'RdYlGn_r')
+            panel(fig, 3, fit, 'log(Goodness-of-fit)', 'cubehelix')
+            fname = '{}_wid={:.3f}'.format(prefix, wid)
+            if name == 'em' and not three:
+                fname += '_wlen={}'.format(em_wlen)
+            plt.savefig(path.join(outdir, fname.replace('.', '_')))
+            plt.close()